@@ -0,0 +1,206 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import os
+import threading
+import time
+import typing
+from dagcontext.airflowutil.ivarloader import IVariableLoader
+from dagcontext.generic.activelog import ActivityLog
+
+from airflow.configuration import conf
+from airflow.models import Variable
+
+# Import the right objects based on airflow version 2.2.1 vs 1.10.12
+try:
+    from airflow.utils.session import create_session
+except Exception as ex:  # pylint: disable=broad-except
+    from airflow.utils.db import create_session
+
+
+class CachedAirflowVariableLoader(IVariableLoader):
+    """
+    Airflow variable loader that reads every requested variable with one metadata
+    database query and caches the parsed values in-process for ttl seconds.
+
+    The scheduler re-parses DAG files continuously, with this loader a parse only
+    touches the database once per ttl instead of once per variable per parse.
+
+    The cache only lives in the process that loaded the values. Where every DAG file
+    parse runs in a new process (the default DAG processor), each parse still reads
+    the database once; only parses in the same process, and the tasks a worker process
+    runs, share the values. Variables may hold secrets, so they are not written to a
+    shared file to get around that.
+
+    If the database read fails or takes longer than timeout seconds, the last known
+    good values are returned (with a warning) when every requested variable has one.
+    The read runs on a reader thread, a process has at most one: while a read that
+    timed out is still running, callers wait on it instead of starting another, and
+    its values are cached when it completes.
+
+    Variables are looked up in the order Variable.get uses. Without a secrets backend
+    configured ([secrets] backend) that is AIRFLOW_VAR_<NAME> environment variables,
+    then the database, which this loader reads in bulk; variables missing from both
+    are passed on to Variable.get. With a secrets backend, which Airflow consults
+    before the environment and the database, every variable is read with
+    Variable.get and only the caching applies.
+    """
+    ENVIRONMENT_PREFIX = "AIRFLOW_VAR_"
+
+    # name -> (parsed value, time fetched), shared by every instance in the process
+    _cache:typing.Dict[str, typing.Tuple[typing.Any, float]] = {}
+    _cache_lock = threading.Lock()
+
+    # Read in flight, (thread, variables, outcome), see _fetch_with_timeout
+    _reader:typing.Optional[typing.Tuple[threading.Thread, typing.FrozenSet[str], dict]] = None
+    _reader_lock = threading.Lock()
+
+    def __init__(self, ttl:float = 300.0, timeout:float = 5.0):
+        """
+        Constructor
+
+        Parameters:
+        ttl: Seconds a cached value is considered fresh
+        timeout: Seconds to wait on the database before using last known values
+        """
+        self.ttl = ttl
+        self.timeout = timeout
+
+    def load(self, variable:str) -> str:
+        """
+        Load a specific variable value from the Airflow variables
+        """
+        return self.load_many([variable])[variable]
+
+    def load_many(self, variables:typing.List[str]) -> typing.Dict[str, typing.Any]:
+        """
+        Load all variables, only those missing or expired in the cache are read.
+
+        Throws:
+        KeyError if a variable does not exist and has never been loaded
+        """
+        now = time.time()
+        with CachedAirflowVariableLoader._cache_lock:
+            cached = dict(CachedAirflowVariableLoader._cache)
+
+        expired = [name for name in variables if name not in cached or now - cached[name][1] >= self.ttl]
+        if expired:
+            try:
+                fetched = self._fetch_with_timeout(expired)
+            except Exception as ex:  # pylint: disable=broad-except
+                if any(name not in cached for name in expired):
+                    raise
+                ActivityLog.log_warning("Variable read failed, using last known values", ex)
+            else:
+                with CachedAirflowVariableLoader._cache_lock:
+                    for name, value in fetched.items():
+                        CachedAirflowVariableLoader._cache[name] = (value, now)
+                        cached[name] = (value, now)
+
+        return {name : cached[name][0] for name in variables}
+
+    @staticmethod
+    def invalidate(variable:str = None) -> None:
+        """Drop one variable, or all of them, from the cache"""
+        with CachedAirflowVariableLoader._cache_lock:
+            if variable is None:
+                CachedAirflowVariableLoader._cache.clear()
+            else:
+                CachedAirflowVariableLoader._cache.pop(variable, None)
+
+    def _fetch_with_timeout(self, variables:typing.List[str]) -> typing.Dict[str, typing.Any]:
+        """
+        Run the bulk read on a daemon thread so a hung database connection cannot
+        stall the caller past timeout. A read still running from an earlier call is
+        waited on when it covers the variables, no second reader is started.
+
+        Throws:
+        TimeoutError if the read does not complete in time or an earlier read of other
+        variables is still running, otherwise whatever the read raised
+        """
+        with CachedAirflowVariableLoader._reader_lock:
+            running = CachedAirflowVariableLoader._reader
+            if running is not None and running[0].is_alive():
+                if not running[1].issuperset(variables):
+                    raise TimeoutError("An earlier variable read is still running")
+                reader, _, outcome = running
+            else:
+                outcome = {}
+                reader = threading.Thread(
+                    target=CachedAirflowVariableLoader._read,
+                    args=(list(variables), outcome),
+                    name="VariableLoader",
+                    daemon=True
+                )
+                CachedAirflowVariableLoader._reader = (reader, frozenset(variables), outcome)
+                reader.start()
+
+        reader.join(self.timeout)
+
+        if reader.is_alive():
+            raise TimeoutError("Variable read exceeded {} seconds".format(self.timeout))
+        if "error" in outcome:
+            raise outcome["error"]
+        return {name : outcome["value"][name] for name in variables}
+
+    @staticmethod
+    def _read(variables:typing.List[str], outcome:dict) -> None:
+        """Reader thread body, values read after the caller gave up are still cached"""
+        try:
+            outcome["value"] = CachedAirflowVariableLoader._fetch(variables)
+        except Exception as ex:  # pylint: disable=broad-except
+            outcome["error"] = ex
+            return
+
+        now = time.time()
+        with CachedAirflowVariableLoader._cache_lock:
+            for name, value in outcome["value"].items():
+                CachedAirflowVariableLoader._cache[name] = (value, now)
+
+    @staticmethod
+    def _fetch(variables:typing.List[str]) -> typing.Dict[str, typing.Any]:
+        """
+        Environment first, then one database query, then Variable.get for the rest.
+        With a secrets backend configured it goes first, only Variable.get is used.
+        """
+        if CachedAirflowVariableLoader._has_secrets_backend():
+            return {name : CachedAirflowVariableLoader._parse(Variable.get(name)) for name in variables}
+
+        raw = {}
+        remaining = []
+        for name in variables:
+            env_name = CachedAirflowVariableLoader.ENVIRONMENT_PREFIX + name.upper()
+            if env_name in os.environ:
+                raw[name] = os.environ[env_name]
+            else:
+                remaining.append(name)
+
+        if remaining:
+            with create_session() as session:
+                rows = session.query(Variable).filter(Variable.key.in_(remaining)).all()
+                for row in rows:
+                    raw[row.key] = row.val
+
+        for name in remaining:
+            if name not in raw:
+                raw[name] = Variable.get(name)
+
+        return {name : CachedAirflowVariableLoader._parse(value) for name, value in raw.items()}
+
+    @staticmethod
+    def _has_secrets_backend() -> bool:
+        """True when a secrets backend is configured in front of the environment and database"""
+        return bool(conf.get("secrets", "backend", fallback=None))
+
+    @staticmethod
+    def _parse(value:typing.Any) -> typing.Any:
+        """Same parsing as AirflowVarialbeLoader, JSON if it is JSON"""
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except Exception as ex:  # pylint: disable=broad-except
+                # It's OK as only one will actually be a JSON object
+                pass
+        return value
@@ -0,0 +1,437 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import hashlib
+import importlib
+import json
+import os
+import typing
+from datetime import datetime, timedelta
+from dagcontext.airflowutil.fanout import RecordFanout
+from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.env_config import EnvironmentConfiguration
+
+
+class DagFactory:
+    """
+    Builds many DAGs from one JSON configuration file instead of a copy of example_dag.py
+    per pipeline variant. A single DAG file builds them all:
+
+        from dagcontext.airflowutil.dagfactory import DagFactory
+        globals().update(DagFactory.build(os.path.join(os.path.dirname(__file__), "pipelines.json")))
+
+    The configuration holds defaults and a list of DAGs, every DAG takes the defaults
+    it does not set itself:
+
+        {
+            "defaults" : {
+                "start_date" : "2021-01-01",
+                "environment_variables" : ["AIRFLOW_VAR_AZURE_DNS_HOST"],
+                "airflow_variables" : ["km_search_instances"],
+                "temp_directory" : "tmp/{dag_id}"
+            },
+            "dags" : [
+                {
+                    "dag_id" : "pipeline_a",
+                    "params" : {"OAK" : "Examples"},
+                    "tasks" : [
+                        {"task_id" : "show_context", "callable" : "tasks.exampletasks.ExampleTasks.show_context"},
+                        {"task_id" : "consume_xcom", "callable" : "tasks.exampletasks.ExampleTasks.consume_xcom",
+                         "upstream" : ["show_context"], "xcom_target" : ["show_context"]},
+                        {"task_id" : "records", "callable" : "tasks.exampletasks.ExampleTasks.process_batch",
+                         "upstream" : ["show_context"], "fanout" : {"batch_size" : 50}}
+                    ]
+                }
+            ]
+        }
+
+    DAG settings are DAG_SETTINGS, start_date is an ISO date and dagrun_timeout is in
+    minutes. The environment settings are always deferred (see EnvironmentConfiguration)
+    so nothing is read from Airflow while parsing, temp_directory is relative to the
+    directory of the configuration file. A task takes a callable (module path), upstream
+    task ids, xcom_target, prefetch, op_kwargs, trigger_rule and fanout (FANOUT_SETTINGS
+    of RecordFanout, true for the defaults). A fan-out task is chained by its plan and
+    reduce tasks, their arguments are set by RecordFanout so it takes no xcom_target,
+    prefetch, op_kwargs or trigger_rule.
+
+    Parsing the configuration, validating it and building the operator arguments of
+    every task produce a plan that is cached in the process and in CACHE_DIRECTORY
+    (.dagfactory next to the configuration), keyed by the hash of the file. Parsing an
+    unchanged configuration again only creates the operators.
+
+    A configuration packaged in the DAG zip is read from the zip, temp_directory and
+    the cache are then relative to the directory of the zip.
+    """
+    PLAN_VERSION = 2
+
+    CACHE_DIRECTORY:typing.Optional[str] = None
+    CACHE_DIRECTORY_NAME = ".dagfactory"
+
+    DEFAULT_VARIABLE_LOADER = "dagcontext.airflowutil.cachedvarloader.CachedAirflowVariableLoader"
+    DEFAULT_TEMP_DIRECTORY = "tmp/{dag_id}"
+
+    # Passed to DAG()
+    DAG_SETTINGS = (
+        "description",
+        "schedule_interval",
+        "start_date",
+        "catchup",
+        "dagrun_timeout",
+        "max_active_runs",
+        "tags",
+        "params",
+        "default_args"
+    )
+    # Used to build the environment settings
+    ENVIRONMENT_SETTINGS = (
+        "environment_variables",
+        "airflow_variables",
+        "variable_loader",
+        "temp_directory",
+        "static"
+    )
+    TASK_SETTINGS = ("task_id", "callable", "upstream", "xcom_target", "prefetch", "op_kwargs", "trigger_rule", "fanout")
+    # Task settings RecordFanout.build takes
+    FANOUT_SETTINGS = ("batch_size", "max_batches")
+
+    # Process cache, config path : ((mtime, size), plan)
+    _plans:typing.Dict[str, typing.Tuple[tuple, dict]] = {}
+
+    @staticmethod
+    def build(config_path:str) -> typing.Dict[str, typing.Any]:
+        """
+        Build the DAGs of a configuration file.
+
+        Parameters:
+        config_path: JSON configuration, see the class
+
+        Returns:
+        Dictionary of dag_id : DAG, add it to the globals of the DAG file
+
+        Throws:
+        ValueError if the configuration is invalid
+        ImportError if a task callable cannot be found
+        """
+        # Only needed while the DAG file is parsed
+        from airflow import DAG
+        try:
+            from airflow.operators.python import PythonOperator
+        except ImportError:
+            from airflow.operators.python_operator import PythonOperator
+
+        return_value = {}
+        for dag_plan in DagFactory.load_plan(config_path)["dags"]:
+            with DAG(dag_id=dag_plan["dag_id"], **DagFactory._dag_arguments(dag_plan["dag"])) as dag:
+                # task_id : (first, last) operator, they differ for a fan-out
+                operators = {}
+                for task in dag_plan["tasks"]:
+                    python_callable = DagFactory.resolve_callable(task["callable"])
+                    if task["fanout"] is not None:
+                        plan_task, _, reduce_task = RecordFanout.build(
+                            EnvironmentConfiguration.from_deferred(dag_plan["deferred"]),
+                            python_callable,
+                            task_prefix = task["task_id"],
+                            batch_size = task["fanout"].get("batch_size", RecordFanout.DEFAULT_BATCH_SIZE),
+                            max_batches = task["fanout"].get("max_batches", RecordFanout.DEFAULT_MAX_BATCHES)
+                        )
+                        operators[task["task_id"]] = (plan_task, reduce_task)
+                    else:
+                        operator = PythonOperator(
+                            task_id=task["task_id"],
+                            python_callable=python_callable,
+                            op_kwargs=task["op_kwargs"],
+                            provide_context=True,
+                            **({"trigger_rule" : task["trigger_rule"]} if task["trigger_rule"] else {})
+                        )
+                        operators[task["task_id"]] = (operator, operator)
+
+                for task in dag_plan["tasks"]:
+                    for upstream in task["upstream"]:
+                        operators[upstream][1] >> operators[task["task_id"]][0]  # pylint: disable=pointless-statement
+
+            return_value[dag_plan["dag_id"]] = dag
+        return return_value
+
+    @staticmethod
+    def load_plan(config_path:str) -> dict:
+        """
+        Plan of a configuration file, from the process cache when the file did not
+        change, from the cache directory when its hash is known, built otherwise.
+
+        Parameters:
+        config_path: JSON configuration, see the class
+
+        Returns:
+        {"version", "hash", "dags" : [{"dag_id", "dag", "deferred", "tasks"}]}
+
+        Throws:
+        ValueError if the configuration is invalid
+        """
+        config_path = os.path.abspath(config_path)
+        archive = DagFactory._archive_of(config_path)
+        stat = os.stat(archive or config_path)
+        signature = (stat.st_mtime, stat.st_size)
+
+        cached = DagFactory._plans.get(config_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        if archive:
+            # Packaged DAG, nothing can be written in the zip so the configuration
+            # directory is the one holding it
+            import zipfile
+            with zipfile.ZipFile(archive, "r") as package:
+                content = package.read(os.path.relpath(config_path, archive).replace(os.sep, "/"))
+            config_directory = os.path.dirname(archive)
+        else:
+            with open(config_path, "rb") as config_file:
+                content = config_file.read()
+            config_directory = os.path.dirname(config_path)
+        config_hash = DagFactory.config_hash(config_path, content)
+
+        cache_path = DagFactory._cache_path(config_path, config_directory, config_hash)
+        plan = DagFactory._read_cache(cache_path, config_hash)
+        if plan is None:
+            plan = DagFactory.create_plan(json.loads(content.decode("utf-8")), config_directory)
+            plan["hash"] = config_hash
+            DagFactory._write_cache(cache_path, plan)
+
+        DagFactory._plans[config_path] = (signature, plan)
+        return plan
+
+    @staticmethod
+    def config_hash(config_path:str, content:bytes) -> str:
+        """
+        Hash of the configuration content and everything else the plan depends on,
+        paths in the plan are built from the file location and working directory.
+        """
+        digest = hashlib.sha256(content)
+        digest.update(json.dumps([DagFactory.PLAN_VERSION, config_path, os.getcwd()]).encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def create_plan(config:dict, config_directory:str) -> dict:
+        """
+        Validate a configuration and build the arguments of every DAG and task.
+
+        Parameters:
+        config: Parsed configuration, see the class
+        config_directory: Directory relative paths are resolved against
+
+        Returns:
+        The plan, see load_plan
+
+        Throws:
+        ValueError if the configuration is invalid
+        """
+        defaults = config.get("defaults") or {}
+        dags = config.get("dags")
+        if not isinstance(dags, list) or not dags:
+            raise ValueError("The DAG configuration must have a list of dags")
+
+        dag_plans = []
+        dag_ids = set()
+        for definition in dags:
+            settings = dict(defaults)
+            settings.update(definition)
+
+            dag_id = settings.get("dag_id")
+            if not dag_id:
+                raise ValueError("Every DAG needs a dag_id")
+            if dag_id in dag_ids:
+                raise ValueError("Duplicate dag_id {}".format(dag_id))
+            dag_ids.add(dag_id)
+
+            unknown = set(settings) - set(DagFactory.DAG_SETTINGS) - set(DagFactory.ENVIRONMENT_SETTINGS) - {"dag_id", "tasks"}
+            if unknown:
+                raise ValueError("Unknown settings for DAG {}: {}".format(dag_id, sorted(unknown)))
+
+            environment_config = DagFactory._environment_config(dag_id, settings, config_directory)
+            dag_plans.append({
+                "dag_id" : dag_id,
+                "dag" : {name : settings[name] for name in DagFactory.DAG_SETTINGS if name in settings},
+                "deferred" : environment_config.get_deferred(),
+                "tasks" : DagFactory._task_plans(dag_id, settings.get("tasks"), environment_config)
+            })
+
+        return {"version" : DagFactory.PLAN_VERSION, "dags" : dag_plans}
+
+    @staticmethod
+    def resolve_callable(path:str) -> typing.Callable:
+        """
+        Object a dotted path points to, the longest importable prefix is the module:
+        tasks.exampletasks.ExampleTasks.show_context
+
+        Throws:
+        ImportError if nothing can be imported or an attribute is missing, or the
+        error of a module that exists but fails to import
+        """
+        parts = path.split(".")
+        for split in range(len(parts) - 1, 0, -1):
+            module_name = ".".join(parts[:split])
+            try:
+                return_value = importlib.import_module(module_name)
+            except ModuleNotFoundError as ex:
+                # Only a missing prefix (or package of it) means a shorter one is the module,
+                # anything the module itself fails to import is reported as is
+                if ex.name != module_name and not module_name.startswith("{}.".format(ex.name)):
+                    raise
+                continue
+            try:
+                for name in parts[split:]:
+                    return_value = getattr(return_value, name)
+            except AttributeError as ex:
+                raise ImportError("Cannot find {}".format(path)) from ex
+            return return_value
+        raise ImportError("Cannot import {}".format(path))
+
+    @staticmethod
+    def _environment_config(dag_id:str, settings:dict, config_directory:str) -> EnvironmentConfiguration:
+        """Deferred configuration of a DAG, the directories it needs are created by its first task"""
+        environment_config = EnvironmentConfiguration(
+            environment_variables = settings.get("environment_variables"),
+            airflow_variables = settings.get("airflow_variables"),
+            deferred = True
+        )
+        environment_config.loader_path = settings.get("variable_loader", DagFactory.DEFAULT_VARIABLE_LOADER)
+
+        for name, value in (settings.get("static") or {}).items():
+            environment_config.update_config(name, value)
+
+        temp_directory = settings.get("temp_directory", DagFactory.DEFAULT_TEMP_DIRECTORY).format(dag_id=dag_id)
+        environment_config.update_config(Constants.ENVIRONMENT.WORKING_DIRECTORY, os.getcwd())
+        environment_config.update_config(Constants.ENVIRONMENT.DAG_DIRECTORY, config_directory)
+        environment_config.update_directory(
+            Constants.ENVIRONMENT.TEMP_DIRECTORY,
+            os.path.join(config_directory, temp_directory)
+        )
+        return environment_config
+
+    @staticmethod
+    def _task_plans(dag_id:str, tasks:typing.List[dict], environment_config:EnvironmentConfiguration) -> typing.List[dict]:
+        if not isinstance(tasks, list) or not tasks:
+            raise ValueError("DAG {} has no tasks".format(dag_id))
+
+        return_value = []
+        task_ids = set()
+        for task in tasks:
+            task_id = task.get("task_id")
+            if not task_id or not task.get("callable"):
+                raise ValueError("Every task of DAG {} needs a task_id and a callable".format(dag_id))
+            if task_id in task_ids:
+                raise ValueError("Duplicate task_id {} in DAG {}".format(task_id, dag_id))
+            task_ids.add(task_id)
+
+            unknown = set(task) - set(DagFactory.TASK_SETTINGS)
+            if unknown:
+                raise ValueError("Unknown settings for task {} of DAG {}: {}".format(task_id, dag_id, sorted(unknown)))
+
+            fanout = task.get("fanout")
+            if fanout is not None and fanout is not False:
+                fanout = DagFactory._fanout_settings(dag_id, task)
+
+            optionals = dict(task.get("op_kwargs") or {})
+            if task.get("xcom_target"):
+                optionals[Constants.AIRFLOW_CTX.XCOM_TARGET] = task["xcom_target"]
+            if task.get("prefetch"):
+                optionals[Constants.AIRFLOW_CTX.PREFETCH] = True
+
+            return_value.append({
+                "task_id" : task_id,
+                "callable" : task["callable"],
+                "upstream" : list(task.get("upstream") or []),
+                "op_kwargs" : environment_config.get_config(optionals),
+                "trigger_rule" : task.get("trigger_rule"),
+                "fanout" : None if fanout is None or fanout is False else fanout
+            })
+
+        for task in return_value:
+            missing = [upstream for upstream in task["upstream"] if upstream not in task_ids]
+            if missing:
+                raise ValueError("Task {} of DAG {} has unknown upstream tasks {}".format(task["task_id"], dag_id, missing))
+        return return_value
+
+    @staticmethod
+    def _fanout_settings(dag_id:str, task:dict) -> dict:
+        """
+        RecordFanout settings of a fan-out task.
+
+        Throws:
+        ValueError if the task sets what RecordFanout does not take
+        """
+        fanout = task["fanout"]
+        if fanout is True:
+            fanout = {}
+        if not isinstance(fanout, dict):
+            raise ValueError("fanout of task {} of DAG {} must be true or a dictionary".format(task["task_id"], dag_id))
+
+        unknown = set(fanout) - set(DagFactory.FANOUT_SETTINGS)
+        if unknown:
+            raise ValueError("Unknown fanout settings for task {} of DAG {}: {}".format(task["task_id"], dag_id, sorted(unknown)))
+
+        unsupported = [name for name in ("xcom_target", "prefetch", "op_kwargs", "trigger_rule") if task.get(name)]
+        if unsupported:
+            raise ValueError("Fan-out task {} of DAG {} does not take {}".format(task["task_id"], dag_id, unsupported))
+        return fanout
+
+    @staticmethod
+    def _dag_arguments(settings:dict) -> dict:
+        """DAG() arguments from the JSON settings of a plan"""
+        return_value = dict(settings)
+        if "start_date" in return_value:
+            return_value["start_date"] = datetime.fromisoformat(return_value["start_date"])
+        if "dagrun_timeout" in return_value:
+            return_value["dagrun_timeout"] = timedelta(minutes=return_value["dagrun_timeout"])
+        return_value.setdefault("schedule_interval", None)
+        return_value.setdefault("catchup", False)
+        return return_value
+
+    @staticmethod
+    def _archive_of(config_path:str) -> typing.Optional[str]:
+        """The DAG zip a configuration is packaged in (see package_dag.py), None for a file"""
+        if os.path.exists(config_path):
+            return None
+        archive = os.path.dirname(config_path)
+        while archive and not os.path.exists(archive):
+            if os.path.dirname(archive) == archive:
+                break
+            archive = os.path.dirname(archive)
+        return archive if os.path.isfile(archive) else None
+
+    @staticmethod
+    def _cache_path(config_path:str, config_directory:str, config_hash:str) -> str:
+        directory = DagFactory.CACHE_DIRECTORY or os.path.join(config_directory, DagFactory.CACHE_DIRECTORY_NAME)
+        return os.path.join(directory, "{}.{}.json".format(os.path.basename(config_path), config_hash[:16]))
+
+    @staticmethod
+    def _read_cache(cache_path:str, config_hash:str) -> typing.Optional[dict]:
+        try:
+            with open(cache_path, "r") as cache_file:
+                plan = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if plan.get("version") != DagFactory.PLAN_VERSION or plan.get("hash") != config_hash:
+            return None
+        return plan
+
+    @staticmethod
+    def _write_cache(cache_path:str, plan:dict) -> None:
+        """
+        Written atomically, plans of earlier versions of the configuration are removed.
+        A read only DAG folder only loses the cache.
+        """
+        directory, name = os.path.split(cache_path)
+        prefix = name.rsplit(".", 2)[0] + "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            temp_path = "{}.{}".format(cache_path, os.getpid())
+            with open(temp_path, "w") as cache_file:
+                json.dump(plan, cache_file)
+            os.replace(temp_path, cache_path)
+
+            for other in os.listdir(directory):
+                if other != name and other.startswith(prefix) and other.endswith(".json"):
+                    os.remove(os.path.join(directory, other))
+        except OSError:
+            pass
@@ -0,0 +1,207 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import math
+import typing
+from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.env_config import EnvironmentConfiguration
+from dagcontext.context.dagcontext import DagContext
+from dagcontext.generic.activelog import ActivityLog
+
+
+class RecordFanout:
+    """
+    Spreads the records of a run over mapped task instances (Airflow 2.3+ dynamic task
+    mapping) instead of processing every record in a single task:
+
+        plan  >>  batch[0..N]  >>  reduce
+
+    plan: Splits the record ids (SYSTEM_FILE_ID) into batches sized for the run and
+          returns one small batch description per mapped instance, the ids themselves
+          are not passed through XCOM.
+    batch: The task callable, called as callable(batch, **context). After building the
+           DagContext it calls context.bind_batch(batch), the record ids are then only
+           the ids of the batch. The return value should come from
+           context.xcom_output(Constants.XCOM_DATA.BATCH_XCOM_PERSIST_NAME, ...),
+           persisted files carry the map index so batches do not overwrite each other.
+    reduce: Loads every batch output and merges them (see merge) into
+            Constants.XCOM_DATA.FANOUT_XCOM_PERSIST_NAME.
+    """
+    # Settings passed to the plan task
+    BATCH_SIZE = "fanout_batch_size"
+    MAX_BATCHES = "fanout_max_batches"
+
+    # Airflow refuses to map more than max_map_length (1024 by default) instances
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_MAX_BATCHES = 256
+
+    @staticmethod
+    def plan_batches(record_count:int, batch_size:int = DEFAULT_BATCH_SIZE, max_batches:int = DEFAULT_MAX_BATCHES) -> typing.List[dict]:
+        """
+        Split record_count records into batches of about batch_size records. When that
+        would need more than max_batches batches the batches grow instead, the records
+        are always spread evenly.
+
+        Parameters:
+        record_count: Number of records in the run
+        batch_size: Target number of records per batch
+        max_batches: Maximum number of batches (mapped task instances)
+
+        Returns:
+        List of {Constants.AIRFLOW_CTX.BATCH_INDEX, BATCH_START, BATCH_END}, empty
+        when there are no records
+
+        Throws:
+        ValueError if batch_size or max_batches is less than 1
+        """
+        if batch_size < 1 or max_batches < 1:
+            raise ValueError("batch_size and max_batches must be at least 1")
+
+        return_value = []
+        if record_count > 0:
+            batch_count = min(max_batches, math.ceil(record_count / batch_size))
+            size = math.ceil(record_count / batch_count)
+            for index, start in enumerate(range(0, record_count, size)):
+                return_value.append({
+                    Constants.AIRFLOW_CTX.BATCH_INDEX : index,
+                    Constants.AIRFLOW_CTX.BATCH_START : start,
+                    Constants.AIRFLOW_CTX.BATCH_END : min(start + size, record_count)
+                })
+        return return_value
+
+    @staticmethod
+    def plan(**context) -> typing.List[list]:
+        """
+        Task callable of the plan step.
+
+        Returns:
+        One op_args list, holding the batch description, per mapped batch instance
+        """
+        dag_context = DagContext.from_snapshot(context)
+        record_ids = dag_context.airflow_context.get_attribute(Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID)
+
+        batches = RecordFanout.plan_batches(
+            len(record_ids),
+            context.get(RecordFanout.BATCH_SIZE) or RecordFanout.DEFAULT_BATCH_SIZE,
+            context.get(RecordFanout.MAX_BATCHES) or RecordFanout.DEFAULT_MAX_BATCHES
+        )
+        ActivityLog.log_info("{} records planned in {} batches".format(len(record_ids), len(batches)))
+        return [[batch] for batch in batches]
+
+    @staticmethod
+    def reduce(**context) -> typing.Any:
+        """
+        Task callable of the reduce step, merges the outputs of every batch instance.
+
+        Returns:
+        The merged output, through DagContext.xcom_output
+        """
+        dag_context = DagContext.from_snapshot(context)
+
+        outputs = []
+        for output in dag_context.xcom_target.values():
+            # A mapped task pulls as a list, one output per map index
+            if isinstance(output, list):
+                outputs.extend(output)
+            elif output is not None:
+                outputs.append(output)
+
+        merged = RecordFanout.merge(outputs)
+        ActivityLog.log_info("Merged the output of {} batches".format(len(outputs)))
+        return dag_context.xcom_output(Constants.XCOM_DATA.FANOUT_XCOM_PERSIST_NAME, merged)
+
+    @staticmethod
+    def merge(outputs:typing.List[typing.Any]) -> typing.Any:
+        """
+        Merge batch outputs. Lists are concatenated and dictionaries merged key by key,
+        where values that are both dictionaries or both lists are merged in turn, so
+        RecordExecutor summaries combine into a single summary. Anything else is
+        collected into a list.
+        """
+        outputs = [output for output in outputs if output is not None]
+        if not outputs:
+            return None
+
+        if all(isinstance(output, dict) for output in outputs):
+            return_value = {}
+            for output in outputs:
+                for key, value in output.items():
+                    if key in return_value:
+                        return_value[key] = RecordFanout.merge([return_value[key], value])
+                    else:
+                        return_value[key] = value
+            return return_value
+
+        if all(isinstance(output, list) for output in outputs):
+            return [item for output in outputs for item in output]
+
+        if len(outputs) == 1:
+            return outputs[0]
+        return outputs
+
+    @staticmethod
+    def build(
+        environment_config:EnvironmentConfiguration,
+        batch_callable:typing.Callable,
+        task_prefix:str = "records",
+        batch_size:int = DEFAULT_BATCH_SIZE,
+        max_batches:int = DEFAULT_MAX_BATCHES) -> typing.Tuple[typing.Any, typing.Any, typing.Any]:
+        """
+        Add the plan, batch and reduce tasks to the DAG being defined (call inside the
+        "with DAG(...)" block) and chain them.
+
+        Parameters:
+        environment_config: Configuration of the DAG, passed to every task
+        batch_callable: Called as batch_callable(batch, **context) for each batch
+        task_prefix: Task ids are <prefix>_plan, <prefix>_batch and <prefix>_reduce
+        batch_size: Target number of records per batch
+        max_batches: Maximum number of mapped batch instances
+
+        Returns:
+        (plan, batch, reduce) operators, put upstream tasks before plan
+
+        Throws:
+        NotImplementedError if the Airflow version has no dynamic task mapping
+        """
+        # Only needed while the DAG file is parsed
+        try:
+            from airflow.operators.python import PythonOperator
+        except ImportError:
+            from airflow.operators.python_operator import PythonOperator
+
+        if not hasattr(PythonOperator, "partial"):
+            raise NotImplementedError("Dynamic task mapping requires Airflow 2.3 or later")
+
+        plan_id = "{}_plan".format(task_prefix)
+        batch_id = "{}_batch".format(task_prefix)
+
+        plan_task = PythonOperator(
+            task_id=plan_id,
+            python_callable=RecordFanout.plan,
+            op_kwargs=environment_config.get_config(
+                {
+                    RecordFanout.BATCH_SIZE: batch_size,
+                    RecordFanout.MAX_BATCHES: max_batches
+                }
+            ),
+        )
+
+        batch_task = PythonOperator.partial(
+            task_id=batch_id,
+            python_callable=batch_callable,
+            op_kwargs=environment_config.get_config(),
+        ).expand(op_args=plan_task.output)
+
+        reduce_task = PythonOperator(
+            task_id="{}_reduce".format(task_prefix),
+            python_callable=RecordFanout.reduce,
+            op_kwargs=environment_config.get_config(
+                {
+                    Constants.AIRFLOW_CTX.XCOM_TARGET: [batch_id]
+                }
+            ),
+        )
+
+        plan_task >> batch_task >> reduce_task  # pylint: disable=pointless-statement
+        return plan_task, batch_task, reduce_task
@@ -2,6 +2,7 @@
 #
 # Licensed under Microsoft Incubation License Agreement:
 
+import typing
 from abc import ABC, abstractmethod
 
 
@@ -15,3 +16,10 @@ class IVariableLoader(ABC):
         """
         Load a specific variable value from the system (typically Airflow)
         """
+
+    def load_many(self, variables:typing.List[str]) -> typing.Dict[str, typing.Any]:
+        """
+        Load several variables at once. Loaders that can read in bulk override
+        this, the default loads them one at a time.
+        """
+        return {variable : self.load(variable) for variable in variables}
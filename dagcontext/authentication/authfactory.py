@@ -6,15 +6,26 @@
 import typing
 from dagcontext.generic.activelog import ActivityLog
 from dagcontext.authentication.identityprovider import IIdentityProvider, IdentitySelector
-from dagcontext.authentication.systemauth import SystemIdentity
-from dagcontext.authentication.azureauth import (
-    AzureIdentity,
-    DefaultIdentity
-)
 
 class AuthFactory:
     @staticmethod
     def load_authentication(system_endpoint, system_header) -> typing.Dict[IdentitySelector, str]:
+        return AuthFactory.load_expiring_authentication(system_endpoint, system_header)[0]
+
+    @staticmethod
+    def load_expiring_authentication(system_endpoint, system_header) -> typing.Tuple[typing.Dict[IdentitySelector, str], typing.Optional[float]]:
+        """
+        Tokens of every provider and the time (seconds since the epoch) the first of
+        them expires, None when no provider reported an expiry.
+        """
+        # Providers pull in azure.identity and requests, only import them when tokens 
+        # are actually requested so DAG file parsing does not pay for them.
+        from dagcontext.authentication.systemauth import SystemIdentity
+        from dagcontext.authentication.azureauth import (
+            AzureIdentity,
+            DefaultIdentity
+        )
+
         auth_collection = {}
 
         providers:typing.List[IIdentityProvider] = [
@@ -26,7 +37,11 @@ class AuthFactory:
         for id_provider in providers:
             auth_collection[id_provider.provider] = AuthFactory.__get_token(id_provider) 
 
-        return auth_collection
+        expiries = [
+            id_provider.expires_on for id_provider in providers
+            if auth_collection[id_provider.provider] is not None and id_provider.expires_on is not None
+        ]
+        return auth_collection, min(expiries) if expiries else None
 
     @staticmethod
     def __get_token(provider:IIdentityProvider) -> str:
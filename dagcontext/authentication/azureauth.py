@@ -3,18 +3,19 @@
 # Licensed under Microsoft Incubation License Agreement:
 
 from dagcontext.authentication.identityprovider import IIdentityProvider, IdentitySelector
-from azure.identity import (
-    AzureCliCredential, 
-    DefaultAzureCredential
-)
+
+# azure.identity is imported in get_token, it is expensive to import and only
+# needed when a token is requested.
 
 class AzureIdentity(IIdentityProvider):
     def __init__(self):
         super().__init__(IdentitySelector.AzureCli)
 
     def get_token(self) -> str:
+        from azure.identity import AzureCliCredential
         cred = AzureCliCredential()
         token_obj = cred.get_token(IIdentityProvider.DEFAULT_TOKEN_ENDPOINT)
+        self.expires_on = token_obj.expires_on
         return token_obj.token
 
 class DefaultIdentity(IIdentityProvider):
@@ -22,6 +23,8 @@ class DefaultIdentity(IIdentityProvider):
         super().__init__(IdentitySelector.DefaultCredential)
 
     def get_token(self) -> str:
+        from azure.identity import DefaultAzureCredential
         cred = DefaultAzureCredential()
         token_obj = cred.get_token(IIdentityProvider.DEFAULT_TOKEN_ENDPOINT)
+        self.expires_on = token_obj.expires_on
         return token_obj.token
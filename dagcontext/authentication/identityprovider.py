@@ -15,6 +15,8 @@ class IIdentityProvider(ABC):
 
     def __init__(self, provider:IdentitySelector):
         self.provider:IdentitySelector = provider
+        # Seconds since the epoch the last token expires, when the provider reports it
+        self.expires_on:float = None
 
     @abstractmethod
     def get_token() -> str:
@@ -1,11 +1,15 @@
 
 import json
-import requests
+import time
 from dagcontext.configurations.constants import Constants
+from dagcontext.generic.ratelimit import RateLimiter
 from dagcontext.authentication.identityprovider import IIdentityProvider, IdentitySelector
 
 
 class SystemIdentity(IIdentityProvider):
+    # Attempts when the identity endpoint throttles the request
+    THROTTLE_ATTEMPTS = 3
+
     def __init__(self, endpoint, header):
         super().__init__(IdentitySelector.OakSystem)
         self.endpoint = endpoint
@@ -15,6 +19,8 @@ class SystemIdentity(IIdentityProvider):
             self.endpoint = Constants.OAK_IDENTITY.OAK_DEFAULT_IDENTITY_ENDPOINT
 
     def get_token(self) -> str:
+        # Imported here so importing the package does not load requests
+        import requests
 
         url = Constants.OAK_IDENTITY.OAK_SYSTEM_IDENTITY_ENDPOINT_URL.format(
             identity_endpoint = self.endpoint
@@ -27,11 +33,32 @@ class SystemIdentity(IIdentityProvider):
             headers['X-IDENTITY-HEADER'] = self.header
 
         return_token = None
-        response = requests.get(url=url, headers=headers)
+        # Every run on the node asks the same endpoint for tokens
+        limiter = RateLimiter.for_url(url)
+        for _ in range(SystemIdentity.THROTTLE_ATTEMPTS):
+            limiter.acquire()
+            response = requests.get(url=url, headers=headers)
+            if response.status_code != 429:
+                break
+            limiter.backoff(RateLimiter.retry_after(response.headers))
+
         if response.status_code != 200:
             raise Exception("Failed to get MSI token on endpoint {}".format(url))
         else:
             data_msi = json.loads(response.text)
             return_token = data_msi["access_token"]
+            self.expires_on = SystemIdentity._expires_on(data_msi)
+
+        return return_token
 
-        return return_token
\ No newline at end of file
+    @staticmethod
+    def _expires_on(data_msi:dict) -> float:
+        """Expiry of an MSI token response, expires_on or expires_in, None when neither is usable"""
+        try:
+            if data_msi.get("expires_on") is not None:
+                return float(data_msi["expires_on"])
+            if data_msi.get("expires_in") is not None:
+                return time.time() + float(data_msi["expires_in"])
+        except (TypeError, ValueError):
+            pass
+        return None
\ No newline at end of file
@@ -5,14 +5,17 @@
 import json
 import typing
 from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.execution_context import ExecutionContext
 from dagcontext.generic.activelog import ActivityLog
 
 class AirflowContextConfiguration:
     """
     Generic configuraton object that loads the "params" from the
-    task context sent to non virtualenv python tasks. The params become
-    first class properties on the class itself.
+    task context sent to non virtualenv python tasks. The params are held in
+    a typed ExecutionContext and exposed by name.
     """
+    __slots__ = ("execution_context",)
+
     def __init__(self, context: dict):
         """
         Recieves the context object passed to tasks by Airflow. Main goal is to
@@ -28,9 +31,11 @@ class AirflowContextConfiguration:
         Version 2.2.1
             Configuration exists in context[Constants.AIRFLOW_CTX.TASK_PARAMS]
         """
+        self.execution_context = ExecutionContext()
+
         # Load params, but in 1.10.12 it will not have the execution config
         if Constants.AIRFLOW_CTX.TASK_PARAMS in context:
-            ActivityLog.log_info("LOADING PARAMETERS: {}".format(Constants.AIRFLOW_CTX.TASK_PARAMS))
+            ActivityLog.log_debug("LOADING PARAMETERS: {}".format(Constants.AIRFLOW_CTX.TASK_PARAMS))
             # When triggered through the Airflow 2.x UI with a payload, this 
             # is enough to get what we are looking for. 
             self._load_setting(context[Constants.AIRFLOW_CTX.TASK_PARAMS])
@@ -38,37 +43,42 @@ class AirflowContextConfiguration:
         # Pick something that SHOULD be there, in 1.12 it won't be....
         if not self.has_attribute(Constants.AIRFLOW_EX_CTX.SYSTEM_PARTITION_ID):
             if Constants.AIRFLOW_CTX.TASK_DAGRUN in context:
-                ActivityLog.log_info("LOADING DAGRUN: {}".format(Constants.AIRFLOW_CTX.TASK_DAGRUN))
+                ActivityLog.log_debug("LOADING DAGRUN: {}".format(Constants.AIRFLOW_CTX.TASK_DAGRUN))
                 # When triggered through the Airflow 1.x UI with a payload, this is
                 # enough to get what we are looking for. 
-                run_configuration = context[Constants.AIRFLOW_CTX.TASK_DAGRUN].conf
+                run_configuration = context[Constants.AIRFLOW_CTX.TASK_DAGRUN].conf or {}
                 self._load_setting(run_configuration)
  
-                if Constants.AIRFLOW_CTX.TASK_DAGRUN_EXECUTION_CONTEXT in context[Constants.AIRFLOW_CTX.TASK_DAGRUN].conf:
-                    ActivityLog.log_info("LOADING EXECUTION CTX: {}".format(Constants.AIRFLOW_CTX.TASK_DAGRUN_EXECUTION_CONTEXT))
+                if Constants.AIRFLOW_CTX.TASK_DAGRUN_EXECUTION_CONTEXT in run_configuration:
+                    ActivityLog.log_debug("LOADING EXECUTION CTX: {}".format(Constants.AIRFLOW_CTX.TASK_DAGRUN_EXECUTION_CONTEXT))
                     # When triggered through the OAK API, we need to be more specific about where to load
                     # the information, so this works to get the payload. 
-                    self._load_setting(context[Constants.AIRFLOW_CTX.TASK_DAGRUN].conf[Constants.AIRFLOW_CTX.TASK_DAGRUN_EXECUTION_CONTEXT])
+                    self._load_setting(run_configuration[Constants.AIRFLOW_CTX.TASK_DAGRUN_EXECUTION_CONTEXT])
+
+    @staticmethod
+    def from_dict(settings: dict) -> "AirflowContextConfiguration":
+        """
+        Build the configuration from an already flattened dictionary (ExecutionContext.to_dict),
+        i.e. a DagContext snapshot, without looking at an Airflow context.
+        """
+        return_value = AirflowContextConfiguration.__new__(AirflowContextConfiguration)
+        return_value.execution_context = ExecutionContext()
+        return_value._load_setting(settings)
+        return return_value
 
     def _load_setting(self, settings: dict) -> None:
         """
-        Sets attributes on this instance of the class based on the content of the incoming
-        dict. Sub keys that are dicts have thier values raised up to first class attributes
-        of the class.
+        Loads the incoming dict into the execution context. Sub keys that are dicts
+        have thier values raised up to first class fields.
 
         Parameters:
-        settings: Dictionary of values to add as attributes to this class instance
+        settings: Dictionary of values to add
 
         Returns:
         None
         """
-        for param in settings:
-            current_value = settings[param]
-            if isinstance(current_value, dict):
-                for sub_param in current_value:
-                    setattr(self, sub_param, current_value[sub_param])
-            else:
-                setattr(self, param, current_value)
+        if settings:
+            self.execution_context.load(settings)
 
     def has_attribute(self, attribute_name: str) -> bool:
         """
@@ -83,7 +93,7 @@ class AirflowContextConfiguration:
         Throws:
         None
         """
-        return attribute_name in self.__dict__
+        return self.execution_context.has(attribute_name)
 
     def get_attribute(self, attribute_name: str) -> typing.Any:
         """
@@ -93,27 +103,25 @@ class AirflowContextConfiguration:
         attribute_name: Property name to find
 
         Returns:
-        The value of the property
+        The value of the property, record ids are a list
 
         Throws:
         KeyError property not present
         """
-        return self.__dict__[attribute_name]
+        return self.execution_context.get(attribute_name)
 
     def put_attribute(self, attribute_name: str, value) -> None:
         """
-        Get the value for the given attribute.
+        Set the value for the given attribute.
 
         Parameters:
-        attribute_name: Property name to find
+        attribute_name: Property name to set
+        value: Value to set
 
         Returns:
-        The value of the property
-
-        Throws:
-        KeyError property not present
+        None
         """
-        self.__dict__[attribute_name] = value
+        self.execution_context.put(attribute_name, value)
 
     def to_json(self, additional: dict = None) -> typing.Optional[str]:
         """
@@ -129,13 +137,9 @@ class AirflowContextConfiguration:
         Throws:
         None
         """
-        return_value = None
+        if not additional:
+            return self.execution_context.to_json()
 
-        output = self.__dict__.copy()
-        if additional:
-            output.update(additional)
-
-        if output and len(output):  # pylint: disable=len-as-condition
-            return_value = json.dumps(output)
-
-        return return_value
+        output = self.execution_context.to_dict()
+        output.update(additional)
+        return json.dumps(output, default=str)
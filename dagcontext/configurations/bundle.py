@@ -0,0 +1,138 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import hashlib
+import json
+import os
+import pkgutil
+import time
+import typing
+
+
+class ConfigurationBundle:
+    """
+    Configuration compiled at packaging time and shipped inside the DAG zip as
+    dagcontext/configurations/compiled_config.json.
+
+    The bundle holds the values that are known when the package is built (constants,
+    paths, non-secret environment values and Airflow variables) together with a hash
+    of the variable names it was compiled for. EnvironmentConfiguration(use_bundle=True)
+    reads it with pkgutil, which works from the zip, and only checks that the hash
+    matches and the bundle is not older than the allowed age. Names the bundle does
+    not have a value for, including every secret, are deferred to task run time.
+    """
+    BUNDLE_PACKAGE = "dagcontext.configurations"
+    BUNDLE_NAME = "compiled_config.json"
+    BUNDLE_VERSION = 1
+
+    # Process cache, the scheduler parses the same DAG file over and over
+    _loaded:typing.Optional[dict] = None
+
+    @staticmethod
+    def spec_hash(environment_variables:typing.List[str], airflow_variables:typing.List[str]) -> str:
+        """
+        Hash of the names a configuration asks for, a bundle is only valid for the
+        exact same set of names.
+        """
+        spec = {
+            "environment" : sorted(environment_variables or []),
+            "airflow" : sorted(airflow_variables or [])
+        }
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def compile(
+        environment_variables:typing.List[str],
+        airflow_variables:typing.List[str],
+        environment_values:dict = None,
+        airflow_values:dict = None,
+        static:dict = None,
+        secrets:typing.List[str] = None) -> dict:
+        """
+        Build a bundle.
+
+        Parameters:
+        environment_variables: os.environ names the DAG configuration asks for
+        airflow_variables: Airflow variable names the DAG configuration asks for
+        environment_values: Values of environment names for the target deployment
+        airflow_values: Values of Airflow variables for the target deployment
+        static: Any other settings (constants, paths)
+        secrets: Names that must never be written to the bundle
+
+        Returns:
+        The bundle dictionary
+        """
+        secrets = set(secrets or [])
+        settings = dict(static or {})
+
+        for values, names in ((environment_values, environment_variables), (airflow_values, airflow_variables)):
+            for name in names or []:
+                if values and name in values and name not in secrets:
+                    settings[name] = values[name]
+
+        return {
+            "version" : ConfigurationBundle.BUNDLE_VERSION,
+            "spec_hash" : ConfigurationBundle.spec_hash(environment_variables, airflow_variables),
+            "created" : time.time(),
+            "settings" : settings
+        }
+
+    @staticmethod
+    def load(spec_hash:str, max_age:float = None) -> typing.Optional[dict]:
+        """
+        Load the bundle shipped with the package.
+
+        Parameters:
+        spec_hash: spec_hash() of the configuration asking for the bundle
+        max_age: Maximum age of the bundle in seconds, None for no limit
+
+        Returns:
+        The bundle settings, None if there is no bundle or it is not fresh
+        """
+        bundle = ConfigurationBundle._loaded
+        if bundle is None:
+            try:
+                raw = pkgutil.get_data(ConfigurationBundle.BUNDLE_PACKAGE, ConfigurationBundle.BUNDLE_NAME)
+                bundle = json.loads(raw)
+            except (OSError, ValueError):
+                bundle = {}
+            ConfigurationBundle._loaded = bundle
+
+        fresh = (bundle.get("version") == ConfigurationBundle.BUNDLE_VERSION
+            and bundle.get("spec_hash") == spec_hash
+            and (max_age is None or time.time() - bundle.get("created", 0) <= max_age))
+
+        return bundle["settings"] if fresh else None
+
+    @staticmethod
+    def package(zip_path:str, bundle:dict, sources:typing.List[str], root:str = ".") -> None:
+        """
+        Create the DAG zip with the bundle included.
+
+        Parameters:
+        zip_path: Zip file to create
+        bundle: Output of compile()
+        sources: Files and directories, relative to root, to add
+        root: Directory the sources are relative to
+        """
+        # Packaging only, keep it out of the DAG parse path
+        import zipfile
+
+        bundle_entry = "/".join(ConfigurationBundle.BUNDLE_PACKAGE.split(".") + [ConfigurationBundle.BUNDLE_NAME])
+
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as package:
+            for source in sources:
+                source_path = os.path.join(root, source)
+                if os.path.isdir(source_path):
+                    for directory, dirs, files in os.walk(source_path):
+                        dirs[:] = [name for name in dirs if name != "__pycache__"]
+                        for name in files:
+                            file_path = os.path.join(directory, name)
+                            entry = os.path.relpath(file_path, root).replace(os.sep, "/")
+                            if entry != bundle_entry:
+                                package.write(file_path, entry)
+                else:
+                    package.write(source_path, source.replace(os.sep, "/"))
+
+            package.writestr(bundle_entry, json.dumps(bundle, separators=(",", ":")))
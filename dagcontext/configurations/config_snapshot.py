@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import os
+import typing
+from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.env_config import EnvironmentConfiguration
+from dagcontext.generic.warmregistry import WarmRegistry
+
+
+class ResolvedConfigSnapshot:
+    """
+    Per-run snapshot of deferred environment settings.
+
+    The first task of a run resolves the deferred settings (os.environ, Airflow
+    variables, directories) and persists the result to
+
+        TEMP_DIRECTORY/resolved_config/<run_id>.<settings key>.json
+
+    The settings key is a hash of the deferred settings, so a task whose op_kwargs
+    carry other settings resolves its own. Every later task of the same run with the
+    same settings reads the snapshot instead of resolving again, which also
+    guarantees that those tasks see the same values.
+    """
+    # Characters of a WarmRegistry.key
+    KEY_LENGTH = 32
+
+    @staticmethod
+    def load_or_resolve(run_id:typing.Optional[str], deferred:dict) -> dict:
+        """
+        Get the resolved settings for a run.
+
+        Parameters:
+        run_id: Run id of the DAG execution, when None nothing is persisted
+        deferred: The content of Constants.ENVIRONMENT.DEFERRED_SETTINGS
+
+        Returns:
+        Resolved environment settings
+        """
+        snapshot_path = ResolvedConfigSnapshot._snapshot_path(run_id, deferred)
+
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, "r") as snapshot:
+                    return json.load(snapshot)
+            except ValueError:
+                # Partially written by a crashed task, resolve again
+                pass
+
+        settings = EnvironmentConfiguration.resolve(deferred)
+
+        if snapshot_path:
+            ResolvedConfigSnapshot._save(snapshot_path, settings)
+
+        return settings
+
+    @staticmethod
+    def clear(run_id:str, temp_directory:str) -> bool:
+        """
+        Remove the snapshots of a run, returns True if one was removed.
+        """
+        return_value = False
+        directory = os.path.join(temp_directory, Constants.XCOM_PERSIST.RESOLVED_CONFIG_PERSIST_PATH)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            names = []
+
+        for name in names:
+            if ResolvedConfigSnapshot.run_id_from_name(name) == run_id:
+                try:
+                    os.remove(os.path.join(directory, name))
+                    return_value = True
+                except FileNotFoundError:
+                    pass
+        return return_value
+
+    @staticmethod
+    def file_name(run_id:str, settings:typing.Any) -> str:
+        """<run_id>.<settings key>.json, settings being the task settings the file was made from"""
+        return "{}.{}.json".format(run_id, WarmRegistry.key(settings))
+
+    @staticmethod
+    def run_id_from_name(name:str) -> typing.Optional[str]:
+        """Run id of a file named by file_name, None for any other file"""
+        base, extension = os.path.splitext(name)
+        run_id, _, key = base.rpartition(".")
+        if extension != ".json" or not run_id or len(key) != ResolvedConfigSnapshot.KEY_LENGTH:
+            return None
+        return run_id
+
+    @staticmethod
+    def _snapshot_path(run_id:typing.Optional[str], deferred:dict) -> typing.Optional[str]:
+        """The temp directory is a static value so it is known before resolving"""
+        static = deferred.get(EnvironmentConfiguration.DEFERRED_STATIC) or {}
+        temp_directory = static.get(Constants.ENVIRONMENT.TEMP_DIRECTORY)
+        if not run_id or not temp_directory:
+            return None
+
+        return os.path.join(
+            temp_directory,
+            Constants.XCOM_PERSIST.RESOLVED_CONFIG_PERSIST_PATH,
+            ResolvedConfigSnapshot.file_name(run_id, deferred)
+        )
+
+    @staticmethod
+    def _save(snapshot_path:str, settings:dict) -> None:
+        """
+        Write atomically, parallel first tasks may race and the last one wins with
+        identical content. Settings can hold identity headers so keep it private.
+        """
+        directory = os.path.dirname(snapshot_path)
+        os.makedirs(directory, exist_ok=True)
+
+        temp_path = "{}.{}".format(snapshot_path, os.getpid())
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w") as snapshot:
+            json.dump(settings, snapshot)
+        os.replace(temp_path, snapshot_path)
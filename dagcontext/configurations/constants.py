@@ -2,6 +2,8 @@
 
 class Environment:
     ENVIRONMENT_SETTINGS = "environment_settings"
+    # Names to resolve at task run time when EnvironmentConfiguration is deferred
+    DEFERRED_SETTINGS = "deferred_settings"
     WORKING_DIRECTORY = "working_directory"
     TEMP_DIRECTORY = "temp_directory"
     DAG_DIRECTORY = "dag_directory"
@@ -18,6 +20,13 @@ class AirflowContextConstants:
     TASK_PARAMS = "params"
     TASK_DAGRUN = "dag_run"
     TASK_DAGRUN_EXECUTION_CONTEXT = "execution_context"
+    # Start XCOM pulls and token acquisition concurrently, see DagContext
+    PREFETCH = "prefetch"
+    # Slice of the record ids given to a mapped batch task, see airflowutil/fanout
+    TASK_BATCH = "batch"
+    BATCH_INDEX = "index"
+    BATCH_START = "start"
+    BATCH_END = "end"
 
     # When triggered by the OAK API we seem to get an auth_token
     # in the payload from the call. We might be able to search for
@@ -52,6 +61,15 @@ class AirflowVariablesConstants:
 class XCOMPersistanceConstants:
     XCOM_PERSIST_PATH = "xcom_data"
     INFLIGHT_PERSIST_PATH = "inflight"
+    RESOLVED_CONFIG_PERSIST_PATH = "resolved_config"
+    CONTEXT_SNAPSHOT_PERSIST_PATH = "context_snapshot"
+    CHECKPOINT_PERSIST_PATH = "checkpoint"
+    RATE_LIMIT_PERSIST_PATH = "rate_limit"
+    MICROBATCH_PERSIST_PATH = "microbatch"
+    RUN_MARKER_PERSIST_PATH = "runs"
+
+    # Data larger than this is persisted to disk instead of passed in XCOM itself
+    XCOM_INLINE_LIMIT = 48 * 1024
 
     """Tasks have a persistance here so it can be found, when using XCOM 
     persistance each one has to have a unique name"""
@@ -66,6 +84,14 @@ class XcomDataConstants:
 
     TASK_DATA_EXAMPLE = "example_data"
 
+    # Output of each mapped batch task and the merged output of the reduce step
+    BATCH_XCOM_PERSIST_NAME = "batch_results.json"
+    FANOUT_XCOM_PERSIST_NAME = "fanout_results.json"
+    # Output of a task processing every record of the run in one go
+    RECORDS_XCOM_PERSIST_NAME = "record_results.json"
+    # Streamed merge of many task outputs, see DagContext.xcom_persist_reduce
+    MERGED_XCOM_PERSIST_NAME = "merged_results.jsonl"
+
 class OakIdentityConstants:
     """
     For pulling identity information. 
@@ -84,6 +110,25 @@ class OakIdentityConstants:
     OAK_DEFAULT_IDENTITY_ENDPOINT = "http://169.254.169.254/metadata/identity/oauth2/token"
     OAK_SYSTEM_IDENTITY_ENDPOINT_URL = "{identity_endpoint}?api-version=2018-02-01&resource=https%3A%2F%2Fmanagement.azure.com%2F"
 
+class OakApiConstants:
+    """
+    OSDU/OAK service endpoints used by dagcontext.oakclient, relative to https://<OAK_HOST>
+    """
+    STORAGE_RECORD = "/api/storage/v2/records/{record_id}"
+    STORAGE_RECORDS = "/api/storage/v2/records"
+    STORAGE_QUERY_RECORDS = "/api/storage/v2/query/records"
+    FILE_METADATA = "/api/file/v2/files/{file_id}/metadata"
+    FILE_DOWNLOAD_URL = "/api/file/v2/files/{file_id}/downloadURL"
+    SEARCH_QUERY = "/api/search/v2/query"
+    SEARCH_QUERY_CURSOR = "/api/search/v2/query_with_cursor"
+
+    # Most records the multi-record calls accept in one request
+    STORAGE_QUERY_BATCH = 100
+    STORAGE_PUT_BATCH = 500
+    SEARCH_PAGE_SIZE = 1000
+
+    PARTITION_HEADER = "data-partition-id"
+
 class LogConstants:
     """constants for logging"""
     ACTIVITY_LOG_DIRECTORY = "activity_log"
@@ -102,5 +147,7 @@ class Constants:
     XCOM_DATA = XcomDataConstants
     # OAK Identity
     OAK_IDENTITY = OakIdentityConstants
+    # OAK service endpoints
+    OAK_API = OakApiConstants
     # Logging
     LOG = LogConstants
@@ -2,9 +2,11 @@
 #
 # Licensed under Microsoft Incubation License Agreement:
 
+import importlib
 import os
 import typing
 from dagcontext.airflowutil.ivarloader import IVariableLoader
+from dagcontext.configurations.bundle import ConfigurationBundle
 from dagcontext.configurations.constants import Constants
 
 
@@ -12,12 +14,26 @@ class EnvironmentConfiguration:
     """
     Wrapper class for the sideloaded configuration which contains all of the deployment details
     that will be needed to process. This must be in a JSON file sitting next to the main dag file.
+
+    In deferred mode nothing is read while the DAG file is parsed. Only the names of the
+    environment and Airflow variables (plus any static values and directories) are passed
+    to the tasks, the DagContext resolves them once per run when the first task executes.
     """
 
-    def __init__(self, 
-        environment_variables:typing.List[str] = None, 
-        variable_loader: IVariableLoader = None, 
-        airflow_variables: typing.List[str] = None):
+    # Keys of the deferred settings passed to the tasks
+    DEFERRED_ENVIRONMENT = "environment_variables"
+    DEFERRED_AIRFLOW = "airflow_variables"
+    DEFERRED_LOADER = "variable_loader"
+    DEFERRED_STATIC = "static"
+    DEFERRED_DIRECTORIES = "directories"
+
+    def __init__(self,
+        environment_variables:typing.List[str] = None,
+        variable_loader: IVariableLoader = None,
+        airflow_variables: typing.List[str] = None,
+        deferred: bool = False,
+        use_bundle: bool = False,
+        bundle_max_age: float = None):
         """
         Sideload configuration is either from a sideloaded JSON file or
         the Airflow variables.
@@ -31,6 +47,11 @@ class EnvironmentConfiguration:
         config_file: The actual sideload config file, does not have to exist
         airflow_variable_loader: Class instance with single static call .load(variable:str)
         airflow_variables: Variables to read from Airflow
+        deferred: Keep only the names and resolve them at task run time. The variable
+                  loader must then be constructible without arguments.
+        use_bundle: Take values from the configuration bundle compiled into the package
+                  if it is fresh, every name it does not cover is deferred.
+        bundle_max_age: Seconds after which the bundle is considered stale, None for no limit
 
         Returns:
         None
@@ -41,19 +62,34 @@ class EnvironmentConfiguration:
         self.variable_loader = variable_loader
         self.airflow_variables = airflow_variables
         self.environment_variables = environment_variables
+        self.deferred = deferred
+        self.directories:typing.List[str] = []
         self.config_object = {}
-
-        if self.environment_variables is not None and len(self.environment_variables):  # pylint: disable=len-as-condition
-            for env_var in self.environment_variables:
-                if env_var in os.environ:
-                    self.config_object[env_var] = os.environ[env_var]
-                else:
-                    self.config_object[env_var] = None
-
-        if self.airflow_variables is not None and len(self.airflow_variables):  # pylint: disable=len-as-condition
-            if self.variable_loader:
-                for airf_var in self.airflow_variables:
-                    self.config_object[airf_var] = self.variable_loader.load(airf_var)
+        # Class path of the loader when rebuilt without one, see from_deferred
+        self.loader_path:typing.Optional[str] = None
+
+        bundled = None
+        if use_bundle:
+            bundled = ConfigurationBundle.load(
+                ConfigurationBundle.spec_hash(self.environment_variables, self.airflow_variables),
+                bundle_max_age
+            )
+
+        if bundled is not None:
+            # Nothing to read at parse time, what the bundle does not have waits for the task
+            self.config_object.update(bundled)
+            self.environment_variables = [name for name in self.environment_variables or [] if name not in bundled]
+            self.airflow_variables = [name for name in self.airflow_variables or [] if name not in bundled]
+            self.deferred = True
+
+        elif not self.deferred:
+            self.config_object.update(
+                EnvironmentConfiguration._read_environment(self.environment_variables)
+            )
+
+            if self.airflow_variables is not None and len(self.airflow_variables):  # pylint: disable=len-as-condition
+                if self.variable_loader:
+                    self.config_object.update(self.variable_loader.load_many(self.airflow_variables))
 
     def update_config(self, field_name: str, field_value: typing.Any):
         """
@@ -75,6 +111,27 @@ class EnvironmentConfiguration:
         if self.config_object is not None:
             self.config_object[field_name] = field_value
 
+    def update_directory(self, field_name: str, path: str):
+        """
+        Set a configuration value that is a directory the tasks need. The directory
+        is created now, or when the settings are resolved in deferred mode.
+
+        Parameters:
+        field_name: Name of new or existing property
+        path: Directory path
+
+        Returns:
+        None
+
+        Throws:
+        ValueError if field name is None
+        """
+        self.update_config(field_name, path)
+        if self.deferred:
+            self.directories.append(path)
+        elif not os.path.exists(path):
+            os.makedirs(path)
+
     def get_config(self, optionals: dict = None) -> dict:
         """
         Transform this internal data to a dictionary to pass along to
@@ -87,13 +144,104 @@ class EnvironmentConfiguration:
         A dictionary to pass to downstream tasks in form
         {Constants.SIDELOAD.SIDELOAD_SETTINGS : dict:properties}
 
+        In deferred mode the settings are None and the names to resolve are in
+        {Constants.ENVIRONMENT.DEFERRED_SETTINGS : dict}
+
         Throws:
         None
         """
         return_data = {Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS: None}
-        if self.config_object is not None:
+        if self.deferred:
+            return_data[Constants.ENVIRONMENT.DEFERRED_SETTINGS] = self.get_deferred()
+        elif self.config_object is not None:
             return_data[Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS] = self.config_object.copy()
-            if optionals and isinstance(optionals, dict):
-                return_data.update(optionals)
 
+        if optionals and isinstance(optionals, dict):
+            return_data.update(optionals)
+
+        return return_data
+
+    def get_deferred(self) -> dict:
+        """
+        The names and static values that resolve() turns into the settings at run time.
+        """
+        loader = self.loader_path
+        if self.variable_loader:
+            loader_class = type(self.variable_loader)
+            loader = "{}.{}".format(loader_class.__module__, loader_class.__qualname__)
+
+        return {
+            EnvironmentConfiguration.DEFERRED_ENVIRONMENT : list(self.environment_variables or []),
+            EnvironmentConfiguration.DEFERRED_AIRFLOW : list(self.airflow_variables or []),
+            EnvironmentConfiguration.DEFERRED_LOADER : loader,
+            EnvironmentConfiguration.DEFERRED_STATIC : self.config_object.copy(),
+            EnvironmentConfiguration.DEFERRED_DIRECTORIES : list(self.directories)
+        }
+
+    @staticmethod
+    def from_deferred(deferred: dict) -> "EnvironmentConfiguration":
+        """
+        Rebuild a deferred configuration from get_deferred() output without reading
+        anything, i.e. from a cached DAG definition.
+
+        Parameters:
+        deferred: The content of Constants.ENVIRONMENT.DEFERRED_SETTINGS
+
+        Returns:
+        EnvironmentConfiguration in deferred mode
+        """
+        return_value = EnvironmentConfiguration(
+            environment_variables = list(deferred.get(EnvironmentConfiguration.DEFERRED_ENVIRONMENT) or []),
+            airflow_variables = list(deferred.get(EnvironmentConfiguration.DEFERRED_AIRFLOW) or []),
+            deferred = True
+        )
+        return_value.loader_path = deferred.get(EnvironmentConfiguration.DEFERRED_LOADER)
+        return_value.config_object.update(deferred.get(EnvironmentConfiguration.DEFERRED_STATIC) or {})
+        return_value.directories.extend(deferred.get(EnvironmentConfiguration.DEFERRED_DIRECTORIES) or [])
+        return return_value
+
+    @staticmethod
+    def resolve(deferred: dict) -> dict:
+        """
+        Resolve deferred settings (see get_deferred) into the same dictionary a
+        non-deferred configuration would have produced at parse time.
+
+        Parameters:
+        deferred: The content of Constants.ENVIRONMENT.DEFERRED_SETTINGS
+
+        Returns:
+        Resolved settings
+
+        Throws:
+        ImportError if the variable loader class cannot be found
+        """
+        settings = dict(deferred.get(EnvironmentConfiguration.DEFERRED_STATIC) or {})
+        settings.update(
+            EnvironmentConfiguration._read_environment(
+                deferred.get(EnvironmentConfiguration.DEFERRED_ENVIRONMENT)
+            )
+        )
+
+        airflow_variables = deferred.get(EnvironmentConfiguration.DEFERRED_AIRFLOW)
+        loader_path = deferred.get(EnvironmentConfiguration.DEFERRED_LOADER)
+        if airflow_variables and loader_path:
+            module_name, class_name = loader_path.rsplit(".", 1)
+            loader_class = getattr(importlib.import_module(module_name), class_name)
+            settings.update(loader_class().load_many(airflow_variables))
+
+        for directory in deferred.get(EnvironmentConfiguration.DEFERRED_DIRECTORIES) or []:
+            os.makedirs(directory, exist_ok=True)
+
+        return settings
+
+    @staticmethod
+    def _read_environment(environment_variables:typing.List[str]) -> dict:
+        """Read the requested os.environ values, missing ones are None"""
+        return_data = {}
+        if environment_variables is not None and len(environment_variables):  # pylint: disable=len-as-condition
+            for env_var in environment_variables:
+                if env_var in os.environ:
+                    return_data[env_var] = os.environ[env_var]
+                else:
+                    return_data[env_var] = None
         return return_data
@@ -0,0 +1,127 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import types
+import typing
+from dagcontext.configurations.constants import Constants
+from dagcontext.generic.activelog import ActivityLog
+
+
+class ExecutionContext:
+    """
+    Typed model of the execution configuration passed to the DAG:
+
+        {
+            "runId": "unique_run_id",
+            "executionContext": {
+                "id": "record_id or list of record_ids",
+                "dataPartitionId": "some_data_partition",
+                "kind": "osdu:wks:dataset--File.Generic:1.0.0"
+            }
+        }
+
+    The known fields are slots, anything else is kept in extra (read only, change it
+    with put). Known fields that are not strings, i.e. integer ids from a trigger
+    payload, are converted with str() and a warning is logged. The record ids are
+    stored as a tuple and handed out as a list, the JSON form is cached until put
+    changes a field.
+    """
+    __slots__ = ("runId", "dataPartitionId", "kind", "id", "_extra", "_serialized")
+
+    FIELDS = (
+        Constants.AIRFLOW_EX_CTX.SYSTEM_RUN_ID,
+        Constants.AIRFLOW_EX_CTX.SYSTEM_PARTITION_ID,
+        Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_KIND,
+        Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID
+    )
+
+    def __init__(self):
+        self.runId:typing.Optional[str] = None
+        self.dataPartitionId:typing.Optional[str] = None
+        self.kind:typing.Optional[str] = None
+        self.id:typing.Tuple[str, ...] = ()
+        self._extra:typing.Dict[str, typing.Any] = {}
+        self._serialized:typing.Optional[str] = None
+
+    @property
+    def extra(self) -> typing.Mapping[str, typing.Any]:
+        """Fields that are not known fields, read only so the cached JSON stays valid"""
+        return types.MappingProxyType(self._extra)
+
+    def load(self, settings:dict) -> None:
+        """
+        Add a payload. Values that are dicts have their keys raised up one level, the
+        same flattening AirflowContextConfiguration always did.
+        """
+        for param, current_value in settings.items():
+            if isinstance(current_value, dict):
+                for sub_param, sub_value in current_value.items():
+                    self.put(sub_param, sub_value)
+            else:
+                self.put(param, current_value)
+
+    def has(self, name:str) -> bool:
+        """True if the field has a value"""
+        if name in ExecutionContext.FIELDS:
+            return name == Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID or getattr(self, name) is not None
+        return name in self._extra
+
+    def get(self, name:str) -> typing.Any:
+        """
+        Value of a field, the record ids are a new list
+
+        Throws:
+        KeyError if the field has no value
+        """
+        if not self.has(name):
+            raise KeyError(name)
+        if name == Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID:
+            return list(self.id)
+        if name in ExecutionContext.FIELDS:
+            return getattr(self, name)
+        return self._extra[name]
+
+    def put(self, name:str, value:typing.Any) -> None:
+        """
+        Set a field, known fields that are not strings are converted with str()
+        """
+        if name == Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID:
+            self.id = ExecutionContext._to_ids(value)
+        elif name in ExecutionContext.FIELDS:
+            setattr(self, name, ExecutionContext._to_str(name, value))
+        else:
+            self._extra[name] = value
+        self._serialized = None
+
+    def to_dict(self) -> dict:
+        """Flat dictionary of every field with a value"""
+        return_value = {name : getattr(self, name) for name in ExecutionContext.FIELDS if self.has(name)}
+        return_value[Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID] = list(self.id)
+        return_value.update(self._extra)
+        return return_value
+
+    def to_json(self) -> str:
+        """JSON form of to_dict, cached until a field changes"""
+        if self._serialized is None:
+            self._serialized = json.dumps(self.to_dict(), default=str)
+        return self._serialized
+
+    @staticmethod
+    def _to_ids(value:typing.Any) -> typing.Tuple[str, ...]:
+        """A single id, a list of ids or nothing become a tuple of ids"""
+        if value is None:
+            return ()
+        if isinstance(value, (list, tuple)):
+            return tuple(ExecutionContext._to_str(Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID, item) for item in value)
+        return (ExecutionContext._to_str(Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID, value),)
+
+    @staticmethod
+    def _to_str(name:str, value:typing.Any) -> typing.Optional[str]:
+        """Known fields are strings, anything else from the payload is converted"""
+        if value is None or isinstance(value, str):
+            return value
+        ActivityLog.log_warning("Execution context field {} is a {}, using it as a string".format(
+            name, type(value).__name__))
+        return str(value)
@@ -0,0 +1,129 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import typing
+from dagcontext.configurations.constants import Constants
+
+
+class XcomChannel:
+    """
+    Declaration of a named XCOM channel, the unit of data passed between tasks.
+
+    name: File name used when the channel is persisted (see DagContext.xcom_persist_save)
+    codec: How data is written, CODEC_JSON (dict/list dumped, anything else as is), CODEC_JSONL
+           (one JSON record per line, can be streamed) or CODEC_TEXT
+    size_budget: Expected maximum size in bytes of the encoded data, None for no expectation
+    retention: Seconds a persisted copy may be kept before it is considered cruft, the
+               TempCollector removes older copies of runs that are no longer active
+    """
+    CODEC_JSON = "json"
+    CODEC_TEXT = "text"
+    CODEC_JSONL = "jsonl"
+
+    def __init__(self, name:str, codec:str = CODEC_JSON, size_budget:int = None, retention:float = None):
+        self.name = name
+        self.codec = codec
+        self.size_budget = size_budget
+        self.retention = retention
+
+    def encode(self, data:typing.Any) -> str:
+        """Turn data into the text that is persisted or passed through XCOM"""
+        if self.codec == XcomChannel.CODEC_JSON and isinstance(data, (list, dict)):
+            return json.dumps(data, indent=4)
+        if self.codec == XcomChannel.CODEC_JSONL and isinstance(data, (list, tuple)):
+            return "".join(self.encode_record(record) for record in data)
+        return data if isinstance(data, str) else str(data)
+
+    @staticmethod
+    def encode_record(record:typing.Any) -> str:
+        """A single JSONL line"""
+        return json.dumps(record, separators=(",", ":"), default=str) + "\n"
+
+    @staticmethod
+    def encoded_size(encoded:str) -> int:
+        """Size in bytes of encoded data once written, UTF-8"""
+        return len(encoded.encode("utf-8"))
+
+    def over_budget(self, encoded:str) -> bool:
+        """True if the encoded data is larger in bytes than the declared budget"""
+        return self.size_budget is not None and XcomChannel.encoded_size(encoded) > self.size_budget
+
+    def __repr__(self):
+        return "XcomChannel({}, {}, budget={}, retention={})".format(
+            self.name, self.codec, self.size_budget, self.retention)
+
+
+class XcomChannelRegistry:
+    """
+    Every valid XCOM channel, built once at import from explicit declarations.
+    Validating a channel name is a dictionary lookup instead of a scan of the
+    constants class.
+    """
+    def __init__(self, declarations:typing.List[XcomChannel] = None):
+        self._channels:typing.Dict[str, XcomChannel] = {}
+        for declaration in declarations or []:
+            self.register(declaration)
+
+    def register(self, channel:XcomChannel) -> XcomChannel:
+        """Add or replace a channel declaration"""
+        self._channels[channel.name] = channel
+        return channel
+
+    def get(self, name:str) -> typing.Optional[XcomChannel]:
+        """The channel declared with name, None if there is none"""
+        return self._channels.get(name)
+
+    def is_valid(self, name:str) -> bool:
+        return name in self._channels
+
+    def channels(self) -> typing.List[XcomChannel]:
+        return list(self._channels.values())
+
+    def retention_of(self, file_name:str) -> typing.Optional[float]:
+        """
+        Retention of the channel a persisted file belongs to. Files are named
+        [<run_id>_][<map_index>_]<channel name>, see DagContext.xcom_persist_save.
+
+        Returns:
+        Seconds, None when the file is not a channel or the channel declares none
+        """
+        for channel in self._channels.values():
+            if file_name == channel.name or file_name.endswith("_" + channel.name):
+                return channel.retention
+        return None
+
+
+# Channels used by the DAG tasks, only names declared here can be persisted. Declare
+# new channels here with their codec, budget and retention.
+XCOM_CHANNELS = XcomChannelRegistry(
+    [
+        XcomChannel(
+            Constants.XCOM_DATA.FIRST_TAKS_XCOM_PERSIST_NAME,
+            XcomChannel.CODEC_JSON,
+            size_budget=1024 * 1024,
+            retention=24 * 60 * 60
+        ),
+        XcomChannel(
+            Constants.XCOM_DATA.BATCH_XCOM_PERSIST_NAME,
+            XcomChannel.CODEC_JSON,
+            retention=24 * 60 * 60
+        ),
+        XcomChannel(
+            Constants.XCOM_DATA.FANOUT_XCOM_PERSIST_NAME,
+            XcomChannel.CODEC_JSON,
+            retention=24 * 60 * 60
+        ),
+        XcomChannel(
+            Constants.XCOM_DATA.RECORDS_XCOM_PERSIST_NAME,
+            XcomChannel.CODEC_JSON,
+            retention=24 * 60 * 60
+        ),
+        XcomChannel(
+            Constants.XCOM_DATA.MERGED_XCOM_PERSIST_NAME,
+            XcomChannel.CODEC_JSONL,
+            retention=24 * 60 * 60
+        )
+    ]
+)
@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import os
+import threading
+import typing
+
+
+class CheckpointJournal:
+    """
+    Append only journal of the records a task has completed, so a retry of the task
+    resumes where the failed attempt stopped instead of starting over.
+
+    Persisted to TEMP_DIRECTORY/checkpoint/<run_id>_<task_id>[_<map_index>].jsonl, one
+    line per completed record:
+
+        {"id": record_id, "result": value returned for the record}
+
+    Each line is a single write to a file opened with O_APPEND, a crash can at most
+    leave a partial last line which is ignored when the journal is loaded.
+    """
+    EXTENSION = ".jsonl"
+
+    KEY_ID = "id"
+    KEY_RESULT = "result"
+
+    def __init__(self, checkpoint_path:str, run_id:str, task_id:str, map_index:int = -1):
+        """
+        Constructor
+
+        Parameters:
+        checkpoint_path: Folder holding the journals
+        run_id: Run id of this instantiation of the DAG
+        task_id: Task the journal belongs to
+        map_index: Map index of a mapped task, -1 otherwise
+        """
+        name = "{}_{}".format(run_id, task_id)
+        if map_index >= 0:
+            name = "{}_{}".format(name, map_index)
+
+        self.journal_path = os.path.join(checkpoint_path, name + CheckpointJournal.EXTENSION)
+        self._lock = threading.Lock()
+        self._descriptor:typing.Optional[int] = None
+        self._completed:typing.Optional[typing.Dict[str, typing.Any]] = None
+
+        os.makedirs(checkpoint_path, exist_ok=True)
+
+    def completed(self) -> typing.Dict[str, typing.Any]:
+        """
+        Records completed by this or an earlier attempt of the task.
+
+        Returns:
+        {record_id : result}
+        """
+        with self._lock:
+            if self._completed is None:
+                self._completed = CheckpointJournal._read(self.journal_path)
+            return dict(self._completed)
+
+    def is_completed(self, record_id:str) -> bool:
+        return record_id in self.completed()
+
+    def record(self, record_id:str, result:typing.Any = None) -> None:
+        """
+        Journal a completed record and its result, the result must be JSON serializable
+        (anything else is journaled as its string form).
+        """
+        line = json.dumps(
+            {CheckpointJournal.KEY_ID : record_id, CheckpointJournal.KEY_RESULT : result},
+            separators=(",", ":"),
+            default=str
+        ) + "\n"
+
+        with self._lock:
+            if self._descriptor is None:
+                self._descriptor = CheckpointJournal._open(self.journal_path)
+            os.write(self._descriptor, line.encode("utf-8"))
+            if self._completed is not None:
+                self._completed[record_id] = result
+
+    def close(self) -> None:
+        with self._lock:
+            if self._descriptor is not None:
+                os.close(self._descriptor)
+                self._descriptor = None
+
+    def clear(self) -> bool:
+        """Remove the journal, call when the task has completed. Returns True if one was removed"""
+        self.close()
+        with self._lock:
+            self._completed = None
+        try:
+            os.remove(self.journal_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def clear_run(checkpoint_path:str, run_id:str) -> int:
+        """Remove the journals of every task of a run, returns the number removed"""
+        return_value = 0
+        if os.path.exists(checkpoint_path):
+            prefix = "{}_".format(run_id)
+            for name in os.listdir(checkpoint_path):
+                if name.startswith(prefix) and name.endswith(CheckpointJournal.EXTENSION):
+                    try:
+                        os.remove(os.path.join(checkpoint_path, name))
+                        return_value += 1
+                    except FileNotFoundError:
+                        pass
+        return return_value
+
+    @staticmethod
+    def _open(journal_path:str) -> int:
+        """
+        Open the journal for appending. A partial last line left by an earlier attempt
+        is terminated so it does not swallow the next record.
+        """
+        descriptor = os.open(journal_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(descriptor).st_size
+        if size and os.pread(descriptor, 1, size - 1) != b"\n":
+            os.write(descriptor, b"\n")
+        return descriptor
+
+    @staticmethod
+    def _read(journal_path:str) -> typing.Dict[str, typing.Any]:
+        return_value = {}
+        try:
+            with open(journal_path, "r") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial line of an attempt that died mid write
+                        continue
+                    return_value[entry[CheckpointJournal.KEY_ID]] = entry.get(CheckpointJournal.KEY_RESULT)
+        except FileNotFoundError:
+            pass
+        return return_value
@@ -0,0 +1,153 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import os
+import typing
+from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.config_snapshot import ResolvedConfigSnapshot
+from dagcontext.configurations.env_config import EnvironmentConfiguration
+from dagcontext.generic.warmregistry import WarmRegistry
+
+
+class ContextSnapshot:
+    """
+    Compact, versioned copy of the parts of a DagContext that are the same for every
+    task of a run: the execution context and the resolved environment settings.
+
+    Persisted to TEMP_DIRECTORY/context_snapshot/<run_id>.<settings key>.json by the
+    first task so that DagContext.from_snapshot in later tasks loads it with a single
+    read. The settings key is a hash of the settings in the task op_kwargs, a task
+    passed other settings than the first task builds and saves its own snapshot.
+    """
+    VERSION = 1
+
+    KEY_VERSION = "version"
+    KEY_RUN_ID = "run_id"
+    KEY_EXECUTION_CONTEXT = "execution_context"
+    KEY_ENVIRONMENT = "environment_settings"
+
+    @staticmethod
+    def save(temp_directory:str, run_id:str, settings_key:str, execution_context:dict, environment_settings:dict) -> str:
+        """
+        Persist the snapshot atomically, settings can hold identity headers so the
+        file is private to the user.
+
+        Returns:
+        Path of the snapshot
+        """
+        snapshot_path = ContextSnapshot.snapshot_path(temp_directory, run_id, settings_key)
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+
+        content = {
+            ContextSnapshot.KEY_VERSION : ContextSnapshot.VERSION,
+            ContextSnapshot.KEY_RUN_ID : run_id,
+            ContextSnapshot.KEY_EXECUTION_CONTEXT : execution_context,
+            ContextSnapshot.KEY_ENVIRONMENT : environment_settings
+        }
+
+        temp_path = "{}.{}".format(snapshot_path, os.getpid())
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w") as snapshot:
+            json.dump(content, snapshot, separators=(",", ":"), default=str)
+        os.replace(temp_path, snapshot_path)
+
+        return snapshot_path
+
+    @staticmethod
+    def load(temp_directory:str, run_id:str, settings_key:str) -> typing.Optional[dict]:
+        """
+        Load the snapshot of a run.
+
+        Returns:
+        The snapshot, None if it does not exist, is damaged or has another version
+        """
+        return_value = None
+        try:
+            with open(ContextSnapshot.snapshot_path(temp_directory, run_id, settings_key), "r") as snapshot:
+                content = json.load(snapshot)
+            if content.get(ContextSnapshot.KEY_VERSION) == ContextSnapshot.VERSION:
+                return_value = content
+        except (OSError, ValueError):
+            pass
+        return return_value
+
+    @staticmethod
+    def clear(temp_directory:str, run_id:str) -> bool:
+        """Remove the snapshots of a run, returns True if one was removed"""
+        return_value = False
+        directory = os.path.join(temp_directory, Constants.XCOM_PERSIST.CONTEXT_SNAPSHOT_PERSIST_PATH)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            names = []
+
+        for name in names:
+            if ResolvedConfigSnapshot.run_id_from_name(name) == run_id:
+                try:
+                    os.remove(os.path.join(directory, name))
+                    return_value = True
+                except FileNotFoundError:
+                    pass
+        return return_value
+
+    @staticmethod
+    def snapshot_path(temp_directory:str, run_id:str, settings_key:str) -> str:
+        return os.path.join(
+            temp_directory,
+            Constants.XCOM_PERSIST.CONTEXT_SNAPSHOT_PERSIST_PATH,
+            "{}.{}.json".format(run_id, settings_key)
+        )
+
+    @staticmethod
+    def settings_key(context:dict) -> str:
+        """
+        Hash of the settings the task was passed in its op_kwargs, resolved or deferred,
+        the part of a snapshot that can differ between the tasks of a run.
+        """
+        settings = []
+        for name in (Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS, Constants.ENVIRONMENT.DEFERRED_SETTINGS):
+            value = context.get(name)
+            if isinstance(value, str):
+                value = json.loads(value)
+            settings.append(value)
+        return WarmRegistry.key(*settings)
+
+    @staticmethod
+    def peek_run_id(context:dict) -> typing.Optional[str]:
+        """
+        Find the run id in an Airflow context without building the full execution
+        context, looks in the same places AirflowContextConfiguration does.
+        """
+        sources = []
+        if Constants.AIRFLOW_CTX.TASK_PARAMS in context:
+            sources.append(context[Constants.AIRFLOW_CTX.TASK_PARAMS] or {})
+        if Constants.AIRFLOW_CTX.TASK_DAGRUN in context:
+            run_configuration = getattr(context[Constants.AIRFLOW_CTX.TASK_DAGRUN], "conf", None) or {}
+            sources.append(run_configuration)
+            sources.append(run_configuration.get(Constants.AIRFLOW_CTX.TASK_DAGRUN_EXECUTION_CONTEXT) or {})
+
+        for source in sources:
+            for key in (Constants.AIRFLOW_EX_CTX.SYSTEM_RUN_ID, Constants.AIRFLOW_EX_CTX.OPTIONAL_SYSTEM_RUN_ID):
+                if source.get(key):
+                    return source[key]
+        return None
+
+    @staticmethod
+    def peek_temp_directory(context:dict) -> typing.Optional[str]:
+        """
+        The temp directory from the task settings, either resolved or deferred, it is a
+        static value so it is known without resolving anything.
+        """
+        settings = context.get(Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS)
+        if isinstance(settings, str):
+            settings = json.loads(settings)
+
+        if not settings:
+            deferred = context.get(Constants.ENVIRONMENT.DEFERRED_SETTINGS)
+            if isinstance(deferred, str):
+                deferred = json.loads(deferred)
+            settings = (deferred or {}).get(EnvironmentConfiguration.DEFERRED_STATIC)
+
+        return (settings or {}).get(Constants.ENVIRONMENT.TEMP_DIRECTORY)
@@ -2,18 +2,28 @@
 #
 # Licensed under Microsoft Incubation License Agreement:
 
+import functools
 import json
 import os
+import threading
+import time
 import typing
-import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
-from pprint import pprint
 from dagcontext.authentication.identityprovider import IdentitySelector
-from dagcontext.authentication.authfactory import AuthFactory
 from dagcontext.configurations.airflowctx_config import AirflowContextConfiguration
+from dagcontext.configurations.config_snapshot import ResolvedConfigSnapshot
 from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.xcom_channels import XCOM_CHANNELS, XcomChannel
+from dagcontext.context.checkpoint import CheckpointJournal
+from dagcontext.context.contextsnapshot import ContextSnapshot
 from dagcontext.context.inflight import InflightTracker
+from dagcontext.context.recordexecutor import RecordExecutor
+from dagcontext.context.xcommerge import XcomMerge
 from dagcontext.generic.activelog import ActivityLog
+from dagcontext.generic.ratelimit import RateLimiter
+from dagcontext.generic.tempcollector import TempCollector
+from dagcontext.generic.warmregistry import WarmRegistry
 
 class PropertyClass(Enum):
     Environment = "Environment"
@@ -29,7 +39,29 @@ class DagContext:
     - Parsed out execution configuration
     - Parsed out deployment information (content of exampleconf.json) if present
     - The xcom result to be used (identified in the context with the Constants.AIRFLOW_CTX.XCOM_TARGET key)
+
+    With Constants.AIRFLOW_CTX.PREFETCH set in the task op_kwargs, the XCOM pulls, token
+    acquisition and temp directory collection are started together on a small thread
+    pool while the rest of the context is built. xcom_target and get_authentication_token
+    wait for them when first used, so task startup takes as long as the slowest of them
+    rather than all of them. Tokens are then acquired even if the task never uses them.
+
+    The blocking calls have async counterparts (token, xcom_load_async, xcom_save_async,
+    xcom_output_async, claim_async, release_async) for tasks running an event loop.
+    They share the state of the synchronous calls and run file and network I/O on the
+    event loop's default thread pool.
+
+    Tokens, the resolved settings of a run and the directories it uses are kept in the
+    WarmRegistry, so later tasks run by the same worker process do not build them again.
     """
+    # Tokens are loaded once, from whichever thread asks first
+    _token_lock = threading.Lock()
+
+    # Threads shared by the contexts of a process that prefetch, see _bind_task
+    PREFETCH_WORKERS = 4
+    _prefetch_pool:typing.Optional[ThreadPoolExecutor] = None
+    _prefetch_pid:typing.Optional[int] = None
+    _prefetch_lock = threading.Lock()
 
     def __init__(self, context):
         """
@@ -61,11 +93,187 @@ class DagContext:
         self.environment_settings = None
         # Any XCOM data passed along
         self.xcom_target = {}
+        # XCOM pulls still running when prefetching
+        self._xcom_futures:typing.Dict[str, Future] = {}
         # Instances covered by 
         self.inflight_tracker:InflightTracker = None
+        # Map index of a mapped (fanned out) task, -1 otherwise
+        self.map_index:int = -1
+        # Batch of records bound to this task, see bind_batch
+        self.batch:typing.Optional[dict] = None
 
         # Authentication object
         self.authentication_tokens:typing.Dict[IdentitySelector, str] = None
+        # Seconds since the epoch the first of the tokens expires, None when unknown
+        self._tokens_expire_on:typing.Optional[float] = None
+
+        # Collect the RUN ID of this task run as it's required for setting up duplciate processing
+        # prevention using the InflightTracker object.
+        self.run_id = self.get_value(PropertyClass.AirflowContext, Constants.AIRFLOW_EX_CTX.SYSTEM_RUN_ID, False)
+        if not self.run_id:
+            self.run_id = self.get_value(PropertyClass.AirflowContext, Constants.AIRFLOW_EX_CTX.OPTIONAL_SYSTEM_RUN_ID, False)
+
+        # Get the environment settings (os.environ and airflow vars) that may be part of this 
+        # context object. 
+        if Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS in context:
+            self.environment_settings = context[Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS]
+            if isinstance(self.environment_settings, str):
+                self.environment_settings = json.loads(self.environment_settings)
+
+        # Deferred configuration, resolved once per run and shared by the tasks of the run
+        if self.environment_settings is None and Constants.ENVIRONMENT.DEFERRED_SETTINGS in context:
+            deferred = context[Constants.ENVIRONMENT.DEFERRED_SETTINGS]
+            if isinstance(deferred, str):
+                deferred = json.loads(deferred)
+            if self.run_id:
+                self.environment_settings = WarmRegistry.get(
+                    WarmRegistry.KIND_SETTINGS,
+                    WarmRegistry.key(self.run_id, deferred),
+                    functools.partial(ResolvedConfigSnapshot.load_or_resolve, self.run_id, deferred)
+                )
+            else:
+                self.environment_settings = ResolvedConfigSnapshot.load_or_resolve(self.run_id, deferred)
+
+        # Record ids (SYSTEM_FILE_ID) are always a list, empty when testing outside of OAK.
+        self._bind_task(context)
+
+    @staticmethod
+    def from_snapshot(context) -> "DagContext":
+        """
+        Build the context from the run snapshot persisted by an earlier task of the same
+        run, only the per-task parts (task instance, XCOM targets, inflight tracker and 
+        logging) are bound from the Airflow context. 
+
+        When there is no snapshot yet (first task of the run) the context is built
+        normally and the snapshot is saved for the tasks that follow.
+
+        Parameters:
+        context: Conetxt passed by Airflow to the task, see the constructor.
+
+        Returns:
+        DagContext
+        """
+        run_id = ContextSnapshot.peek_run_id(context)
+        temp_directory = ContextSnapshot.peek_temp_directory(context)
+
+        snapshot = None
+        if run_id and temp_directory:
+            snapshot = ContextSnapshot.load(temp_directory, run_id, ContextSnapshot.settings_key(context))
+
+        if snapshot is None:
+            return_value = DagContext(context)
+            return_value.save_snapshot()
+            return return_value
+
+        return_value = DagContext.__new__(DagContext)
+        return_value.context = context
+        return_value.airflow_context = AirflowContextConfiguration.from_dict(
+            snapshot[ContextSnapshot.KEY_EXECUTION_CONTEXT]
+        )
+        return_value.environment_settings = snapshot[ContextSnapshot.KEY_ENVIRONMENT]
+        return_value.xcom_target = {}
+        return_value._xcom_futures = {}
+        return_value.inflight_tracker = None
+        return_value.map_index = -1
+        return_value.batch = None
+        return_value.authentication_tokens = None
+        return_value._tokens_expire_on = None
+        return_value.run_id = snapshot[ContextSnapshot.KEY_RUN_ID]
+        return_value._bind_task(context)
+        return return_value
+
+    @property
+    def xcom_target(self) -> dict:
+        """XCOM data passed to this task by target task id, waits on prefetched pulls"""
+        if self._xcom_futures:
+            for target, future in list(self._xcom_futures.items()):
+                self._xcom_target[target] = future.result()
+                self._xcom_futures.pop(target, None)
+        return self._xcom_target
+
+    @xcom_target.setter
+    def xcom_target(self, value:dict) -> None:
+        self._xcom_target = value
+
+    @staticmethod
+    def _get_prefetch_pool() -> ThreadPoolExecutor:
+        """Pool shared by the contexts of this process, a forked child gets its own"""
+        with DagContext._prefetch_lock:
+            if DagContext._prefetch_pool is None or DagContext._prefetch_pid != os.getpid():
+                DagContext._prefetch_pool = ThreadPoolExecutor(
+                    max_workers=DagContext.PREFETCH_WORKERS,
+                    thread_name_prefix="dagcontext-prefetch"
+                )
+                DagContext._prefetch_pid = os.getpid()
+            return DagContext._prefetch_pool
+
+    def save_snapshot(self) -> typing.Optional[str]:
+        """
+        Persist the run level parts of this context for DagContext.from_snapshot.
+
+        Returns:
+        Path of the snapshot, None when there is no run id or temp directory
+        """
+        if self.batch is not None:
+            # Record ids are restricted to the batch, not the run
+            return None
+        return_value = None
+        temp_directory = self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY, False)
+        if self.run_id and temp_directory:
+            return_value = ContextSnapshot.save(
+                temp_directory,
+                self.run_id,
+                ContextSnapshot.settings_key(self.context),
+                self.airflow_context.execution_context.to_dict(),
+                self.environment_settings
+            )
+        return return_value
+
+    def snapshot_clear(self) -> bool:
+        """
+        Remove the run snapshots. Call from the last task of the run, like xcom_persist_clear.
+        """
+        return_value = False
+        temp_directory = self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY, False)
+        if self.run_id and temp_directory:
+            return_value = ContextSnapshot.clear(temp_directory, self.run_id)
+        return return_value
+
+    def _bind_task(self, context) -> None:
+        """
+        Everything that is specific to the task being run rather than the run itself:
+        XCOM data passed to this task, inflight tracking and the activity log.
+        """
+        if Constants.AIRFLOW_CTX.TASK_INSTANCE in context:
+            map_index = getattr(context[Constants.AIRFLOW_CTX.TASK_INSTANCE], "map_index", -1)
+            self.map_index = map_index if isinstance(map_index, int) else -1
+
+        if context.get(Constants.AIRFLOW_CTX.TASK_BATCH):
+            self.bind_batch(context[Constants.AIRFLOW_CTX.TASK_BATCH])
+
+        temp_directory = self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY, False)
+
+        # Process wide settings first, prefetched work already logs and calls services.
+        # Share the API rate limits with every run on this node.
+        if temp_directory:
+            RateLimiter.RATE_LIMIT_DIRECTORY = os.path.join(temp_directory, Constants.XCOM_PERSIST.RATE_LIMIT_PERSIST_PATH)
+
+        if self.run_id:
+            # Set up activity log
+            ActivityLog.ACTIVITY_LOG_DIRECTORY = os.path.join(
+                self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY),
+                Constants.LOG.ACTIVITY_LOG_DIRECTORY
+            )
+            ActivityLog.ACTIVITY_LOG_BASETASK_ID = self.run_id
+            if Constants.AIRFLOW_CTX.TASK_INSTANCE in context:
+                ActivityLog.ACTIVITY_LOG_TASK_ID = getattr(context[Constants.AIRFLOW_CTX.TASK_INSTANCE], "task_id", None)
+
+            # Structured logs carry the partition so they can be queried across runs
+            partition = self.get_value(PropertyClass.AirflowContext, Constants.AIRFLOW_EX_CTX.SYSTEM_PARTITION_ID, False)
+            if partition:
+                ActivityLog.ACTIVITY_LOG_FIELDS = {Constants.AIRFLOW_EX_CTX.SYSTEM_PARTITION_ID : partition}
+
+        pool = DagContext._get_prefetch_pool() if context.get(Constants.AIRFLOW_CTX.PREFETCH) else None
 
         # Verify that the context has a task instance AND that there is a defined xcom_target
         # in teh payload. 
@@ -75,20 +283,14 @@ class DagContext:
                 targets = [targets]
 
             for target in targets:
-                self.xcom_target[target] = self.xcom_persist_load(target)
-
-        # Get the environment settings (os.environ and airflow vars) that may be part of this 
-        # context object. 
-        if Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS in context:
-            self.environment_settings = context[Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS]
-            if isinstance(self.environment_settings, str):
-                self.environment_settings = json.loads(self.environment_settings)
+                if pool:
+                    self._xcom_futures[target] = pool.submit(self.xcom_persist_load, target)
+                else:
+                    self.xcom_target[target] = self.xcom_persist_load(target)
 
-        # Collect the RUN ID of this task run as it's required for setting up duplciate processing
-        # prevention using the InflightTracker object.
-        self.run_id = self.get_value(PropertyClass.AirflowContext, Constants.AIRFLOW_EX_CTX.SYSTEM_RUN_ID, False)
-        if not self.run_id:
-            self.run_id = self.get_value(PropertyClass.AirflowContext, Constants.AIRFLOW_EX_CTX.OPTIONAL_SYSTEM_RUN_ID, False)
+        if pool:
+            # Loads every token, get_authentication_token waits on the token lock meanwhile
+            pool.submit(self._prefetch_tokens)
 
         # When testing locally and not in Airflow this might be a problem, but set up the inflight
         # tracker so we can keep track of what this specific instance is processing.
@@ -98,20 +300,66 @@ class DagContext:
                 self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY),
                 Constants.XCOM_PERSIST.INFLIGHT_PERSIST_PATH
             )
-            self.inflight_tracker = InflightTracker(self.run_id, self.inflight_path)
-
-            # Set up activity log
-            ActivityLog.ACTIVITY_LOG_DIRECTORY = os.path.join(
+            # Tasks of the run (and instances of a mapped task) each own the records they claim
+            task_key = None
+            task_id = getattr(context.get(Constants.AIRFLOW_CTX.TASK_INSTANCE), "task_id", None)
+            if task_id:
+                task_key = "{}.{}".format(task_id, self.map_index)
+            self.inflight_tracker = InflightTracker(self.run_id, self.inflight_path, task_key)
+
+            # Keeps the files of this run from being collected until the run completes
+            try:
+                TempCollector.mark_run(temp_directory, self.run_id)
+            except OSError as ex:
+                ActivityLog.log_warning("Unable to mark the run active", str(ex))
+
+            # Remove what earlier runs left behind, at most every few minutes and briefly
+            if pool:
+                pool.submit(self._collect_temp)
+            else:
+                self._collect_temp()
+
+    def _prefetch_tokens(self) -> None:
+        # Nothing waits on the prefetch, a failure would otherwise go unseen until the
+        # task asks for a token itself
+        try:
+            self.get_authentication_token(IdentitySelector.OakSystem)
+        except Exception as ex:  # pylint: disable=broad-except
+            ActivityLog.log_warning("Authentication token prefetch failed", str(ex))
+
+    def _collect_temp(self) -> None:
+        try:
+            TempCollector.collect_if_due(
                 self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY),
-                Constants.LOG.ACTIVITY_LOG_DIRECTORY
+                self.run_id
             )
-            ActivityLog.ACTIVITY_LOG_BASETASK_ID = self.run_id
+        except Exception as ex:  # pylint: disable=broad-except
+            ActivityLog.log_warning("Temp directory collection failed", str(ex))
+
+    def bind_batch(self, batch:dict) -> None:
+        """
+        Restrict this task to a batch of the run records (see airflowutil/fanout). The
+        record ids (SYSTEM_FILE_ID) become the slice of the run ids the batch covers, so
+        everything reading them, such as the RecordExecutor, only sees the batch.
 
+        Parameters:
+        batch: {Constants.AIRFLOW_CTX.BATCH_INDEX, BATCH_START, BATCH_END}
 
-        # Again, for testing, don't throw if not there (won't be) but will be in OAK execution.
-        id_value = self.get_value(PropertyClass.AirflowContext, Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID, False)
-        if not isinstance(id_value, list):
-            self.airflow_context.put_attribute(Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID, [id_value])
+        Returns:
+        None
+
+        Throws:
+        KeyError if the batch is missing a field
+        """
+        record_ids = self.airflow_context.get_attribute(Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID)
+        self.airflow_context.put_attribute(
+            Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID,
+            record_ids[batch[Constants.AIRFLOW_CTX.BATCH_START]:batch[Constants.AIRFLOW_CTX.BATCH_END]]
+        )
+        self.batch = batch
+        ActivityLog.log_debug("Bound to batch {} with {} records".format(
+            batch[Constants.AIRFLOW_CTX.BATCH_INDEX],
+            batch[Constants.AIRFLOW_CTX.BATCH_END] - batch[Constants.AIRFLOW_CTX.BATCH_START]))
 
     def get_authentication_token(self, selector:IdentitySelector) -> str:
         """
@@ -124,17 +372,100 @@ class DagContext:
         Returns a dict of values where keys are IdentitySelector(Enum) values and values are
         the actual token acquired, if any
         """
-        if self.authentication_tokens is None:
-            self.authentication_tokens = AuthFactory.load_authentication(
-                    self.get_value(PropertyClass.Environment, Constants.OAK_IDENTITY.IDENTITY_ENDPOINT), 
-                    self.get_value(PropertyClass.Environment, Constants.OAK_IDENTITY.IDENTITY_HEADER)
-                )
+        if self._loaded_tokens() is None:
+            with DagContext._token_lock:
+                if self._loaded_tokens() is None:
+                    # Deferred import, the identity providers are only loaded when a token is needed
+                    from dagcontext.authentication.authfactory import AuthFactory
+                    endpoint = self.get_value(PropertyClass.Environment, Constants.OAK_IDENTITY.IDENTITY_ENDPOINT)
+                    header = self.get_value(PropertyClass.Environment, Constants.OAK_IDENTITY.IDENTITY_HEADER)
+                    # Kept until shortly before the first token expires. When every
+                    # provider failed nothing is kept, the next task tries again.
+                    self.authentication_tokens, self._tokens_expire_on = WarmRegistry.get(
+                        WarmRegistry.KIND_TOKENS,
+                        WarmRegistry.key(endpoint, header),
+                        functools.partial(AuthFactory.load_expiring_authentication, endpoint, header),
+                        expires_on=lambda tokens: tokens[1],
+                        keep=DagContext._has_token
+                    )
 
         return_token = None
         if selector in self.authentication_tokens:
             return_token = self.authentication_tokens[selector]
         return return_token
 
+    @staticmethod
+    def _has_token(tokens:typing.Tuple[typing.Dict[IdentitySelector, str], typing.Optional[float]]) -> bool:
+        """True when a load acquired a token or reported an expiry"""
+        return tokens[1] is not None or any(token is not None for token in tokens[0].values())
+
+    def _loaded_tokens(self) -> typing.Optional[typing.Dict[IdentitySelector, str]]:
+        """Tokens already loaded, None when not loaded or about to expire"""
+        expire_on = self._tokens_expire_on
+        if expire_on is not None and time.time() >= expire_on - WarmRegistry.EXPIRY_MARGIN:
+            return None
+        return self.authentication_tokens
+
+    def reset_authentication_tokens(self) -> None:
+        """
+        Forget the tokens, also for the other tasks of the process, the next
+        get_authentication_token loads them again. Call when a service rejected a token.
+        """
+        with DagContext._token_lock:
+            if self.environment_settings is not None:
+                WarmRegistry.invalidate(
+                    WarmRegistry.KIND_TOKENS,
+                    WarmRegistry.key(
+                        self.get_value(PropertyClass.Environment, Constants.OAK_IDENTITY.IDENTITY_ENDPOINT, False),
+                        self.get_value(PropertyClass.Environment, Constants.OAK_IDENTITY.IDENTITY_HEADER, False)
+                    )
+                )
+            self.authentication_tokens = None
+            self._tokens_expire_on = None
+
+    async def token(self, selector:IdentitySelector) -> str:
+        """
+        Async get_authentication_token, tokens already loaded are returned without
+        leaving the event loop.
+        """
+        tokens = self._loaded_tokens()
+        if tokens is not None:
+            return tokens.get(selector)
+        return await self._run_io(self.get_authentication_token, selector)
+
+    async def xcom_load_async(self, task_id:str) -> typing.Any:
+        """Async xcom_persist_load, the pull and file read run on the thread pool"""
+        return await self._run_io(self.xcom_persist_load, task_id)
+
+    async def xcom_save_async(self, persisted_task:str, data:typing.Any) -> str:
+        """Async xcom_persist_save, the file write runs on the thread pool"""
+        return await self._run_io(self.xcom_persist_save, persisted_task, data)
+
+    async def xcom_output_async(self, persisted_task:str, data:typing.Any) -> typing.Any:
+        """Async xcom_output, the file write (if any) runs on the thread pool"""
+        return await self._run_io(self.xcom_output, persisted_task, data)
+
+    async def claim_async(self, file_id:str) -> bool:
+        """
+        Async InflightTracker.claim. Without a tracker (no run id) every record is owned.
+        """
+        if self.inflight_tracker is None:
+            return True
+        return await self._run_io(self.inflight_tracker.claim, file_id)
+
+    async def release_async(self, file_id:str) -> bool:
+        """Async InflightTracker.release"""
+        if self.inflight_tracker is None:
+            return False
+        return await self._run_io(self.inflight_tracker.release, file_id)
+
+    @staticmethod
+    async def _run_io(function:typing.Callable, *args) -> typing.Any:
+        """Run a blocking call on the default executor of the running event loop"""
+        # Only tasks using the async calls pay for the import
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
     def get_value(self, propClass:PropertyClass, field_name:str, except_on_misssing:bool = True) -> typing.Any:
         """
         Put a setting by name into one of the configuration objects contained in this 
@@ -275,38 +606,111 @@ class DagContext:
         being persisted has the run_id of this instance appended to it to avoid conflicts. 
 
         Parameters
-        persisted_task: must be a member of the constants class XCOMPersistanceConstants
-        data: Content to dump to a file. If a dict or list, it's JSON dumped, otherwise it goes as is
+        persisted_task: must be a registered XCOM channel (see configurations/xcom_channels)
+        data: Content to dump to a file, encoded by the channel codec. With the default JSON
+              codec a dict or list is JSON dumped, otherwise it goes as is
 
         Returns:
         The full path of the file generated.
 
         Throws:
-        ValueError: If persisted_task is not a member of  XCOMPersistanceConstants
+        ValueError: If persisted_task is not a registered XCOM channel
         """
-        return_path = None
+        channel = XCOM_CHANNELS.get(persisted_task)
+        if channel is None:
+            raise ValueError("Requested task not in XCOM PERSIST values: {}".format(persisted_task))
 
-        if DagContext._is_valid_persistance(Constants.XCOM_DATA, persisted_task):
-            # Do something
-            file_name = persisted_task
-            if self.run_id:
-                file_name = "{}_{}".format(self.run_id, persisted_task)
+        return self._persist_encoded(channel, channel.encode(data))
 
-            xcom_directory = self._create_xcom_path(Constants.XCOM_PERSIST.XCOM_PERSIST_PATH)
-            persist_path = os.path.join(xcom_directory, file_name)
-            
-            output_data = data
-            if isinstance(output_data, list) or isinstance(output_data,dict):
-                output_data = json.dumps(output_data, indent=4)
+    def xcom_output(self, persisted_task:str, data:typing.Any) -> typing.Any:
+        """
+        Return value for a task that passes data on through XCOM. Small data is
+        returned as is. Data larger than Constants.XCOM_PERSIST.XCOM_INLINE_LIMIT is
+        persisted with xcom_persist_save and the path is returned instead, 
+        xcom_persist_load in the downstream task handles either.
 
-            with open(persist_path, "w") as persisted_data:
-                persisted_data.writelines(output_data)
+        Parameters
+        persisted_task: must be a registered XCOM channel
+        data: Content to pass on
 
-            return_path = persist_path
-        else:
+        Returns:
+        data or the path of the persisted data
+
+        Throws:
+        ValueError: If persisted_task is not a registered XCOM channel
+        """
+        channel = XCOM_CHANNELS.get(persisted_task)
+        if channel is None:
             raise ValueError("Requested task not in XCOM PERSIST values: {}".format(persisted_task))
 
-        return return_path
+        encoded = channel.encode(data)
+        # A character is at least a byte, only text short enough is measured in bytes
+        if (len(encoded) <= Constants.XCOM_PERSIST.XCOM_INLINE_LIMIT
+            and XcomChannel.encoded_size(encoded) <= Constants.XCOM_PERSIST.XCOM_INLINE_LIMIT):
+            return encoded
+
+        return self._persist_encoded(channel, encoded)
+
+    def _persist_encoded(self, channel:XcomChannel, encoded:str) -> str:
+        """
+        Write encoded channel data to the XCOM directory, warning when it is larger
+        than the channel declared.
+        """
+        if channel.over_budget(encoded):
+            ActivityLog.log_warning("XCOM channel {} is {} bytes, budget is {}".format(
+                channel.name, XcomChannel.encoded_size(encoded), channel.size_budget))
+
+        persist_path = self._persist_path(channel)
+        with open(persist_path, "w") as persisted_data:
+            persisted_data.write(encoded)
+
+        return persist_path
+
+    def _persist_path(self, channel:XcomChannel) -> str:
+        """
+        Path the channel is persisted to by this task, unique to the run and map index.
+        """
+        file_name = channel.name
+        if self.map_index >= 0:
+            # Every mapped instance of a task writes the same channel
+            file_name = "{}_{}".format(self.map_index, file_name)
+        if self.run_id:
+            file_name = "{}_{}".format(self.run_id, file_name)
+
+        xcom_directory = self._create_xcom_path(Constants.XCOM_PERSIST.XCOM_PERSIST_PATH)
+        return os.path.join(xcom_directory, file_name)
+
+    def xcom_persist_reduce(self,
+        task_ids:typing.List[str],
+        persisted_task:str = Constants.XCOM_DATA.MERGED_XCOM_PERSIST_NAME,
+        key:typing.Union[str, typing.Callable[[typing.Any], typing.Any]] = None,
+        reverse:bool = False) -> str:
+        """
+        Combine the outputs of many upstream tasks into one persisted channel with
+        bounded memory (see XcomMerge). Unlike listing the tasks in 
+        Constants.AIRFLOW_CTX.XCOM_TARGET nothing is loaded into xcom_target, records
+        are streamed from the upstream outputs to the new file.
+
+        Parameters:
+        task_ids: Upstream task ids, a mapped task contributes every map index
+        persisted_task: Registered channel to write, written as JSONL
+        key: None to concatenate in task order, a field name or function of a record to
+             k-way merge on. Every upstream output must then be sorted on the key.
+        reverse: Upstream outputs are sorted in descending key order
+
+        Returns:
+        The full path of the file generated, pass it on as the task return value
+
+        Throws:
+        ValueError: If persisted_task is not a registered XCOM channel
+        """
+        channel = XCOM_CHANNELS.get(persisted_task)
+        if channel is None:
+            raise ValueError("Requested task not in XCOM PERSIST values: {}".format(persisted_task))
+
+        persist_path = self._persist_path(channel)
+        XcomMerge(self).merge(task_ids, channel, persist_path, key, reverse)
+        return persist_path
 
     def xcom_persist_load(self, task_id:str) -> typing.Any:
         """
@@ -318,30 +722,60 @@ class DagContext:
         task_id: The actual Airflow task name to find a value for 
 
         Returns:
-        Value contained or value in a file
+        Value contained or value in a file, for a mapped task (see airflowutil/fanout)
+        a list with the value of each map index
         """
         return_data = None
         
         if Constants.AIRFLOW_CTX.TASK_INSTANCE in self.context:        
             raw_data = self.context[Constants.AIRFLOW_CTX.TASK_INSTANCE].xcom_pull(task_ids=task_id)
-            try:
-                # Is it a file path?
-                if os.path.exists(raw_data):
-                    file_content = None
-                    with open(raw_data, "r") as xcom_data:
-                        file_content = xcom_data.readlines()
-                        file_content = "\n".join(file_content)
-                        # Just in case it fails.....
-                        raw_data = file_content
-
-                    if file_content:
-                        return_data = json.loads(file_content)
+            if self._is_mapped(task_id):
+                # One value per map index, each of them decoded
+                return_data = [DagContext._decode_xcom(value) for value in raw_data or []]
+            else:
+                return_data = DagContext._decode_xcom(raw_data)
 
-                else:
-                    return_data = json.loads(raw_data)
-            except Exception as ex:  # pylint: disable=broad-except, unused-variable
-                # Not a JSON object and not a file
-                return_data = raw_data
+        return return_data
+
+    def _is_mapped(self, task_id:str) -> bool:
+        """True when task_id is a mapped task of the DAG this task belongs to"""
+        task = getattr(self.context[Constants.AIRFLOW_CTX.TASK_INSTANCE], "task", None)
+        dag = getattr(task, "dag", None)
+        if dag is None or not dag.has_task(task_id):
+            return False
+
+        try:
+            from airflow.models.mappedoperator import MappedOperator
+        except ImportError:
+            # Airflow before 2.3 has no mapped tasks
+            return False
+        return isinstance(dag.get_task(task_id), MappedOperator)
+
+    @staticmethod
+    def _decode_xcom(raw_data:typing.Any) -> typing.Any:
+        """Decode a pulled XCOM value, the content of the file it names or its JSON"""
+        return_data = None
+        try:
+            # Is it a file path?
+            if isinstance(raw_data, str) and raw_data.endswith(XcomMerge.JSONL_EXTENSION) and os.path.exists(raw_data):
+                return_data = list(XcomMerge.records(raw_data))
+
+            elif os.path.exists(raw_data):
+                file_content = None
+                with open(raw_data, "r") as xcom_data:
+                    file_content = xcom_data.readlines()
+                    file_content = "\n".join(file_content)
+                    # Just in case it fails.....
+                    raw_data = file_content
+
+                if file_content:
+                    return_data = json.loads(file_content)
+
+            else:
+                return_data = json.loads(raw_data)
+        except Exception as ex:  # pylint: disable=broad-except, unused-variable
+            # Not a JSON object and not a file
+            return_data = raw_data
 
         return return_data
 
@@ -356,6 +790,7 @@ class DagContext:
 
         if os.path.exists(xcom_directory):
             if clear_all:
+                import shutil
                 shutil.rmtree(xcom_directory)
             elif self.run_id:
                 owned_files = []
@@ -373,11 +808,97 @@ class DagContext:
 
         return return_count
 
+    def resolved_config_clear(self) -> bool:
+        """
+        Remove the per-run snapshot of deferred environment settings. Call from the
+        last task of the run, like xcom_persist_clear.
+        """
+        return_value = False
+        temp_directory = self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY, False)
+        if self.run_id and temp_directory:
+            return_value = ResolvedConfigSnapshot.clear(self.run_id, temp_directory)
+        return return_value
+
+    def run_marker_clear(self) -> bool:
+        """
+        Remove the marker that keeps the temp files of the run (see TempCollector).
+        Call from the last task of the run, like xcom_persist_clear.
+        """
+        return_value = False
+        temp_directory = self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY, False)
+        if self.run_id and temp_directory:
+            return_value = TempCollector.clear_run(temp_directory, self.run_id)
+        return return_value
+
+    def record_executor(self,
+        mode:str = RecordExecutor.MODE_THREAD,
+        max_workers:int = None,
+        timeout:float = None,
+        checkpoint:bool = False) -> RecordExecutor:
+        """
+        Executor that processes the record ids of this run in parallel, claiming each
+        record through the inflight tracker. See RecordExecutor.
+
+        Parameters:
+        mode: RecordExecutor.MODE_THREAD or RecordExecutor.MODE_PROCESS
+        max_workers: Records processed concurrently, defaults to the CPU count
+        timeout: Seconds allowed per record, None for no limit
+        checkpoint: Journal completed records so a retry of the task resumes
+
+        Returns:
+        RecordExecutor bound to this context
+        """
+        return RecordExecutor(self, mode, max_workers, timeout, checkpoint)
+
+    def checkpoint_journal(self) -> CheckpointJournal:
+        """
+        Journal of the records completed by this task (and map index) in this run, it
+        survives a failed attempt so the retry can resume. See CheckpointJournal.
+
+        Returns:
+        CheckpointJournal
+
+        Throws:
+        ValueError if there is no run id
+        """
+        if not self.run_id:
+            raise ValueError("A checkpoint journal requires a run id")
+
+        task_id = getattr(self.context.get(Constants.AIRFLOW_CTX.TASK_INSTANCE), "task_id", None)
+        return CheckpointJournal(
+            self._checkpoint_path(),
+            self.run_id,
+            task_id or "task",
+            self.map_index
+        )
+
+    def checkpoint_clear(self) -> int:
+        """
+        Remove the checkpoint journals of every task of the run. Call from the last
+        task of the run, like xcom_persist_clear.
+
+        Returns:
+        Number of journals removed
+        """
+        return_value = 0
+        if self.run_id:
+            return_value = CheckpointJournal.clear_run(self._checkpoint_path(), self.run_id)
+        return return_value
+
+    def _checkpoint_path(self) -> str:
+        return os.path.join(
+            self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY),
+            Constants.XCOM_PERSIST.CHECKPOINT_PERSIST_PATH
+        )
+
     def summarize(self):
         """
         Print a summary of the different settings that are contained within this
         instance.
         """
+        # pprint pulls in dataclasses/inspect, only worth it when summarizing
+        from pprint import pprint
+
         print("Execution Configuration from DAG:")
         print(self.airflow_context.to_json())
 
@@ -397,8 +918,8 @@ class DagContext:
         temp_directory = self.get_value(PropertyClass.Environment, Constants.ENVIRONMENT.TEMP_DIRECTORY)
         xcom_directory = os.path.join(temp_directory, path)
 
-        if not os.path.exists(xcom_directory):
-            os.makedirs(xcom_directory)
+        # Several threads may persist at once
+        os.makedirs(xcom_directory, exist_ok=True)
 
         return xcom_directory
 
@@ -427,7 +948,12 @@ class DagContext:
         """
         constants_class: One of the classes in constants.py to find a setting in
         setting: Setting to find to see if it's a valid choice.
+
+        XCOM data names are looked up in the channel registry, other classes are scanned.
         """
+        if constants_class is Constants.XCOM_DATA:
+            return XCOM_CHANNELS.is_valid(setting)
+
         return_value = False
         for prop in dir(constants_class):
             val = getattr(constants_class, prop)
@@ -4,7 +4,9 @@
 
 import os
 import datetime
-from pprint import pprint
+import threading
+import typing
+from dagcontext.generic.warmregistry import WarmRegistry
 
 
 class InflightTracker:
@@ -22,21 +24,25 @@ class InflightTracker:
     Other processes can determine if a file it thinks it should process is being processed by another
     instance of the DAG. If it is, it should be ignored to prevent duplicate processing.
     """
-    def __init__(self, task_run_id:str, inflight_path:str):
+    def __init__(self, task_run_id:str, inflight_path:str, task_key:str = None):
         """
         Constructor 
 
         Parameters:
         task_run_id: Run id of this instantiation of the DAG
         inflight_path: Folder in which to track inflight information.
+        task_key: Task (and map index) of the run claiming records, tasks of the same
+                  run do not process each other's records
         """
         self.task_run_id = task_run_id
+        self.task_key = task_key
+        # Record claims may come from several worker threads
+        self._lock = threading.Lock()
 
         # Make sure path exists
         self.inflight_path = inflight_path
         self.processing_path = os.path.join(inflight_path, "processing-{}.txt".format(self.task_run_id))
-        if not os.path.exists(self.inflight_path):
-            os.makedirs(self.inflight_path)
+        WarmRegistry.ensure_directory(self.inflight_path)
 
     def inflight_exists(self, file_id:str) -> bool:
         """
@@ -61,6 +67,54 @@ class InflightTracker:
 
         return return_value
 
+    def claim(self, file_id:str) -> bool:
+        """
+        Atomically take ownership of a record. Unlike inflight_exists followed by 
+        inflight_append there is no window in which two workflows can both decide
+        the record is free, the record file is created exclusively.
+
+        A record already claimed by this task of the run (i.e. on a task retry) is still
+        owned, one claimed by another task of the same run is not.
+
+        Parameters:
+        file_id: OAK File id to process
+
+        Returns:
+        True if this task owns the record and should process it
+        """
+        record = self._record_path(file_id)
+        try:
+            descriptor = os.open(record, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return self._claimant(file_id) == (self.task_run_id, self.task_key)
+
+        with os.fdopen(descriptor, "w") as record_file:
+            record_file.write("{}\n{}".format(datetime.datetime.now(), self.task_run_id))
+            if self.task_key:
+                record_file.write("\n{}".format(self.task_key))
+
+        self._append_process_records([file_id])
+        return True
+
+    def release(self, file_id:str) -> bool:
+        """
+        Give up a record claimed with claim(). Records owned by other runs, or other
+        tasks of this run, are left alone.
+
+        Returns:
+        True if the record was released
+        """
+        if self._claimant(file_id) != (self.task_run_id, self.task_key):
+            return False
+        return self.infligth_remove([file_id]) > 0
+
+    def owner(self, file_id:str) -> str:
+        """
+        Run id that claimed the record, None if it is not inflight or was added with
+        inflight_append (which only records a time stamp).
+        """
+        return self._claimant(file_id)[0]
+
     def inflight_append(self, file_ids:list) -> None:
         """
         To prevent multiiple invocation on the same file being pushed to OAK when multiple workflows
@@ -143,7 +197,24 @@ class InflightTracker:
         for this instance. 
         """
         if file_ids:
-            with open(self.processing_path, "a") as proc:
+            with self._lock, open(self.processing_path, "a") as proc:
                 for id in file_ids:
                     proc.writelines(id + "\n")
 
+    def _claimant(self, file_id:str) -> typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+        """(run id, task key) that claimed the record, None for what the record does not hold"""
+        lines = []
+        try:
+            with open(self._record_path(file_id), "r") as record_file:
+                lines = record_file.read().splitlines()
+        except FileNotFoundError:
+            pass
+        return (
+            lines[1] if len(lines) > 1 else None,
+            lines[2] if len(lines) > 2 else None
+        )
+
+    def _record_path(self, file_id:str) -> str:
+        """Record files are named after the last part of the OAK id"""
+        return os.path.join(self.inflight_path, file_id.split(':')[-1])
+
@@ -0,0 +1,353 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import os
+import time
+import typing
+from dagcontext.configurations.airflowctx_config import AirflowContextConfiguration
+from dagcontext.configurations.constants import Constants
+from dagcontext.context.contextsnapshot import ContextSnapshot
+from dagcontext.context.inflight import InflightTracker
+from dagcontext.context.recordexecutor import RecordExecutor
+from dagcontext.generic.activelog import ActivityLog
+from dagcontext.generic.tempcollector import TempCollector
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows has no fcntl, every run then processes its own records
+    fcntl = None
+
+
+class MicroBatcher:
+    """
+    Runs the records of many small triggered runs (OSDU triggers the DAG once per file)
+    in a single execution, so scheduling aside the per-run cost of building the
+    DagContext, acquiring tokens and setting up logging is paid once per batch.
+
+    Every run calls run() from its task:
+        1. Its payload (run id and record ids) is spooled to
+           TEMP_DIRECTORY/microbatch/pending/<run_id>.json
+        2. One run on the node becomes the leader (an flock on leader.lock). It waits
+           until the oldest payload is window seconds old or max_records records are
+           pending, takes every pending payload and processes all of their records
+           with one RecordExecutor on its own DagContext. A record asked for by more
+           than one run is processed once.
+        3. Each record is claimed with the InflightTracker of the run that asked for
+           it and everything logged while processing it goes to the activity log of
+           that run. Each run gets its own summary (see RecordExecutor) written to
+           results/<run_id>.json
+        4. Every run, leader included, returns the summary of its own records
+
+    A retry of a run that timed out waiting does not submit its payload again while
+    it is still pending or in a batch, it waits for that batch instead.
+
+    Only one leader exists at a time, so payloads a previous leader took but did not
+    finish (it died) are picked up by the next leader.
+    """
+    PENDING = "pending"
+    BATCHES = "batches"
+    RESULTS = "results"
+    LEADER_LOCK = "leader.lock"
+
+    KEY_RUN_ID = "run_id"
+    KEY_IDS = "ids"
+    KEY_SUBMITTED = "submitted"
+
+    def __init__(self,
+        temp_directory:str,
+        window:float = 2.0,
+        max_records:int = 500,
+        wait_timeout:float = 900.0,
+        poll_interval:float = 0.2):
+        """
+        Constructor
+
+        Parameters:
+        temp_directory: TEMP_DIRECTORY of the DAG
+        window: Seconds a payload waits for others to join its batch
+        max_records: Records that start a batch before the window passed
+        wait_timeout: Seconds a run waits for its results
+        poll_interval: Seconds between checks for results or leadership
+        """
+        self.directory = os.path.join(temp_directory, Constants.XCOM_PERSIST.MICROBATCH_PERSIST_PATH)
+        self.window = window
+        self.max_records = max_records
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+        for sub_directory in (MicroBatcher.PENDING, MicroBatcher.BATCHES, MicroBatcher.RESULTS):
+            os.makedirs(os.path.join(self.directory, sub_directory), exist_ok=True)
+
+    @staticmethod
+    def from_context(context:dict, **settings) -> "MicroBatcher":
+        """
+        Batcher for the TEMP_DIRECTORY of the task settings in an Airflow context, settings
+        are passed to the constructor.
+
+        Throws:
+        ValueError if the context has no temp directory
+        """
+        temp_directory = ContextSnapshot.peek_temp_directory(context)
+        if not temp_directory:
+            raise ValueError("Micro batching requires a temp directory")
+        return MicroBatcher(temp_directory, **settings)
+
+    def run(self,
+        context:dict,
+        function:typing.Callable[[str], typing.Any],
+        mode:str = RecordExecutor.MODE_THREAD,
+        max_workers:int = None,
+        timeout:float = None) -> dict:
+        """
+        Process the records of this run as part of a batch.
+
+        Parameters:
+        context: Context passed by Airflow to the task, a DagContext is only built
+                 when this run leads a batch
+        function: Called with a single record id, see RecordExecutor
+        mode, max_workers, timeout: See RecordExecutor
+
+        Returns:
+        Summary of the records of this run, see RecordExecutor
+
+        Throws:
+        TimeoutError if no batch processed this run within wait_timeout
+        """
+        run_id = ContextSnapshot.peek_run_id(context)
+        if not run_id:
+            raise ValueError("Micro batching requires a run id")
+
+        record_ids = AirflowContextConfiguration(context).get_attribute(Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID)
+        # Followers never build a DagContext, keep their payload and result from being collected
+        TempCollector.mark_run(os.path.dirname(self.directory), run_id)
+        if self._queued(run_id):
+            # An earlier attempt timed out waiting, its records are still on their way
+            ActivityLog.log_info("Payload of an earlier attempt is still queued, waiting on it", run_id)
+        else:
+            self._submit(run_id, record_ids)
+
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            summary = self._take_result(run_id)
+            if summary is not None:
+                return summary
+
+            lock = self._try_lead()
+            if lock is not None:
+                try:
+                    self._lead(context, function, mode, max_workers, timeout)
+                finally:
+                    os.close(lock)
+                continue
+
+            time.sleep(self.poll_interval)
+
+        raise TimeoutError("Run {} was not processed within {} seconds".format(run_id, self.wait_timeout))
+
+    def _submit(self, run_id:str, record_ids:typing.Tuple[str, ...]) -> None:
+        payload = {
+            MicroBatcher.KEY_RUN_ID : run_id,
+            MicroBatcher.KEY_IDS : list(record_ids),
+            MicroBatcher.KEY_SUBMITTED : time.time()
+        }
+        MicroBatcher._write(os.path.join(self.directory, MicroBatcher.PENDING, MicroBatcher._file_name(run_id)), payload)
+
+    def _queued(self, run_id:str) -> bool:
+        """True if the payload of the run is pending or taken by a leader"""
+        name = MicroBatcher._file_name(run_id)
+        return any(
+            os.path.exists(os.path.join(self.directory, sub_directory, name))
+            for sub_directory in (MicroBatcher.PENDING, MicroBatcher.BATCHES)
+        )
+
+    def _try_lead(self) -> typing.Optional[int]:
+        """Descriptor holding the leader lock, None when another run leads"""
+        if fcntl is None:
+            # No node wide lock, lead a batch of whatever this process submitted
+            return os.open(os.devnull, os.O_RDONLY)
+
+        descriptor = os.open(os.path.join(self.directory, MicroBatcher.LEADER_LOCK), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(descriptor)
+            return None
+        return descriptor
+
+    def _lead(self, context:dict, function, mode:str, max_workers:int, timeout:float) -> None:
+        """Collect a batch, process it and write the result of every run in it"""
+        # Deferred, dagcontext.context.dagcontext does not depend on this module
+        from dagcontext.context.dagcontext import DagContext
+
+        self._wait_for_batch()
+        payloads = self._take_pending()
+        if not payloads:
+            return
+
+        dag_context = DagContext.from_snapshot(context)
+        inflight_path = os.path.join(
+            os.path.dirname(self.directory),
+            Constants.XCOM_PERSIST.INFLIGHT_PERSIST_PATH
+        )
+
+        # Every record processed once, claimed for the first run asking for it
+        owners:typing.Dict[str, InflightTracker] = {}
+        record_ids = []
+        for payload in payloads:
+            tracker = InflightTracker(payload[MicroBatcher.KEY_RUN_ID], inflight_path)
+            for record_id in payload[MicroBatcher.KEY_IDS]:
+                if record_id not in owners:
+                    owners[record_id] = tracker
+                    record_ids.append(record_id)
+        owner_runs = {record_id : tracker.task_run_id for record_id, tracker in owners.items()}
+
+        ActivityLog.log_info("Micro batch of {} runs, {} records".format(len(payloads), len(record_ids)))
+
+        leader_tracker = dag_context.inflight_tracker
+        dag_context.inflight_tracker = _BatchTracker(owners)
+        try:
+            summary = RecordExecutor(dag_context, mode, max_workers, timeout).run(
+                _OwnedRecord(function, owner_runs),
+                record_ids
+            )
+        finally:
+            dag_context.inflight_tracker = leader_tracker
+
+        self._attribute(payloads, summary, dag_context.run_id)
+        self._clear_batch()
+
+    def _attribute(self, payloads:typing.List[dict], summary:dict, leader_run:str) -> None:
+        """Split the batch summary into one result and activity log per run"""
+        skipped = set(summary[RecordExecutor.SKIPPED])
+        for payload in payloads:
+            run_id = payload[MicroBatcher.KEY_RUN_ID]
+            ids = payload[MicroBatcher.KEY_IDS]
+            run_summary = {
+                RecordExecutor.RESULTS : {i : summary[RecordExecutor.RESULTS][i] for i in ids if i in summary[RecordExecutor.RESULTS]},
+                RecordExecutor.ERRORS : {i : summary[RecordExecutor.ERRORS][i] for i in ids if i in summary[RecordExecutor.ERRORS]},
+                RecordExecutor.SKIPPED : [i for i in ids if i in skipped]
+            }
+
+            # Entries go to the log of the run the records belong to
+            with ActivityLog.for_run(run_id):
+                ActivityLog.log_info("Processed in micro batch led by {}: {} succeeded, {} failed, {} skipped".format(
+                    leader_run,
+                    len(run_summary[RecordExecutor.RESULTS]),
+                    len(run_summary[RecordExecutor.ERRORS]),
+                    len(run_summary[RecordExecutor.SKIPPED])))
+                for record_id, error in run_summary[RecordExecutor.ERRORS].items():
+                    ActivityLog.log_warning("Record failed", record_id, error)
+
+            MicroBatcher._write(
+                os.path.join(self.directory, MicroBatcher.RESULTS, MicroBatcher._file_name(run_id)),
+                run_summary
+            )
+
+    def _wait_for_batch(self) -> None:
+        """Wait until the oldest pending payload is window seconds old or enough records are pending"""
+        while True:
+            pending = self._read_directory(MicroBatcher.PENDING)
+            if not pending:
+                return
+            oldest = min(payload[MicroBatcher.KEY_SUBMITTED] for payload in pending.values())
+            records = sum(len(payload[MicroBatcher.KEY_IDS]) for payload in pending.values())
+            remaining = oldest + self.window - time.time()
+            if remaining <= 0 or records >= self.max_records:
+                return
+            time.sleep(min(remaining, self.poll_interval))
+
+    def _take_pending(self) -> typing.List[dict]:
+        """
+        Move pending payloads into the batch directory, starting with those a previous
+        leader took but did not finish.
+        """
+        batch_directory = os.path.join(self.directory, MicroBatcher.BATCHES)
+        pending_directory = os.path.join(self.directory, MicroBatcher.PENDING)
+
+        payloads = list(self._read_directory(MicroBatcher.BATCHES).values())
+        records = sum(len(payload[MicroBatcher.KEY_IDS]) for payload in payloads)
+
+        for name, payload in sorted(self._read_directory(MicroBatcher.PENDING).items(), key=lambda item: item[1][MicroBatcher.KEY_SUBMITTED]):
+            if payloads and records + len(payload[MicroBatcher.KEY_IDS]) > self.max_records:
+                break
+            try:
+                os.replace(os.path.join(pending_directory, name), os.path.join(batch_directory, name))
+            except FileNotFoundError:
+                continue
+            payloads.append(payload)
+            records += len(payload[MicroBatcher.KEY_IDS])
+
+        return payloads
+
+    def _clear_batch(self) -> None:
+        batch_directory = os.path.join(self.directory, MicroBatcher.BATCHES)
+        for name in os.listdir(batch_directory):
+            try:
+                os.remove(os.path.join(batch_directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _take_result(self, run_id:str) -> typing.Optional[dict]:
+        result_path = os.path.join(self.directory, MicroBatcher.RESULTS, MicroBatcher._file_name(run_id))
+        try:
+            with open(result_path, "r") as result:
+                summary = json.load(result)
+        except (FileNotFoundError, ValueError):
+            return None
+        os.remove(result_path)
+        return summary
+
+    def _read_directory(self, sub_directory:str) -> typing.Dict[str, dict]:
+        """Payloads in a sub directory by file name, files being written are skipped"""
+        return_value = {}
+        directory = os.path.join(self.directory, sub_directory)
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), "r") as payload:
+                    return_value[name] = json.load(payload)
+            except (FileNotFoundError, ValueError):
+                pass
+        return return_value
+
+    @staticmethod
+    def _file_name(run_id:str) -> str:
+        return "{}.json".format(run_id.replace(os.sep, "_"))
+
+    @staticmethod
+    def _write(path:str, content:dict) -> None:
+        """Atomic, readers never see a partial file"""
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "w") as output:
+            json.dump(content, output, default=str)
+        os.replace(temp_path, path)
+
+
+class _OwnedRecord:
+    """
+    Record function of a micro batch, logs while processing a record go to the run
+    that asked for it. A class rather than a closure so process pools can pickle it.
+    """
+    def __init__(self, function:typing.Callable[[str], typing.Any], owner_runs:typing.Dict[str, str]):
+        self.function = function
+        self.owner_runs = owner_runs
+
+    def __call__(self, record_id:str) -> typing.Any:
+        with ActivityLog.for_run(self.owner_runs[record_id]):
+            return self.function(record_id)
+
+
+class _BatchTracker:
+    """Routes RecordExecutor claims to the InflightTracker of the run that owns the record"""
+    def __init__(self, owners:typing.Dict[str, InflightTracker]):
+        self.owners = owners
+
+    def claim(self, record_id:str) -> bool:
+        return self.owners[record_id].claim(record_id)
+
+    def release(self, record_id:str) -> bool:
+        return self.owners[record_id].release(record_id)
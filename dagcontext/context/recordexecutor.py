@@ -0,0 +1,213 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import functools
+import os
+import time
+import typing
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dagcontext.configurations.constants import Constants
+from dagcontext.generic.activelog import ActivityLog
+
+
+class RecordExecutor:
+    """
+    Processes the records of a run (SYSTEM_FILE_ID) in parallel.
+
+    For every record:
+        - The record is claimed with the InflightTracker, records owned by another run
+          or another task of the run are skipped
+        - The user function is called with the record id on a thread or process pool,
+          at most max_workers records are in progress at any time
+        - The claim is released when the record fails. A completed record stays claimed
+          until the run abandons its claims (see InflightTracker.abandon), so no other
+          task of the run processes it again
+
+    With checkpoint=True every completed record and its result is journaled (see
+    CheckpointJournal). A retry of the task takes the journaled results as they are
+    and only processes the records that did not complete.
+
+    Results are gathered into a summary that can be passed on through XCOM:
+
+        {
+            "results" : {record_id : return value},
+            "errors" : {record_id : error message},
+            "skipped" : [record ids owned by another run]
+        }
+
+    Use MODE_PROCESS for CPU bound work, the function must then be picklable (defined
+    at module level) and so must its return value.
+
+    A record is only handed to the pool when a worker is free to run it, so its timeout
+    counts from the moment it starts. A timed out record is reported as an error but
+    the worker running it cannot be interrupted: the record stays claimed until that
+    worker really finishes, and the pool has max_workers spare workers so records
+    behind it keep running. Once the spare workers are stuck as well, new records wait
+    for a stuck one to finish.
+    """
+    MODE_THREAD = "thread"
+    MODE_PROCESS = "process"
+
+    RESULTS = "results"
+    ERRORS = "errors"
+    SKIPPED = "skipped"
+
+    def __init__(self, context, mode:str = MODE_THREAD, max_workers:int = None, timeout:float = None, checkpoint:bool = False):
+        """
+        Constructor
+
+        Parameters:
+        context: DagContext of the task
+        mode: MODE_THREAD or MODE_PROCESS
+        max_workers: Records processed concurrently, defaults to the CPU count
+        timeout: Seconds allowed per record, None for no limit
+        checkpoint: Journal completed records so a retry resumes
+
+        Throws:
+        ValueError if mode is not supported
+        """
+        if mode not in (RecordExecutor.MODE_THREAD, RecordExecutor.MODE_PROCESS):
+            raise ValueError("Unsupported executor mode: {}".format(mode))
+
+        self.context = context
+        self.mode = mode
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.checkpoint = checkpoint
+
+    def run(self,
+        function:typing.Callable[[str], typing.Any],
+        record_ids:typing.List[str] = None,
+        output_channel:str = None) -> typing.Any:
+        """
+        Process the records.
+
+        Parameters:
+        function: Called with a single record id, the return value is the record result
+        record_ids: Records to process, defaults to the record ids of the execution context
+        output_channel: If present, the summary is passed through DagContext.xcom_output
+                        on this XCOM channel and that return value is returned instead
+
+        Returns:
+        Summary dictionary (see class) or the xcom_output value
+        """
+        if record_ids is None:
+            record_ids = self.context.airflow_context.get_attribute(Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID)
+
+        summary = {RecordExecutor.RESULTS : {}, RecordExecutor.ERRORS : {}, RecordExecutor.SKIPPED : []}
+        tracker = self.context.inflight_tracker
+
+        journal = self.context.checkpoint_journal() if self.checkpoint else None
+        completed = journal.completed() if journal else {}
+
+        pending = list(record_ids)
+        in_progress:typing.Dict[Future, typing.Tuple[str, float]] = {}
+        # Timed out records whose worker is still running them
+        stuck:typing.Dict[Future, str] = {}
+
+        # Loading multiprocessing is only worth it for process pools
+        if self.mode == RecordExecutor.MODE_PROCESS:
+            from concurrent.futures import ProcessPoolExecutor as pool_class
+        else:
+            from concurrent.futures import ThreadPoolExecutor as pool_class
+        # Spare workers take over from workers stuck on timed out records
+        capacity = self.max_workers * 2
+        pool = pool_class(max_workers=capacity)
+        try:
+            while pending or in_progress:
+                # Keep the pool fed but never queue more than it can start right away
+                while pending and len(in_progress) < self.max_workers and len(in_progress) + len(stuck) < capacity:
+                    record_id = pending.pop(0)
+                    if record_id in completed:
+                        # Done by an earlier attempt of the task
+                        summary[RecordExecutor.RESULTS][record_id] = completed[record_id]
+                        continue
+                    if tracker and not tracker.claim(record_id):
+                        ActivityLog.log_debug("Record owned by another run, skipping", record_id)
+                        summary[RecordExecutor.SKIPPED].append(record_id)
+                        continue
+                    in_progress[pool.submit(function, record_id)] = (record_id, time.monotonic())
+
+                if not in_progress and not (pending and stuck):
+                    continue
+
+                done, _ = wait(
+                    list(in_progress) + list(stuck),
+                    timeout=self._next_deadline(in_progress),
+                    return_when=FIRST_COMPLETED
+                )
+
+                for future in done:
+                    if future in stuck:
+                        record_id = stuck.pop(future)
+                        ActivityLog.log_info("Timed out record finished, releasing it", record_id)
+                        self._release(record_id)
+                        continue
+
+                    record_id, _ = in_progress.pop(future)
+                    try:
+                        summary[RecordExecutor.RESULTS][record_id] = future.result()
+                        if journal:
+                            journal.record(record_id, summary[RecordExecutor.RESULTS][record_id])
+                    except Exception as ex:  # pylint: disable=broad-except
+                        ActivityLog.log_warning("Record failed", record_id, str(ex))
+                        summary[RecordExecutor.ERRORS][record_id] = str(ex)
+                        # Another attempt may take it, a completed record stays claimed
+                        self._release(record_id)
+
+                if self.timeout is not None:
+                    now = time.monotonic()
+                    for future, (record_id, started) in list(in_progress.items()):
+                        if now - started >= self.timeout:
+                            in_progress.pop(future)
+                            ActivityLog.log_warning("Record timed out", record_id)
+                            summary[RecordExecutor.ERRORS][record_id] = "Timed out after {} seconds".format(self.timeout)
+                            # Still running, released once the worker is done with it
+                            stuck[future] = record_id
+        finally:
+            # Anything still in progress here is abandoned (error or interrupt) and the
+            # stuck records are left running. Records that never started are released
+            # now, the others once their worker is done, so no other run processes a
+            # record while a worker is still on it.
+            running = dict(stuck)
+            running.update({future : record_id for future, (record_id, _) in in_progress.items()})
+            for future, record_id in running.items():
+                if future.cancel():
+                    self._release(record_id)
+                else:
+                    future.add_done_callback(functools.partial(self._release_done, record_id))
+            # Do not wait on workers that are still running. shutdown(cancel_futures=True)
+            # needs Python 3.9, everything submitted was cancelled above where possible.
+            pool.shutdown(wait=not running)
+            if journal:
+                journal.close()
+
+        ActivityLog.log_info("Records processed: {} succeeded ({} resumed), {} failed, {} skipped".format(
+            len(summary[RecordExecutor.RESULTS]),
+            len([record_id for record_id in record_ids if record_id in completed]),
+            len(summary[RecordExecutor.ERRORS]),
+            len(summary[RecordExecutor.SKIPPED])
+        ))
+
+        if output_channel:
+            return self.context.xcom_output(output_channel, summary)
+        return summary
+
+    def _next_deadline(self, in_progress:dict) -> typing.Optional[float]:
+        """Seconds until the oldest record in progress times out"""
+        if self.timeout is None or not in_progress:
+            return None
+        oldest = min(started for _, started in in_progress.values())
+        return max(0.0, self.timeout - (time.monotonic() - oldest))
+
+    def _release_done(self, record_id:str, _future:Future) -> None:
+        self._release(record_id)
+
+    def _release(self, record_id:str) -> None:
+        tracker = self.context.inflight_tracker
+        if tracker:
+            try:
+                tracker.release(record_id)
+            except Exception as ex:  # pylint: disable=broad-except
+                ActivityLog.log_warning("Unable to release record", record_id, str(ex))
@@ -0,0 +1,134 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import heapq
+import itertools
+import json
+import os
+import typing
+from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.xcom_channels import XcomChannel
+from dagcontext.generic.activelog import ActivityLog
+
+
+class XcomMerge:
+    """
+    Combines the outputs of many upstream tasks into a single persisted JSONL channel
+    without loading them all into memory, see DagContext.xcom_persist_reduce.
+
+    Each upstream output (a persisted file or an inline XCOM value, one per map index
+    for a mapped task) is read as a stream of records:
+        - .jsonl files are read one line at a time
+        - Other JSON data is loaded on its own, a list gives its items as records,
+          anything else is a single record
+
+    Without a key the streams are concatenated in task order. With a key the records
+    are k-way merged on that key, which keeps only one record per upstream output in
+    memory and requires every output to already be sorted on the key.
+    """
+    JSONL_EXTENSION = ".jsonl"
+
+    def __init__(self, context):
+        """
+        Constructor
+
+        Parameters:
+        context: DagContext of the task
+        """
+        self.context = context
+
+    def sources(self, task_ids:typing.List[str]) -> typing.List[typing.Any]:
+        """
+        Raw XCOM values of the upstream tasks, paths are not opened.
+        """
+        return_value = []
+        task_instance = self.context.context.get(Constants.AIRFLOW_CTX.TASK_INSTANCE)
+        if task_instance is not None:
+            for task_id in task_ids:
+                raw_data = task_instance.xcom_pull(task_ids=task_id)
+                if self.context._is_mapped(task_id):
+                    # One value per map index, a list output of a task that is not
+                    # mapped is a single output
+                    return_value.extend(value for value in raw_data or [] if value is not None)
+                elif raw_data is not None:
+                    return_value.append(raw_data)
+        return return_value
+
+    def merge(self,
+        task_ids:typing.List[str],
+        channel:XcomChannel,
+        persist_path:str,
+        key:typing.Union[str, typing.Callable[[typing.Any], typing.Any]] = None,
+        reverse:bool = False) -> int:
+        """
+        Stream the upstream outputs into persist_path, one JSONL record per line.
+
+        Parameters:
+        task_ids: Upstream task ids
+        channel: Channel being written
+        persist_path: File to write, replaced only once the merge completed
+        key: None to concatenate, a field name or a function of a record to merge on
+        reverse: Outputs are sorted in descending key order
+
+        Returns:
+        Number of records written
+        """
+        streams = [XcomMerge.records(source) for source in self.sources(task_ids)]
+
+        if key is None:
+            merged = itertools.chain.from_iterable(streams)
+        else:
+            key_function = key if callable(key) else (lambda record: record[key])
+            merged = heapq.merge(*streams, key=key_function, reverse=reverse)
+
+        record_count = 0
+        byte_count = 0
+        temp_path = "{}.{}.tmp".format(persist_path, os.getpid())
+        try:
+            with open(temp_path, "w") as persisted_data:
+                for record in merged:
+                    line = channel.encode_record(record)
+                    persisted_data.write(line)
+                    record_count += 1
+                    # JSONL lines are ASCII (json.dumps escapes the rest), characters are bytes
+                    byte_count += len(line)
+            os.replace(temp_path, persist_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        if channel.size_budget is not None and byte_count > channel.size_budget:
+            ActivityLog.log_warning("XCOM channel {} is {} bytes, budget is {}".format(
+                channel.name, byte_count, channel.size_budget))
+
+        ActivityLog.log_info("Merged {} records from {} outputs".format(record_count, len(streams)))
+        return record_count
+
+    @staticmethod
+    def records(source:typing.Any) -> typing.Iterator[typing.Any]:
+        """
+        Records of a single upstream output, see the class for the formats.
+        """
+        if isinstance(source, str) and os.path.isfile(source):
+            if source.endswith(XcomMerge.JSONL_EXTENSION):
+                with open(source, "r") as persisted_data:
+                    for line in persisted_data:
+                        if line.strip():
+                            yield json.loads(line)
+                return
+
+            with open(source, "r") as persisted_data:
+                source = persisted_data.read()
+
+        if isinstance(source, str):
+            try:
+                source = json.loads(source)
+            except ValueError:
+                # Plain text output
+                pass
+
+        if isinstance(source, list):
+            yield from source
+        else:
+            yield source
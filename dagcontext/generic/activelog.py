@@ -3,9 +3,31 @@
 # Licensed under Microsoft Incubation License Agreement:
 
 from datetime import datetime
+import contextlib
+import functools
 import json
 import os
 import sys
+import threading
+import time
+import types
+import typing
+from dagcontext.generic.logarchive import ActivityLogArchive
+from dagcontext.generic.logwriter import ActivityLogWriter
+from dagcontext.generic.warmregistry import WarmRegistry
+
+class LazyLogValue:
+    """Logging argument built only when the message is written, see ActivityLog.lazy"""
+    __slots__ = ("function", "args", "kwargs")
+
+    def __init__(self, function:typing.Callable, args:tuple, kwargs:dict):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.function(*self.args, **self.kwargs)
+
 
 class ActivityLog:
     """
@@ -14,28 +36,134 @@ class ActivityLog:
     /tmp/activity_log 
 
     Logs are tagged with the run ID 
+
+    When ACTIVITY_LOG_BUFFERED is set (default) lines are handed to a background
+    writer that batches them and flushes on size, on interval, on errors and on
+    task exit (see flush_on_exit). Set it to False to write synchronously.
+
+    When ACTIVITY_LOG_FORMAT is FORMAT_JSONL each call is written as a single JSON
+    record (run_id, task, level, ts, message, fields) to <run_id>_activity.jsonl
+    with a sidecar <run_id>_activity.idx that summarizes every written block by
+    level and time. See dagcontext/generic/logquery for reading them back.
     """
+    FORMAT_TEXT = "text"
+    FORMAT_JSONL = "jsonl"
+
+    TEXT_EXTENSION = ".log"
+    JSONL_EXTENSION = ".jsonl"
+    INDEX_EXTENSION = ".idx"
+
     ACTIVITY_LOG_DIRECTORY = None
     ACTIVITY_LOG_BASETASK_ID = None
+    ACTIVITY_LOG_TASK_ID = None
+    ACTIVITY_LOG_FORMAT = FORMAT_TEXT
+    # Fields added to every structured record, i.e. data partition
+    ACTIVITY_LOG_FIELDS = {}
+
+    # Thresholds for the file and console (Airflow log), messages below both are
+    # dropped before any of the arguments are rendered. A level not in LEVELS counts
+    # as DEFAULT_LEVEL.
+    LEVELS = {"DEBUG" : 10, "INFO" : 20, "SEGMENT" : 20, "WARN" : 30, "ERROR" : 40}
+    DEFAULT_LEVEL = "INFO"
+    ACTIVITY_LOG_LEVEL = "INFO"
+    ACTIVITY_LOG_CONSOLE_LEVEL = "INFO"
+    # Payload limits, lists/dicts are sampled and rendered text truncated
+    ACTIVITY_LOG_MAX_ITEMS = 100
+    ACTIVITY_LOG_MAX_CHARS = 8192
     ACTIVITY_LOG_CACHE_SIZE = 50
+    ACTIVITY_LOG_ARCHIVE_BYTES = 256 * 1024 * 1024
+    ACTIVITY_LOG_COMPRESS_AFTER = 6 * 60 * 60
+
+    ACTIVITY_LOG_BUFFERED = True
+    ACTIVITY_LOG_FLUSH_SIZE = 500
+    ACTIVITY_LOG_FLUSH_INTERVAL = 2.0
+
+    _writer:ActivityLogWriter = None
+    # Run a thread logs for when it differs from ACTIVITY_LOG_BASETASK_ID, see for_run
+    _scope = threading.local()
+    _archive:ActivityLogArchive = None
+    _last_maintenance = 0.0
+    _timestamp_second = None
+    _timestamp_text = None
+
+    @staticmethod
+    def flush(timeout:float = None) -> bool:
+        """Push any buffered lines out to the activity log file"""
+        return_value = True
+        if ActivityLog._writer:
+            return_value = ActivityLog._writer.flush(timeout)
+        return return_value
+
+    @staticmethod
+    def complete_run(run_id:str = None) -> None:
+        """
+        Called when a run has finished logging (typically by its last task). The
+        buffered lines are flushed and the run's log is compressed in the archive.
+        """
+        run_id = run_id or ActivityLog.ACTIVITY_LOG_BASETASK_ID
+        archive = ActivityLog._get_archive()
+        if run_id and archive:
+            ActivityLog.flush()
+            archive.compress_run(run_id)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def for_run(run_id:str):
+        """
+        Entries the current thread logs inside the block go to the log of run_id,
+        i.e. records of other runs processed in a micro batch. Other threads keep
+        logging to ACTIVITY_LOG_BASETASK_ID.
+        """
+        previous = getattr(ActivityLog._scope, "run_id", None)
+        ActivityLog._scope.run_id = run_id
+        try:
+            yield
+        finally:
+            ActivityLog._scope.run_id = previous
+
+    @staticmethod
+    def _run_id() -> typing.Optional[str]:
+        return getattr(ActivityLog._scope, "run_id", None) or ActivityLog.ACTIVITY_LOG_BASETASK_ID
+
+    @staticmethod
+    def flush_on_exit(task_function):
+        """
+        Decorator for task callables that makes sure the buffered activity log
+        is written out when the task returns or raises. Airflow may end the task
+        process without running atexit handlers so this should wrap every task.
+        """
+        @functools.wraps(task_function)
+        def wrapper(*args, **kwargs):
+            try:
+                return task_function(*args, **kwargs)
+            finally:
+                ActivityLog.flush()
+        return wrapper
 
     @staticmethod
     def log_segment(segment_name):
         """Only to file if present deliniate between tasks"""
+        if not ActivityLog._file_enabled("SEGMENT"):
+            return
+
+        if ActivityLog.ACTIVITY_LOG_FORMAT == ActivityLog.FORMAT_JSONL:
+            ActivityLog._output_to_activity_log([ActivityLog._build_record("SEGMENT", [segment_name])])
+            return
+
+        timestamp = ActivityLog._get_timestamp()
         output_content = []
-        output_content.append("{} ************************************************".format(
-            ActivityLog._get_timestamp()
-            )
-        )
-        output_content.append("{} {}".format(ActivityLog._get_timestamp(), segment_name))
-        output_content.append("{} ************************************************".format(
-            ActivityLog._get_timestamp()
-            )
-        )
+        output_content.append("{} ************************************************".format(timestamp))
+        output_content.append("{} {}".format(timestamp, segment_name))
+        output_content.append("{} ************************************************".format(timestamp))
 
         # Dump to archive file
         ActivityLog._output_to_activity_log(output_content)
 
+    @staticmethod
+    def log_debug(*args):
+        """Diagnostic logging, off unless ACTIVITY_LOG_LEVEL or ACTIVITY_LOG_CONSOLE_LEVEL is DEBUG"""
+        ActivityLog._log_something("DEBUG", *args)
+
     @staticmethod
     def log_info(*args):
         """Informational logging"""
@@ -50,97 +178,340 @@ class ActivityLog:
     def log_error(*args):
         """ Error Logging"""
         ActivityLog._log_something("ERROR", *args)
+        # Errors usually precede a failure, get everything on disk now
+        ActivityLog.flush()
+
+    @staticmethod
+    def is_enabled(level:str) -> bool:
+        """
+        True if a message at level would be written anywhere. Use it to guard
+        expensive work that only exists to be logged.
+        """
+        return ActivityLog._file_enabled(level) or ActivityLog._console_enabled(level)
+
+    @staticmethod
+    def lazy(function:typing.Callable, *args, **kwargs) -> LazyLogValue:
+        """
+        Argument for a logging call that is only built when the message is written:
+
+            ActivityLog.log_debug("Records", ActivityLog.lazy(summarize, records))
+
+        A lambda without required arguments is treated the same way, any other
+        callable (classes, functions, bound methods) is logged as it is.
+        """
+        return LazyLogValue(function, args, kwargs)
+
+    @staticmethod
+    def _file_enabled(level:str) -> bool:
+        return (ActivityLog.ACTIVITY_LOG_BASETASK_ID is not None
+            and ActivityLog.ACTIVITY_LOG_DIRECTORY is not None
+            and ActivityLog._level(level) >= ActivityLog._level(ActivityLog.ACTIVITY_LOG_LEVEL))
+
+    @staticmethod
+    def _console_enabled(level:str) -> bool:
+        return ActivityLog._level(level) >= ActivityLog._level(ActivityLog.ACTIVITY_LOG_CONSOLE_LEVEL)
+
+    @staticmethod
+    def _level(level:str) -> int:
+        """Value of a level name, DEFAULT_LEVEL for names not in LEVELS"""
+        value = ActivityLog.LEVELS.get(level)
+        if value is None:
+            value = ActivityLog.LEVELS.get(str(level).upper(), ActivityLog.LEVELS[ActivityLog.DEFAULT_LEVEL])
+        return value
 
     @staticmethod
     def _log_something(level, *args):
         """
         Breaks down the args
 
-        - Dict/List dumped as JSON
+        - Callables are invoked to produce the value, only if the level is enabled
+        - Dict/List dumped as JSON, sampled/truncated to the payload limits
         - Exceptions log file and line with exception
         - Strings are straight out
         - Other are string versions of whatever it is.
         """
+        to_file = ActivityLog._file_enabled(level)
+        to_console = ActivityLog._console_enabled(level)
+        if not (to_file or to_console):
+            return
+
+        args = [ActivityLog._limit_payload(ActivityLog._resolve(arg)) for arg in args]
+
+        if ActivityLog.ACTIVITY_LOG_FORMAT == ActivityLog.FORMAT_JSONL:
+            record = ActivityLog._build_record(level, args)
+            if to_console:
+                print(record["message"])
+                if record["fields"]:
+                    print(ActivityLog._truncate(json.dumps(record["fields"], indent=4, default=str)))
+            if to_file:
+                ActivityLog._output_to_activity_log([record])
+            return
+
         lines = []
 
         for arg in args:
             output = arg
             if isinstance(output, Exception):
                 exception_type, exception_object, exception_traceback = sys.exc_info()
-                filename = exception_traceback.tb_frame.f_code.co_filename
-                filename = os.path.split(filename)[1]
-                line_number = exception_traceback.tb_lineno
-                lines.append("({}:{}) {}".format(filename, line_number, exception_type))
+                if exception_traceback:
+                    filename = exception_traceback.tb_frame.f_code.co_filename
+                    filename = os.path.split(filename)[1]
+                    line_number = exception_traceback.tb_lineno
+                    lines.append("({}:{}) {}".format(filename, line_number, exception_type))
                 lines.append("\t{}".format(str(output)))
 
-            elif isinstance(output, dict) or isinstance(output, list):
-                result = json.dumps(output, indent=4)
+            elif isinstance(output, (dict, list, tuple)):
+                result = ActivityLog._truncate(json.dumps(output, indent=4, default=str))
                 individuals = result.split("\n")
                 lines.extend(individuals)
 
             elif not isinstance(output, str):
-                lines.append(str(output))
+                lines.append(ActivityLog._truncate(str(output)))
 
             else:
-                lines.append(output)
+                lines.append(ActivityLog._truncate(output))
 
         # Dump to console, i.e. Airflow log
-        output_content = []
-        for line in lines:
-            output_content.append("{} {:<8} {}".format(ActivityLog._get_timestamp(), level, line))
-            print(line)
+        if to_console:
+            print("\n".join(lines))
 
         # Dump to archive file
-        ActivityLog._output_to_activity_log(output_content)
+        if to_file:
+            timestamp = ActivityLog._get_timestamp()
+            output_content = ["{} {:<8} {}".format(timestamp, level, line) for line in lines]
+            ActivityLog._output_to_activity_log(output_content)
+
+    @staticmethod
+    def _resolve(arg):
+        """
+        Lazy arguments, a LazyLogValue or a lambda without required arguments is only
+        evaluated when it will be logged. Other callables are values in their own right.
+        """
+        if isinstance(arg, LazyLogValue):
+            return arg()
+        if isinstance(arg, types.LambdaType) and arg.__name__ == "<lambda>":
+            code = arg.__code__
+            required = code.co_argcount - len(arg.__defaults__ or ())
+            required_keywords = code.co_kwonlyargcount - len(arg.__kwdefaults__ or {})
+            if required == 0 and required_keywords == 0:
+                return arg()
+        return arg
+
+    @staticmethod
+    def _limit_payload(arg):
+        """
+        Sample large lists and dicts down to ACTIVITY_LOG_MAX_ITEMS entries, a marker
+        entry records how many were left out.
+        """
+        limit = ActivityLog.ACTIVITY_LOG_MAX_ITEMS
+        if isinstance(arg, (list, tuple)) and len(arg) > limit:
+            return list(arg[:limit]) + ["... {} more items".format(len(arg) - limit)]
+
+        if isinstance(arg, dict):
+            if len(arg) > limit:
+                keys = list(arg)[:limit]
+                limited = {key : arg[key] for key in keys}
+                limited["..."] = "{} more keys".format(len(arg) - limit)
+                arg = limited
+            if any(isinstance(value, list) and len(value) > limit for value in arg.values()):
+                arg = {
+                    key : (value[:limit] + ["... {} more items".format(len(value) - limit)]
+                        if isinstance(value, list) and len(value) > limit else value)
+                    for key, value in arg.items()
+                }
+        return arg
+
+    @staticmethod
+    def _truncate(text:str) -> str:
+        """Cap a rendered value at ACTIVITY_LOG_MAX_CHARS"""
+        limit = ActivityLog.ACTIVITY_LOG_MAX_CHARS
+        if len(text) > limit:
+            return "{}... ({} chars truncated)".format(text[:limit], len(text) - limit)
+        return text
+
+    @staticmethod
+    def _build_record(level:str, args) -> dict:
+        """
+        Structured version of the args
+
+        - Dicts are merged into the record fields
+        - Exceptions are recorded in the exception field with file and line
+        - Everything else is joined into the message, lists as compact JSON
+        """
+        message = []
+        fields = dict(ActivityLog.ACTIVITY_LOG_FIELDS)
+
+        for arg in args:
+            if isinstance(arg, Exception):
+                exception_type, exception_object, exception_traceback = sys.exc_info()
+                exception_info = {"type" : type(arg).__name__, "message" : str(arg)}
+                if exception_traceback:
+                    exception_info["file"] = os.path.split(exception_traceback.tb_frame.f_code.co_filename)[1]
+                    exception_info["line"] = exception_traceback.tb_lineno
+                fields["exception"] = exception_info
+                message.append(str(arg))
+            elif isinstance(arg, dict):
+                fields.update(arg)
+            elif isinstance(arg, (list, tuple)):
+                message.append(ActivityLog._truncate(json.dumps(arg, default=str)))
+            else:
+                message.append(ActivityLog._truncate(str(arg)))
+
+        return {
+            "run_id" : ActivityLog._run_id(),
+            "task" : ActivityLog.ACTIVITY_LOG_TASK_ID,
+            "level" : level,
+            "ts" : time.time(),
+            "message" : " ".join(message),
+            "fields" : fields
+        }
 
     @staticmethod
     def _get_timestamp() -> str:
-        """Get timestamp for log entry"""
-        now = datetime.utcnow()
-        return now.strftime("%m/%d/%Y - %H:%M:%S:")
+        """Get timestamp for log entry, formatted at most once per second"""
+        now = int(time.time())
+        if now != ActivityLog._timestamp_second:
+            ActivityLog._timestamp_text = datetime.utcfromtimestamp(now).strftime("%m/%d/%Y - %H:%M:%S:")
+            ActivityLog._timestamp_second = now
+        return ActivityLog._timestamp_text
 
     @staticmethod
     def _output_to_activity_log(lines):
         """Dumps the lines generated out to the appropriate log"""
-        if ActivityLog.ACTIVITY_LOG_BASETASK_ID and ActivityLog.ACTIVITY_LOG_DIRECTORY:
-            if not os.path.exists(ActivityLog.ACTIVITY_LOG_DIRECTORY):
-                os.makedirs(ActivityLog.ACTIVITY_LOG_DIRECTORY)
-            
-            file_name = "{}_activity.log".format(ActivityLog.ACTIVITY_LOG_BASETASK_ID)
+        run_id = ActivityLog._run_id()
+        if run_id and ActivityLog.ACTIVITY_LOG_DIRECTORY:
+            extension = ActivityLog.TEXT_EXTENSION
+            if ActivityLog.ACTIVITY_LOG_FORMAT == ActivityLog.FORMAT_JSONL:
+                extension = ActivityLog.JSONL_EXTENSION
+
+            file_name = "{}_activity{}".format(run_id, extension)
             file_path = os.path.join(ActivityLog.ACTIVITY_LOG_DIRECTORY, file_name)
 
-            with open(file_path,"a") as activity_output:
-                for line in lines:
-                    activity_output.write("{}\n".format(line))
+            if ActivityLog.ACTIVITY_LOG_BUFFERED:
+                ActivityLog._get_writer().write(file_path, lines)
+            else:
+                ActivityLog._write_lines(file_path, lines)
+                ActivityLog._throttled_maintenance()
+
+    @staticmethod
+    def _get_writer() -> ActivityLogWriter:
+        """Lazily create the background writer shared by all logging calls"""
+        if ActivityLog._writer is None:
+            ActivityLog._writer = ActivityLogWriter(
+                ActivityLog._write_lines,
+                ActivityLog.ACTIVITY_LOG_FLUSH_SIZE,
+                ActivityLog.ACTIVITY_LOG_FLUSH_INTERVAL,
+                ActivityLog._maintain_archive
+            )
+        return ActivityLog._writer
+
+    @staticmethod
+    def _write_lines(file_path:str, lines):
+        """Write a batch of lines to the log file in a single append"""
+        WarmRegistry.ensure_directory(os.path.dirname(file_path))
+
+        if file_path.endswith(ActivityLog.JSONL_EXTENSION):
+            ActivityLog._write_records(file_path, lines)
+            return
+
+        content = "".join("{}\n".format(line) for line in lines).encode("utf-8")
+        ActivityLog._append(file_path, content)
+
+        archive = ActivityLog._get_archive()
+        if archive:
+            archive.register(file_path, len(content))
+
+    @staticmethod
+    def _write_records(file_path:str, records):
+        """
+        Write a batch of structured records and append one entry describing the
+        block to the sidecar index:
+            {"offset", "length", "ts_min", "ts_max", "levels" : {level : count}}
+        """
+        levels = {}
+        for record in records:
+            levels[record["level"]] = levels.get(record["level"], 0) + 1
+
+        content = "".join(json.dumps(record, default=str) + "\n" for record in records).encode("utf-8")
+        offset = ActivityLog._append(file_path, content)
+
+        block = {
+            "offset" : offset,
+            "length" : len(content),
+            "ts_min" : min(record["ts"] for record in records),
+            "ts_max" : max(record["ts"] for record in records),
+            "levels" : levels
+        }
+        index_path = file_path[:-len(ActivityLog.JSONL_EXTENSION)] + ActivityLog.INDEX_EXTENSION
+        index_content = (json.dumps(block) + "\n").encode("utf-8")
+        ActivityLog._append(index_path, index_content)
+
+        archive = ActivityLog._get_archive()
+        if archive:
+            archive.register(file_path, len(content))
+            archive.register(index_path, len(index_content))
+
+    @staticmethod
+    def _append(file_path:str, content:bytes) -> int:
+        """
+        Append content with a single write on an O_APPEND descriptor.
+
+        Parallel tasks of a run share the run's log file. The kernel positions and
+        writes an O_APPEND write as one operation, so a batch from one process is
+        never interleaved with lines from another and no lock is needed.
+
+        Returns:
+        Offset in the file at which content was written
+        """
+        descriptor = os.open(file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            written = os.write(descriptor, content)
+            # After an O_APPEND write the descriptor sits at the end of our data
+            offset = os.lseek(descriptor, 0, os.SEEK_CUR) - written
+            while written < len(content):
+                # Only on exotic file systems, the remainder is still appended
+                written += os.write(descriptor, content[written:])
+        finally:
+            os.close(descriptor)
+        return offset
+
+    @staticmethod
+    def _throttled_maintenance():
+        """Unbuffered mode, still only maintain the archive once per flush window"""
+        now = time.monotonic()
+        if now - ActivityLog._last_maintenance >= ActivityLog.ACTIVITY_LOG_FLUSH_INTERVAL:
+            ActivityLog._last_maintenance = now
+            ActivityLog._maintain_archive()
+
+    @staticmethod
+    def _get_archive() -> typing.Optional[ActivityLogArchive]:
+        """Archive for the current log directory, rebuilt if the directory changes"""
+        directory = ActivityLog.ACTIVITY_LOG_DIRECTORY
+        if not directory:
+            return None
+
+        archive = ActivityLog._archive
+        if archive is None or archive.directory != directory:
+            archive = ActivityLogArchive(
+                directory,
+                ActivityLog.ACTIVITY_LOG_CACHE_SIZE,
+                ActivityLog.ACTIVITY_LOG_ARCHIVE_BYTES,
+                ActivityLog.ACTIVITY_LOG_COMPRESS_AFTER
+            )
+            ActivityLog._archive = archive
 
-        # Maintain archive to size specified.
-        ActivityLog._maintain_archive()
+        # Budgets may be changed at any time on the class
+        archive.max_runs = ActivityLog.ACTIVITY_LOG_CACHE_SIZE
+        archive.max_bytes = ActivityLog.ACTIVITY_LOG_ARCHIVE_BYTES
+        archive.compress_after = ActivityLog.ACTIVITY_LOG_COMPRESS_AFTER
+        return archive
 
     @staticmethod
-    def _maintain_archive(archive_size = ACTIVITY_LOG_CACHE_SIZE):
+    def _maintain_archive():
         """Used to clear out old logs so we don't overflow the system"""
-        if ActivityLog.ACTIVITY_LOG_DIRECTORY:
-            found_files = {}
-            if os.path.exists(ActivityLog.ACTIVITY_LOG_DIRECTORY):
-                for root, dirs, files in os.walk(ActivityLog.ACTIVITY_LOG_DIRECTORY, topdown=False):
-                    for name in files:
-                        file_path = os.path.join(root, name)
-                        file_time = os.path.getctime(file_path)
-                        found_files[file_time] = file_path
-
-            keys = list(found_files.keys())
-            # Sort oldest to last
-            keys.sort()
-            if len(keys) > archive_size:
-                clean_count = archive_size - len(keys)
-                current_count = 0
-                for key in keys:
-                    print("Clearing old file", found_files[key])
-                    os.remove(found_files[key])
-                    current_count += 1
-
-                    if current_count >= clean_count:
-                        break
+        archive = ActivityLog._get_archive()
+        if archive:
+            archive.maintain(ActivityLog.ACTIVITY_LOG_BASETASK_ID)
 
 """
 ActivityLog.ACTIVITY_LOG_DIRECTORY = "./activity_logs"
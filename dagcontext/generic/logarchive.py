@@ -0,0 +1,336 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import contextlib
+import json
+import os
+import threading
+import time
+import typing
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows has no fcntl, the index is then only safe within one process
+    fcntl = None
+
+
+class ActivityLogArchive:
+    """
+    Keeps the activity log directory bounded without rescanning it on every write.
+
+    An index file in the log directory tracks each run (all files named
+    <run_id>_activity.*) with its files, their sizes, the last time the run was
+    written to and whether it completed. Every process logging to the directory
+    shares it: maintenance and compression read the index, change it and write it
+    back while holding an exclusive flock on LOCK_FILE, so no process overwrites
+    what another one recorded. Sizes of the files that can still grow are refreshed
+    from disk on each pass and the directory listing is only re-read when the directory's modification time
+    changed since the index was written, i.e. when a file was added or removed.
+    Writers register the files they append to, which costs nothing until the next
+    maintenance pass.
+
+    Maintenance enforces two budgets, oldest runs are removed first:
+        - max_runs: Number of runs to keep
+        - max_bytes: Total size of all files in the archive
+
+    Only completed runs are gzipped, a run that did not complete may still have a
+    writer appending to its files. compress_run marks a run completed and compresses
+    it, files a completed run gets afterwards (late flushes) are compressed by
+    maintenance once the run has not been written to for compress_after seconds.
+    A file is renamed before it is compressed, so a late append creates a new file
+    instead of being lost. Structured log sidecar index files are small and are
+    left uncompressed so they can be read cheaply.
+    """
+    INDEX_FILE = ".archive_index.json"
+    LOCK_FILE = ".archive_index.lock"
+    RUN_SEPARATOR = "_activity"
+    COMPRESSED_EXTENSION = ".gz"
+    COMPRESSING_EXTENSION = ".compressing"
+    UNCOMPRESSED_EXTENSIONS = (COMPRESSED_EXTENSION, ".idx")
+
+    def __init__(self, directory:str, max_runs:int, max_bytes:int = None, compress_after:float = None):
+        """
+        Constructor
+
+        Parameters:
+        directory: Activity log directory to manage
+        max_runs: Maximum number of runs to keep
+        max_bytes: Maximum total bytes on disk, None for no limit
+        compress_after: Seconds a completed run must not have been written to before
+                        files it got after completing are compressed, None to disable
+        """
+        self.directory = directory
+        self.max_runs = max_runs
+        self.max_bytes = max_bytes
+        self.compress_after = compress_after
+        self.index_path = os.path.join(directory, ActivityLogArchive.INDEX_FILE)
+        self.lock_path = os.path.join(directory, ActivityLogArchive.LOCK_FILE)
+
+        self._lock = threading.RLock()
+        # Index as last read or written by this process
+        self._runs:typing.Dict[str, dict] = {}
+        # Files written by this process since the index was last updated, name : last write
+        self._pending:typing.Dict[str, float] = {}
+
+    def register(self, file_path:str, added_bytes:int) -> None:
+        """
+        Record that added_bytes were appended to file_path. Called by the log writer
+        after every batch, the index is updated by the next maintenance pass.
+        """
+        with self._lock:
+            name = os.path.basename(file_path)
+            self._pending[name] = time.time()
+            run = self._runs.setdefault(
+                ActivityLogArchive.run_id_from_name(name),
+                {"updated" : 0.0, "files" : {}}
+            )
+            run["files"][name] = run["files"].get(name, 0) + added_bytes
+
+    def maintain(self, active_run:str = None) -> int:
+        """
+        Enforce the count and byte budgets and compress completed runs.
+
+        Parameters:
+        active_run: Run id currently being logged, never removed or compressed
+
+        Returns:
+        Number of runs removed
+        """
+        removed = 0
+        with self._locked_index():
+            # Oldest first, name breaks ties so equal timestamps never collide
+            ordered = sorted(self._runs.items(), key=lambda item: (item[1]["updated"], item[0]))
+            ordered = [run_id for run_id, _ in ordered if run_id != active_run]
+
+            run_count = len(self._runs)
+            total_bytes = self._total()
+            for run_id in ordered:
+                over_count = run_count > self.max_runs
+                over_bytes = self.max_bytes is not None and total_bytes > self.max_bytes
+                if not (over_count or over_bytes):
+                    break
+
+                total_bytes -= sum(self._runs[run_id]["files"].values())
+                run_count -= 1
+                self._delete_run(run_id)
+                removed += 1
+
+            if self.compress_after is not None:
+                idle_limit = time.time() - self.compress_after
+                for run_id in ordered:
+                    run = self._runs.get(run_id)
+                    if run and run.get("completed") and run["updated"] < idle_limit and self._has_uncompressed(run_id):
+                        # One run per pass keeps maintenance cost bounded
+                        self._compress(run_id)
+                        break
+
+        return removed
+
+    def compress_run(self, run_id:str) -> None:
+        """
+        Mark run_id completed and gzip every uncompressed file belonging to it. If
+        the run already has a compressed file the new content is appended as another
+        gzip member.
+        """
+        with self._locked_index():
+            run = self._runs.get(run_id)
+            if run:
+                run["completed"] = True
+                self._compress(run_id)
+
+    def total_bytes(self) -> int:
+        """Total size of the archive according to the index"""
+        with self._locked_index():
+            return self._total()
+
+    @staticmethod
+    def run_id_from_name(name:str) -> str:
+        """Files are named <run_id>_activity.<ext>, anything else is its own run"""
+        if ActivityLogArchive.RUN_SEPARATOR in name:
+            return name.rsplit(ActivityLogArchive.RUN_SEPARATOR, 1)[0]
+        return name
+
+    def _total(self) -> int:
+        return sum(sum(run["files"].values()) for run in self._runs.values())
+
+    def _compress(self, run_id:str) -> None:
+        """Gzip the uncompressed files of a run, called with the index locked"""
+        # Only needed once a run completes, not on every import
+        import gzip
+        import shutil
+
+        run = self._runs[run_id]
+        for name in list(run["files"]):
+            if name.endswith(ActivityLogArchive.UNCOMPRESSED_EXTENSIONS):
+                continue
+
+            # A file left renamed by an interrupted compression is picked up again
+            source_name = name
+            if name.endswith(ActivityLogArchive.COMPRESSING_EXTENSION):
+                source_name = name[:-len(ActivityLogArchive.COMPRESSING_EXTENSION)]
+            moving = os.path.join(self.directory, source_name + ActivityLogArchive.COMPRESSING_EXTENSION)
+            target_name = source_name + ActivityLogArchive.COMPRESSED_EXTENSION
+            target = os.path.join(self.directory, target_name)
+            try:
+                if name == source_name:
+                    # Appends from here on create a new file, they are not lost
+                    os.rename(os.path.join(self.directory, name), moving)
+                with open(moving, "rb") as raw, gzip.open(target, "ab") as packed:
+                    shutil.copyfileobj(raw, packed)
+                os.remove(moving)
+                self._mark_compressed(run, source_name)
+            except FileNotFoundError:
+                # Removed by another process in the meantime
+                pass
+
+            del run["files"][name]
+            if os.path.exists(target):
+                run["files"][target_name] = os.path.getsize(target)
+
+    def _has_uncompressed(self, run_id:str) -> bool:
+        return any(
+            not name.endswith(ActivityLogArchive.UNCOMPRESSED_EXTENSIONS)
+            for name in self._runs[run_id]["files"]
+        )
+
+    def _mark_compressed(self, run:dict, name:str) -> None:
+        """
+        Structured logs keep byte offsets in their .idx sidecar, tell readers that
+        every block written so far has moved into the compressed file.
+        """
+        base, extension = os.path.splitext(name)
+        index_name = base + ".idx"
+        if extension == ".jsonl" and index_name in run["files"]:
+            marker = json.dumps({"compressed" : True}) + "\n"
+            with open(os.path.join(self.directory, index_name), "a") as index_file:
+                index_file.write(marker)
+            run["files"][index_name] += len(marker)
+
+    def _delete_run(self, run_id:str) -> None:
+        """Remove all files of a run and drop it from the index"""
+        for name in self._runs[run_id]["files"]:
+            file_path = os.path.join(self.directory, name)
+            print("Clearing old file", file_path)
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        del self._runs[run_id]
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """
+        Hold the index: the thread lock, the flock of the directory, and the index
+        read from disk with this process's writes and the current file sizes applied.
+        The index is written back when the block completes.
+        """
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                yield self
+                return
+
+            descriptor = None
+            if fcntl is not None:
+                descriptor = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if descriptor is not None:
+                    fcntl.flock(descriptor, fcntl.LOCK_EX)
+                self._load()
+                yield self
+                self._save()
+            finally:
+                if descriptor is not None:
+                    fcntl.flock(descriptor, fcntl.LOCK_UN)
+                    os.close(descriptor)
+
+    def _load(self) -> None:
+        """
+        Read the index from disk and bring it up to date, called with the index
+        locked. A missing or unreadable index is rebuilt from the directory listing.
+        """
+        runs = {}
+        listed_mtime = None
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r") as index_file:
+                    content = json.load(index_file)
+                runs = content.get("runs", {})
+                listed_mtime = content.get("directory_mtime")
+            except Exception as ex:  # pylint: disable=broad-except
+                print("Activity log index unreadable, rebuilding:", ex)
+
+        for name, written in self._pending.items():
+            run = runs.setdefault(ActivityLogArchive.run_id_from_name(name), {"updated" : 0.0, "files" : {}})
+            run["files"].setdefault(name, 0)
+            run["updated"] = max(run["updated"], written)
+        written_names = set(self._pending)
+        self._pending = {}
+        self._runs = runs
+
+        if listed_mtime != os.stat(self.directory).st_mtime_ns:
+            written_names.update(self._reconcile())
+        self._refresh_sizes(written_names)
+
+    def _reconcile(self) -> typing.Set[str]:
+        """
+        Pick up files created or deleted by other processes from the directory listing
+
+        Returns:
+        Names of the files that were not indexed
+        """
+        added = set()
+        present = set()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            present.add(entry.name)
+
+            run_id = ActivityLogArchive.run_id_from_name(entry.name)
+            run = self._runs.setdefault(run_id, {"updated" : 0.0, "files" : {}})
+            if entry.name not in run["files"]:
+                run["files"][entry.name] = 0
+                added.add(entry.name)
+
+        for run_id in list(self._runs):
+            files = self._runs[run_id]["files"]
+            for name in [name for name in files if name not in present]:
+                del files[name]
+            if not files:
+                del self._runs[run_id]
+        return added
+
+    def _refresh_sizes(self, written_names:typing.Set[str]) -> None:
+        """
+        Sizes and last write of the indexed files that may have changed from the file
+        system, vanished files are dropped. Those are the files of runs that did not
+        complete and written_names (written by this process or newly listed). Files a
+        completed run gets later are registered by their writer, whose pass refreshes them.
+        """
+        for run_id in list(self._runs):
+            run = self._runs[run_id]
+            for name in list(run["files"]):
+                if run.get("completed") and name not in written_names:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    del run["files"][name]
+                    continue
+                run["files"][name] = stat.st_size
+                if not name.endswith(ActivityLogArchive.COMPRESSED_EXTENSION):
+                    run["updated"] = max(run["updated"], stat.st_mtime)
+            if not run["files"]:
+                del self._runs[run_id]
+
+    def _save(self) -> None:
+        """
+        Write the index, called with the index locked. It is written in place so
+        the directory's modification time only changes when files come or go.
+        """
+        if not os.path.exists(self.index_path):
+            open(self.index_path, "a").close()
+        directory_mtime = os.stat(self.directory).st_mtime_ns
+        with open(self.index_path, "w") as index_file:
+            json.dump({"runs" : self._runs, "directory_mtime" : directory_mtime}, index_file)
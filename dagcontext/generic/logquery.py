@@ -0,0 +1,175 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import gzip
+import json
+import os
+import typing
+from datetime import datetime
+from dagcontext.generic.activelog import ActivityLog
+from dagcontext.generic.logarchive import ActivityLogArchive
+
+
+class ActivityLogQuery:
+    """
+    Reads back structured (ActivityLog.FORMAT_JSONL) activity logs.
+
+    Each run has a <run_id>_activity.jsonl log and a <run_id>_activity.idx sidecar
+    in which every written block is described by its byte range, time range and
+    the count of records per level. Queries consult the sidecar first and only
+    read the blocks that can contain a match, runs without a matching block are
+    not opened at all.
+
+    Compressed runs (.jsonl.gz) can only be streamed, the sidecar still decides
+    whether the run has to be read.
+
+    Usage:
+        query = ActivityLogQuery("/tmp/example/activity_log")
+        errors = list(query.errors("run_x"))
+        window = list(query.between(start, end))
+    """
+    def __init__(self, directory:str):
+        """
+        Constructor
+
+        Parameters:
+        directory: The activity log directory (TEMP_DIRECTORY/activity_log)
+        """
+        self.directory = directory
+
+    def runs(self) -> typing.List[str]:
+        """
+        Run ids that have a structured log in the directory.
+        """
+        return_value = set()
+        if os.path.exists(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(ActivityLog.INDEX_EXTENSION):
+                    return_value.add(ActivityLogArchive.run_id_from_name(name))
+        return sorted(return_value)
+
+    def errors(self, run_id:str = None, **fields) -> typing.Iterator[dict]:
+        """
+        All ERROR records for a run, or every run when run_id is None.
+        """
+        return self.query(run_id=run_id, level="ERROR", fields=fields)
+
+    def between(self, start, end, run_id:str = None, level:str = None) -> typing.Iterator[dict]:
+        """
+        All records with start <= ts <= end. Bounds may be datetimes or epoch seconds.
+        """
+        return self.query(run_id=run_id, level=level, start=start, end=end)
+
+    def query(self,
+        run_id:str = None,
+        level:str = None,
+        start = None,
+        end = None,
+        task:str = None,
+        fields:dict = None) -> typing.Iterator[dict]:
+        """
+        Generic query, every criteria is optional.
+
+        Parameters:
+        run_id: Limit to a single run
+        level: Record level, i.e. INFO, WARN, ERROR
+        start: Lower time bound, datetime or epoch seconds
+        end: Upper time bound, datetime or epoch seconds
+        task: Airflow task id that produced the record
+        fields: Values that must be present in the record fields
+
+        Returns:
+        Generator of matching records in file order
+        """
+        start = ActivityLogQuery._to_epoch(start)
+        end = ActivityLogQuery._to_epoch(end)
+
+        run_ids = [run_id] if run_id else self.runs()
+        for current_run in run_ids:
+            blocks = [
+                block for block in self._read_index(current_run)
+                if ActivityLogQuery._block_matches(block, level, start, end)
+            ]
+            if not blocks:
+                continue
+
+            for record in self._read_blocks(current_run, blocks):
+                if level and record["level"] != level:
+                    continue
+                if start is not None and record["ts"] < start:
+                    continue
+                if end is not None and record["ts"] > end:
+                    continue
+                if task and record["task"] != task:
+                    continue
+                if fields and any(record["fields"].get(key) != value for key, value in fields.items()):
+                    continue
+                yield record
+
+    def _file_base(self, run_id:str) -> str:
+        return os.path.join(self.directory, "{}_activity".format(run_id))
+
+    def _read_index(self, run_id:str) -> typing.List[dict]:
+        """
+        Load the sidecar index of a run, missing or damaged lines are skipped.
+
+        When the archive compresses the log it appends a {"compressed": true}
+        marker, every block before the last marker now lives in the .gz file and
+        is flagged as such.
+        """
+        blocks = []
+        index_path = self._file_base(run_id) + ActivityLog.INDEX_EXTENSION
+        if os.path.exists(index_path):
+            with open(index_path, "r") as index_file:
+                for line in index_file:
+                    try:
+                        block = json.loads(line)
+                    except ValueError:
+                        # Partial line from a writer that has not finished
+                        continue
+
+                    if "offset" in block:
+                        blocks.append(block)
+                    elif block.get("compressed"):
+                        for previous in blocks:
+                            previous["compressed"] = True
+        return blocks
+
+    def _read_blocks(self, run_id:str, blocks:typing.List[dict]) -> typing.Iterator[dict]:
+        """
+        Stream the compressed part of the run, if any, then read only the byte
+        ranges in blocks that belong to the live log.
+        """
+        log_path = self._file_base(run_id) + ActivityLog.JSONL_EXTENSION
+
+        compressed_path = log_path + ActivityLogArchive.COMPRESSED_EXTENSION
+        if any(block.get("compressed") for block in blocks) and os.path.exists(compressed_path):
+            with gzip.open(compressed_path, "rb") as log_file:
+                for line in log_file:
+                    yield json.loads(line)
+
+        live_blocks = [block for block in blocks if not block.get("compressed")]
+        if live_blocks and os.path.exists(log_path):
+            with open(log_path, "rb") as log_file:
+                for block in live_blocks:
+                    log_file.seek(block["offset"])
+                    content = log_file.read(block["length"])
+                    for line in content.splitlines():
+                        yield json.loads(line)
+
+    @staticmethod
+    def _block_matches(block:dict, level:str, start:float, end:float) -> bool:
+        if level and not block["levels"].get(level):
+            return False
+        if start is not None and block["ts_max"] < start:
+            return False
+        if end is not None and block["ts_min"] > end:
+            return False
+        return True
+
+    @staticmethod
+    def _to_epoch(value) -> typing.Optional[float]:
+        if isinstance(value, datetime):
+            return value.timestamp()
+        return value
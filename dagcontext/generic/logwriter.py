@@ -0,0 +1,179 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import atexit
+import os
+import queue
+import threading
+import time
+import typing
+
+
+class ActivityLogWriter:
+    """
+    Background writer used by the ActivityLog so that logging calls do not pay for
+    file I/O on the calling thread.
+
+    Calls to write() put lines on a queue. A daemon thread drains the queue, batches
+    the lines per output file and hands each batch to the sink when:
+        - The number of pending lines reaches flush_size
+        - flush_interval seconds have passed since the last flush
+        - flush() is called explicitly (task exit, errors)
+        - The interpreter exits
+
+    The maintenance callable, if any, is run after a flush but at most once per
+    flush_interval window.
+    """
+
+    # Marker put on the queue to request a flush, paired with an Event to signal
+    _FLUSH = "__flush__"
+
+    def __init__(self,
+        sink:typing.Callable[[str, typing.List[str]], None],
+        flush_size:int = 500,
+        flush_interval:float = 2.0,
+        maintenance:typing.Callable[[], None] = None):
+        """
+        Constructor
+
+        Parameters:
+        sink: Callable(file_path, lines) that performs the actual write of a batch
+        flush_size: Number of pending lines that forces a flush
+        flush_interval: Maximum number of seconds lines are held before a flush
+        maintenance: Optional callable to run at most once per flush window
+        """
+        self.sink = sink
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.maintenance = maintenance
+
+        self._lock = threading.Lock()
+        self._queue:queue.Queue = None
+        self._thread:threading.Thread = None
+        self._pid = None
+        self._last_maintenance = 0.0
+
+        atexit.register(self.close)
+
+    def write(self, file_path:str, lines:typing.List[str]) -> None:
+        """
+        Queue lines to be written to file_path by the background thread.
+        """
+        if lines:
+            self._ensure_running()
+            self._queue.put((file_path, lines))
+
+    def flush(self, timeout:float = None) -> bool:
+        """
+        Block until every line queued before this call has been handed to the sink.
+
+        Parameters:
+        timeout: Seconds to wait, None to wait until complete
+
+        Returns:
+        True if the flush completed in the time allowed
+        """
+        if not self._is_running():
+            return True
+
+        flushed = threading.Event()
+        self._queue.put((ActivityLogWriter._FLUSH, flushed))
+        return flushed.wait(timeout)
+
+    def close(self) -> None:
+        """
+        Flush outstanding lines and stop the background thread.
+        """
+        if self._is_running():
+            self._queue.put((None, None))
+            self._thread.join()
+        self._thread = None
+
+    def _is_running(self) -> bool:
+        """
+        Thread is only valid in the process that started it. After a fork the child
+        gets a copy of the queue but no thread to drain it.
+        """
+        return (self._thread is not None
+            and self._pid == os.getpid()
+            and self._thread.is_alive())
+
+    def _ensure_running(self) -> None:
+        """
+        Start the background thread if this process does not have one yet.
+        """
+        if self._is_running():
+            return
+
+        with self._lock:
+            if not self._is_running():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="ActivityLogWriter",
+                    daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        """
+        Thread body, drain the queue and flush batches based on size and time.
+        """
+        pending:typing.Dict[str, typing.List[str]] = {}
+        pending_count = 0
+        last_flush = time.monotonic()
+
+        while True:
+            # Nothing to flush, sleep until lines or a request arrive
+            wait_time = None
+            if pending:
+                wait_time = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                file_path, payload = self._queue.get(timeout=wait_time)
+            except queue.Empty:
+                file_path, payload = ActivityLogWriter._FLUSH, None
+
+            stop = file_path is None
+            if file_path not in (None, ActivityLogWriter._FLUSH):
+                if not pending:
+                    # The interval runs from the first line of a batch, not from the
+                    # last flush, after an idle spell that is long past
+                    last_flush = time.monotonic()
+                pending.setdefault(file_path, []).extend(payload)
+                pending_count += len(payload)
+                # A steadily fed queue never times out, so the interval is checked here too
+                if pending_count < self.flush_size and time.monotonic() - last_flush < self.flush_interval:
+                    continue
+
+            self._flush_pending(pending)
+            pending = {}
+            pending_count = 0
+            last_flush = time.monotonic()
+
+            if isinstance(payload, threading.Event):
+                payload.set()
+
+            if stop:
+                break
+
+    def _flush_pending(self, pending:typing.Dict[str, typing.List[str]]) -> None:
+        """
+        Hand every batch to the sink then run maintenance if the window allows it.
+        Errors are reported but never allowed to kill the thread.
+        """
+        for file_path, lines in pending.items():
+            try:
+                self.sink(file_path, lines)
+            except Exception as ex:  # pylint: disable=broad-except
+                print("ActivityLogWriter failed to write {}: {}".format(file_path, ex))
+
+        if self.maintenance and pending:
+            now = time.monotonic()
+            if now - self._last_maintenance >= self.flush_interval:
+                self._last_maintenance = now
+                try:
+                    self.maintenance()
+                except Exception as ex:  # pylint: disable=broad-except
+                    print("ActivityLogWriter maintenance failed: {}".format(ex))
@@ -0,0 +1,184 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import os
+import re
+import struct
+import threading
+import time
+import typing
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows has no fcntl, limits are then per process
+    fcntl = None
+
+
+class RateLimiter:
+    """
+    Token bucket per endpoint shared by every process on the node, so concurrent DAG
+    runs together stay under a service limit instead of each of them being throttled.
+
+    The bucket of an endpoint lives in RATE_LIMIT_DIRECTORY/<endpoint>.bucket, a 24 byte
+    state (tokens, last refill, blocked until) read and written under an exclusive
+    flock. DagContext points RATE_LIMIT_DIRECTORY at TEMP_DIRECTORY/rate_limit, until
+    then (or without fcntl) the buckets are per process.
+
+    Endpoints are keyed by host name. LIMITS holds (requests per second, burst) for
+    known endpoints, everything else gets DEFAULT_RATE and DEFAULT_BURST. When a service
+    answers 429, backoff() blocks the bucket for every process until Retry-After passed.
+    """
+    RATE_LIMIT_DIRECTORY:typing.Optional[str] = None
+
+    DEFAULT_RATE = 10.0
+    DEFAULT_BURST = 20.0
+    LIMITS:typing.Dict[str, typing.Tuple[float, float]] = {}
+
+    # Seconds to back off on a 429 without Retry-After
+    DEFAULT_BACKOFF = 5.0
+
+    BUCKET_EXTENSION = ".bucket"
+
+    _STATE = struct.Struct("ddd")
+    _limiters:typing.Dict[str, "RateLimiter"] = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self, key:str, rate:float, burst:float):
+        """
+        Constructor, use for_url or for_key to share limiters in the process.
+
+        Parameters:
+        key: Endpoint name
+        rate: Tokens added per second
+        burst: Most tokens the bucket holds
+        """
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        # In process state when there is no shared directory
+        self._state = (burst, time.time(), 0.0)
+        self._descriptor:typing.Optional[int] = None
+        self._descriptor_owner:typing.Optional[tuple] = None
+
+    @staticmethod
+    def for_url(url:str) -> "RateLimiter":
+        """Limiter of the host a URL points to"""
+        return RateLimiter.for_key(urlsplit(url).netloc or url)
+
+    @staticmethod
+    def for_key(key:str) -> "RateLimiter":
+        """Limiter of an endpoint, one instance per process"""
+        with RateLimiter._limiters_lock:
+            limiter = RateLimiter._limiters.get(key)
+            if limiter is None:
+                rate, burst = RateLimiter.LIMITS.get(key, (RateLimiter.DEFAULT_RATE, RateLimiter.DEFAULT_BURST))
+                limiter = RateLimiter(key, rate, burst)
+                RateLimiter._limiters[key] = limiter
+            return limiter
+
+    def acquire(self, timeout:float = None) -> bool:
+        """
+        Take a token, waiting for one to become available.
+
+        Parameters:
+        timeout: Most seconds to wait, None to wait as long as needed
+
+        Returns:
+        True if a token was taken, False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self._update(lambda state, now: RateLimiter._take(state, now, self.rate, self.burst))
+            if wait <= 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def backoff(self, seconds:float = None) -> None:
+        """
+        Block the endpoint for every process, call when the service throttled a request.
+
+        Parameters:
+        seconds: Retry-After of the response, DEFAULT_BACKOFF when None
+        """
+        until = time.time() + (RateLimiter.DEFAULT_BACKOFF if seconds is None else seconds)
+
+        def block(state, now):
+            tokens, updated, blocked = state
+            return (0.0, now, max(blocked, until)), 0.0
+
+        self._update(block)
+
+    @staticmethod
+    def retry_after(headers:typing.Mapping[str, str]) -> typing.Optional[float]:
+        """Seconds from a Retry-After header, None when missing or a date"""
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _take(state:tuple, now:float, rate:float, burst:float) -> typing.Tuple[tuple, float]:
+        """
+        Refill the bucket and take a token.
+
+        Returns:
+        (new state, seconds to wait before trying again or 0 when a token was taken)
+        """
+        tokens, updated, blocked = state
+        if now < blocked:
+            return (tokens, updated, blocked), blocked - now
+
+        tokens = min(burst, tokens + max(0.0, now - max(updated, blocked)) * rate)
+        if tokens >= 1.0:
+            return (tokens - 1.0, now, blocked), 0.0
+        return (tokens, now, blocked), (1.0 - tokens) / rate
+
+    def _update(self, change:typing.Callable[[tuple, float], typing.Tuple[tuple, float]]) -> float:
+        """Apply change to the bucket state, shared through the bucket file when possible"""
+        with self._lock:
+            descriptor = self._open()
+            if descriptor is None:
+                self._state, return_value = change(self._state, time.time())
+                return return_value
+
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            try:
+                raw = os.pread(descriptor, RateLimiter._STATE.size, 0)
+                state = RateLimiter._STATE.unpack(raw) if len(raw) == RateLimiter._STATE.size else (self.burst, time.time(), 0.0)
+                state, return_value = change(state, time.time())
+                os.pwrite(descriptor, RateLimiter._STATE.pack(*state), 0)
+            finally:
+                fcntl.flock(descriptor, fcntl.LOCK_UN)
+            return return_value
+
+    def _open(self) -> typing.Optional[int]:
+        """
+        Descriptor of the bucket file, reopened after a fork or when the directory
+        changed. None when buckets are per process.
+        """
+        directory = RateLimiter.RATE_LIMIT_DIRECTORY
+        if fcntl is None or not directory:
+            return None
+
+        owner = (os.getpid(), directory)
+        if self._descriptor is not None and self._descriptor_owner != owner:
+            # A forked child shares the open file (and its lock) with the parent
+            os.close(self._descriptor)
+            self._descriptor = None
+
+        if self._descriptor is None:
+            os.makedirs(directory, exist_ok=True)
+            name = re.sub(r"[^A-Za-z0-9_.-]", "_", self.key) + RateLimiter.BUCKET_EXTENSION
+            self._descriptor = os.open(os.path.join(directory, name), os.O_RDWR | os.O_CREAT, 0o644)
+            self._descriptor_owner = owner
+
+        return self._descriptor
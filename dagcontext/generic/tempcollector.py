@@ -0,0 +1,411 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import os
+import time
+import typing
+from dagcontext.configurations.config_snapshot import ResolvedConfigSnapshot
+from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.xcom_channels import XCOM_CHANNELS
+from dagcontext.generic.logarchive import ActivityLogArchive
+from dagcontext.generic.warmregistry import WarmRegistry
+
+
+class TempCollector:
+    """
+    Removes what crashed or forgetful runs leave behind in TEMP_DIRECTORY, the tasks
+    clearing their own files (xcom_persist_clear, abandon, ...) is then an optimization
+    instead of a requirement.
+
+    An index file (TEMP_DIRECTORY/.temp_index.json) holds every file of the managed
+    categories with its size, modification time and owning run. A category directory
+    is only listed again when its modification time changed, so a collection on a
+    quiet node reads a single file.
+
+    Each category has a budget (CATEGORY_BUDGETS):
+        - max_age: Seconds after its last modification a file is removed
+        - max_bytes: Total size of the category, oldest files are removed first
+
+    Persisted XCOM channels declaring a retention (see XCOM_CHANNELS) are removed
+    after that retention instead of the max_age of the XCOM category.
+
+    Files of active runs are never removed. Every task of a run touches the run marker
+    TEMP_DIRECTORY/runs/<run_id> (mark_run) and the last task removes it (clear_run),
+    a run is active while its marker exists and is younger than RUN_MAX_AGE, so runs
+    waiting on a sensor or a retry delay keep their files. Runs of older tasks without
+    a marker count as active while any of their files was modified in the last
+    ACTIVE_WINDOW seconds, files that cannot be tied to a run are kept for
+    ACTIVE_WINDOW seconds. Markers of runs that never completed expire after RUN_MAX_AGE.
+
+    DagContext calls collect_if_due() when it is constructed, which collects at most
+    every COLLECT_INTERVAL seconds and for at most TIME_SLICE seconds. A directory
+    too large to list within the slice is listed over several collections, the
+    entries already indexed are kept in the index and skipped. To collect from cron
+    or a maintenance DAG:
+
+        python -m dagcontext.generic.tempcollector <temp_directory> [--dry-run]
+    """
+    INDEX_FILE = ".temp_index.json"
+    INDEX_VERSION = 1
+
+    # category : (max_age seconds, max_bytes), None for no budget
+    CATEGORY_BUDGETS:typing.Dict[str, typing.Tuple[typing.Optional[float], typing.Optional[int]]] = {
+        Constants.XCOM_PERSIST.XCOM_PERSIST_PATH : (24 * 60 * 60, 1024 * 1024 * 1024),
+        Constants.XCOM_PERSIST.INFLIGHT_PERSIST_PATH : (24 * 60 * 60, None),
+        Constants.XCOM_PERSIST.CHECKPOINT_PERSIST_PATH : (3 * 24 * 60 * 60, 1024 * 1024 * 1024),
+        Constants.XCOM_PERSIST.RESOLVED_CONFIG_PERSIST_PATH : (24 * 60 * 60, None),
+        Constants.XCOM_PERSIST.CONTEXT_SNAPSHOT_PERSIST_PATH : (24 * 60 * 60, None),
+        # Sizes and compression are managed by ActivityLogArchive
+        Constants.LOG.ACTIVITY_LOG_DIRECTORY : (7 * 24 * 60 * 60, None),
+        # Buckets of endpoints no longer called
+        Constants.XCOM_PERSIST.RATE_LIMIT_PERSIST_PATH : (7 * 24 * 60 * 60, None),
+        # Payloads and results of runs that timed out waiting on a micro batch
+        os.path.join(Constants.XCOM_PERSIST.MICROBATCH_PERSIST_PATH, "pending") : (24 * 60 * 60, None),
+        os.path.join(Constants.XCOM_PERSIST.MICROBATCH_PERSIST_PATH, "batches") : (24 * 60 * 60, None),
+        os.path.join(Constants.XCOM_PERSIST.MICROBATCH_PERSIST_PATH, "results") : (24 * 60 * 60, None),
+        # Markers of runs that never completed
+        Constants.XCOM_PERSIST.RUN_MARKER_PERSIST_PATH : (3 * 24 * 60 * 60, None),
+    }
+
+    ACTIVE_WINDOW = 60 * 60
+    RUN_MAX_AGE = 3 * 24 * 60 * 60
+    COLLECT_INTERVAL = 10 * 60
+    TIME_SLICE = 0.25
+
+    # Bookkeeping files of other components
+    IGNORED_FILES = (INDEX_FILE, ActivityLogArchive.INDEX_FILE, ActivityLogArchive.LOCK_FILE)
+
+    # Index entry fields
+    SIZE = 0
+    MTIME = 1
+    RUN = 2
+
+    def __init__(self, temp_directory:str, dry_run:bool = False):
+        """
+        Constructor
+
+        Parameters:
+        temp_directory: TEMP_DIRECTORY of the DAG
+        dry_run: Report what would be removed without removing it
+        """
+        self.temp_directory = temp_directory
+        self.dry_run = dry_run
+        self.index_path = os.path.join(temp_directory, TempCollector.INDEX_FILE)
+        self.removed:typing.List[str] = []
+        # Categories files were removed from
+        self._changed:typing.Set[str] = set()
+
+    @staticmethod
+    def collect_if_due(temp_directory:str, active_run:str = None) -> int:
+        """
+        Collect when the last collection is older than COLLECT_INTERVAL, within TIME_SLICE.
+
+        Returns:
+        Number of files removed
+        """
+        try:
+            last = os.stat(os.path.join(temp_directory, TempCollector.INDEX_FILE)).st_mtime
+        except FileNotFoundError:
+            last = 0
+        if time.time() - last < TempCollector.COLLECT_INTERVAL:
+            return 0
+        return TempCollector(temp_directory).collect(active_run, TempCollector.TIME_SLICE)
+
+    @staticmethod
+    def mark_run(temp_directory:str, run_id:str) -> None:
+        """Create or touch the marker that keeps the files of a run, call from every task"""
+        directory = WarmRegistry.ensure_directory(os.path.join(temp_directory, Constants.XCOM_PERSIST.RUN_MARKER_PERSIST_PATH))
+        marker = os.path.join(directory, TempCollector._marker_name(run_id))
+        try:
+            os.utime(marker)
+        except FileNotFoundError:
+            os.close(os.open(marker, os.O_WRONLY | os.O_CREAT, 0o644))
+
+    @staticmethod
+    def clear_run(temp_directory:str, run_id:str) -> bool:
+        """Remove the marker of a completed run, returns True if one was removed"""
+        try:
+            os.remove(os.path.join(temp_directory, Constants.XCOM_PERSIST.RUN_MARKER_PERSIST_PATH, TempCollector._marker_name(run_id)))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def collect(self, active_run:str = None, time_slice:float = None) -> int:
+        """
+        Enforce the category budgets.
+
+        Parameters:
+        active_run: Run id of the caller, its files are kept
+        time_slice: Seconds to spend, None for no limit. Work left over is picked up
+                    by the next collection.
+
+        Returns:
+        Number of files removed
+        """
+        deadline = None if time_slice is None else time.monotonic() + time_slice
+        index = self._load_index()
+        directories = index["directories"]
+
+        for category in TempCollector.CATEGORY_BUDGETS:
+            if not self._refresh(category, index, deadline):
+                # Out of time, the listing resumes with the next collection. Nothing is
+                # removed until every category is indexed, active runs are not known yet
+                self._save_index(index)
+                return len(self.removed)
+
+        active, runs = self._active_runs(directories, active_run)
+        now = time.time()
+
+        for category, (max_age, max_bytes) in TempCollector.CATEGORY_BUDGETS.items():
+            files = directories.get(category, {}).get("files", {})
+            # Oldest first, for the size budget
+            candidates = sorted(
+                (entry[TempCollector.MTIME], name) for name, entry in files.items()
+                if not self._protected(name, entry, active, runs, now)
+            )
+            total = sum(entry[TempCollector.SIZE] for entry in files.values())
+
+            for mtime, name in candidates:
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                file_max_age = self._max_age(category, name, max_age)
+                # Appending to a file does not change the directory, the index can be behind
+                size = files[name][TempCollector.SIZE]
+                mtime = self._restat(category, name, files)
+                if mtime is None:
+                    total -= size
+                    continue
+                if now - mtime < TempCollector.ACTIVE_WINDOW:
+                    continue
+                expired = file_max_age is not None and now - mtime > file_max_age
+                over_size = max_bytes is not None and total > max_bytes
+                if not (expired or over_size):
+                    if category == Constants.XCOM_PERSIST.XCOM_PERSIST_PATH:
+                        # Channels have their own retention, a newer file may be expired
+                        continue
+                    # Everything after this one is newer
+                    break
+                total -= files[name][TempCollector.SIZE]
+                self._remove(category, name)
+                del files[name]
+
+        self._save_index(index)
+        return len(self.removed)
+
+    def _refresh(self, category:str, index:dict, deadline:typing.Optional[float]) -> bool:
+        """
+        Re-list a category directory when it changed since it was indexed.
+
+        Entries listed before the deadline are kept in index["scans"], a listing cut
+        short resumes from them: entries already listed are not stat'ed or read again.
+
+        Returns:
+        False when the deadline passed before the listing completed
+        """
+        directories = index["directories"]
+        scans = index.setdefault("scans", {})
+        category_path = os.path.join(self.temp_directory, category)
+        try:
+            mtime = os.stat(category_path).st_mtime
+        except FileNotFoundError:
+            directories.pop(category, None)
+            scans.pop(category, None)
+            return True
+
+        entry = directories.get(category)
+        if entry is not None and entry["mtime"] == mtime and category not in scans:
+            return True
+
+        known = entry["files"] if entry else {}
+        scanned = scans.setdefault(category, {})
+        listed = set()
+        with os.scandir(category_path) as listing:
+            for item in listing:
+                if item.name in TempCollector.IGNORED_FILES:
+                    continue
+                listed.add(item.name)
+                if item.name in scanned:
+                    continue
+                if deadline is not None and time.monotonic() > deadline:
+                    return False
+                if not item.is_file():
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                previous = known.get(item.name)
+                run_id = previous[TempCollector.RUN] if previous else self._owner(category, item.path, item.name)
+                scanned[item.name] = [stat.st_size, stat.st_mtime, run_id]
+
+        # Complete, drop what was removed since the listing started
+        directories[category] = {
+            "mtime" : mtime,
+            "files" : {name : value for name, value in scanned.items() if name in listed}
+        }
+        del scans[category]
+        return True
+
+    def _owner(self, category:str, path:str, name:str) -> typing.Optional[str]:
+        """Run a file belongs to, None when it cannot be told"""
+        if category == Constants.XCOM_PERSIST.INFLIGHT_PERSIST_PATH:
+            if name.startswith("processing-") and name.endswith(".txt"):
+                return name[len("processing-"):-len(".txt")]
+            # Claimed records hold "timestamp\nrun_id"
+            try:
+                with open(path, "r") as record:
+                    lines = record.read(1024).splitlines()
+                return lines[1] if len(lines) > 1 else None
+            except OSError:
+                return None
+
+        if category == Constants.LOG.ACTIVITY_LOG_DIRECTORY:
+            return ActivityLogArchive.run_id_from_name(name)
+
+        if category == Constants.XCOM_PERSIST.RUN_MARKER_PERSIST_PATH:
+            return name
+
+        if category in (Constants.XCOM_PERSIST.RESOLVED_CONFIG_PERSIST_PATH, Constants.XCOM_PERSIST.CONTEXT_SNAPSHOT_PERSIST_PATH):
+            # <run_id>.<settings key>.json
+            return ResolvedConfigSnapshot.run_id_from_name(name)
+
+        if category.startswith(Constants.XCOM_PERSIST.MICROBATCH_PERSIST_PATH + os.sep):
+            return os.path.splitext(name)[0]
+
+        # <run_id>_<name>, run ids may hold underscores so the owner is matched against
+        # the run ids known from the other categories, see _match
+        return None
+
+    @staticmethod
+    def _max_age(category:str, name:str, max_age:typing.Optional[float]) -> typing.Optional[float]:
+        """Seconds a file is kept, the retention of its XCOM channel when it declares one"""
+        if category == Constants.XCOM_PERSIST.XCOM_PERSIST_PATH:
+            retention = XCOM_CHANNELS.retention_of(name)
+            if retention is not None:
+                return retention
+        return max_age
+
+    @staticmethod
+    def _match(name:str, runs:typing.Set[str]) -> typing.Optional[str]:
+        """Longest run id name starts with followed by an underscore"""
+        return_value = None
+        for run_id in runs:
+            if name.startswith(run_id + "_") and (return_value is None or len(run_id) > len(return_value)):
+                return_value = run_id
+        return return_value
+
+    def _active_runs(self, directories:dict, active_run:str) -> typing.Tuple[typing.Set[str], typing.Set[str]]:
+        """
+        Returns:
+        (runs with a live marker or a file modified within ACTIVE_WINDOW plus active_run,
+        every run id known)
+        """
+        now = time.time()
+        runs = set()
+        recent = []
+        active = set()
+        for category, entry in directories.items():
+            markers = category == Constants.XCOM_PERSIST.RUN_MARKER_PERSIST_PATH
+            for name, (size, mtime, run_id) in entry["files"].items():
+                if run_id:
+                    runs.add(run_id)
+                # Index times can only be behind, a file that looks recent is. One that
+                # looks old is re-stat'ed before it is removed.
+                if now - mtime < (TempCollector.RUN_MAX_AGE if markers else TempCollector.ACTIVE_WINDOW):
+                    if run_id:
+                        active.add(run_id)
+                    else:
+                        recent.append(name)
+        if active_run:
+            runs.add(active_run)
+            active.add(active_run)
+
+        for name in recent:
+            run_id = TempCollector._match(name, runs)
+            if run_id:
+                active.add(run_id)
+        return active, runs
+
+    @staticmethod
+    def _marker_name(run_id:str) -> str:
+        return run_id.replace(os.sep, "_")
+
+    def _protected(self, name:str, entry:list, active:typing.Set[str], runs:typing.Set[str], now:float) -> bool:
+        """True if the file belongs to an active run, files of unknown runs are kept while recent"""
+        run_id = entry[TempCollector.RUN] or TempCollector._match(name, runs)
+        if run_id:
+            return run_id in active
+        return now - entry[TempCollector.MTIME] < TempCollector.ACTIVE_WINDOW
+
+    def _restat(self, category:str, name:str, files:dict) -> typing.Optional[float]:
+        """Refresh the index entry of a file, returns its modification time or None if it is gone"""
+        try:
+            stat = os.stat(os.path.join(self.temp_directory, category, name))
+        except FileNotFoundError:
+            del files[name]
+            return None
+        files[name][TempCollector.SIZE] = stat.st_size
+        files[name][TempCollector.MTIME] = stat.st_mtime
+        return stat.st_mtime
+
+    def _remove(self, category:str, name:str) -> None:
+        path = os.path.join(self.temp_directory, category, name)
+        self.removed.append(path)
+        self._changed.add(category)
+        if not self.dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+            if index.get("version") == TempCollector.INDEX_VERSION:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {"version" : TempCollector.INDEX_VERSION, "directories" : {}}
+
+    def _save_index(self, index:dict) -> None:
+        """Written atomically, its modification time is the time of the last collection"""
+        if self.dry_run:
+            return
+        for category, entry in index["directories"].items():
+            if category not in self._changed:
+                continue
+            # Removing files changed the directory, do not list it again for that
+            try:
+                entry["mtime"] = os.stat(os.path.join(self.temp_directory, category)).st_mtime
+            except FileNotFoundError:
+                pass
+
+        os.makedirs(self.temp_directory, exist_ok=True)
+        temp_path = "{}.{}".format(self.index_path, os.getpid())
+        with open(temp_path, "w") as index_file:
+            json.dump(index, index_file, separators=(",", ":"))
+        os.replace(temp_path, self.index_path)
+
+
+def main():
+    # Only the command line needs it, this module is imported by every task
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Remove expired files from a DAG TEMP_DIRECTORY")
+    parser.add_argument("temp_directory", help="TEMP_DIRECTORY of the DAG")
+    parser.add_argument("--dry-run", action="store_true", help="List what would be removed")
+    parser.add_argument("--time-slice", type=float, default=None, help="Seconds to spend, default no limit")
+    arguments = parser.parse_args()
+
+    collector = TempCollector(arguments.temp_directory, arguments.dry_run)
+    collector.collect(time_slice=arguments.time_slice)
+    for path in collector.removed:
+        print(path)
+    print("{} files {}".format(len(collector.removed), "to remove" if arguments.dry_run else "removed"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import hashlib
+import json
+import os
+import threading
+import time
+import typing
+
+
+class WarmRegistry:
+    """
+    Long lived resources shared by every task a worker process runs. Executors that
+    reuse worker processes (Celery, the LocalExecutor pool) otherwise rebuild them for
+    each task, with the registry the second and later tasks find them ready.
+
+    Resources are kept per kind and key, the key being a hash of the configuration
+    they were built from (see key()), so a change in configuration builds a new one:
+
+        - KIND_TOKENS: Authentication tokens by identity endpoint, until they expire
+        - KIND_SETTINGS: Resolved environment settings of a run
+        - KIND_SESSION: Pooled requests.Session by base URL, see session()
+        - KIND_DIRECTORY: Directories known to exist, see ensure_directory()
+
+    invalidate() drops resources, closing those that can be closed. A forked child
+    drops the resources that must not be shared with its parent (sessions hold the
+    parent's sockets) and gets fresh locks, everything else it keeps.
+
+    Set ENABLED to False to build every resource on each request.
+    """
+    KIND_TOKENS = "tokens"
+    KIND_SETTINGS = "settings"
+    KIND_SESSION = "session"
+    KIND_DIRECTORY = "directory"
+
+    ENABLED = True
+
+    # Seconds a resource of a kind is kept, kinds not listed are kept until invalidated.
+    # Resources that report their own expiry (see get) use that instead.
+    TTL:typing.Dict[str, float] = {
+        KIND_TOKENS : 30 * 60,
+        KIND_SETTINGS : 60 * 60,
+    }
+
+    # Seconds before a reported expiry a resource is dropped, so it is not handed out
+    # just before it stops working
+    EXPIRY_MARGIN = 5 * 60
+
+    # Entry fields
+    VALUE = 0
+    EXPIRES = 1
+    FORK_SAFE = 2
+
+    _entries:typing.Dict[typing.Tuple[str, str], list] = {}
+    _lock = threading.Lock()
+    # One lock per resource being built, so a slow build only blocks its own key
+    _build_locks:typing.Dict[typing.Tuple[str, str], threading.Lock] = {}
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hash of the configuration a resource is built from"""
+        content = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+    @staticmethod
+    def get(kind:str,
+        key:str,
+        factory:typing.Callable[[], typing.Any],
+        fork_safe:bool = True,
+        expires_on:typing.Callable[[typing.Any], typing.Optional[float]] = None,
+        keep:typing.Callable[[typing.Any], bool] = None) -> typing.Any:
+        """
+        Resource of a kind and key, built with factory when missing or expired.
+
+        Parameters:
+        kind: One of the KIND_ values, or any other name
+        key: Configuration hash, see key()
+        factory: Builds the resource, called at most once at a time per key
+        fork_safe: False when a forked child must build its own
+        expires_on: Returns the time (seconds since the epoch) the built resource
+                    expires, it is kept until EXPIRY_MARGIN seconds before. When
+                    missing or it returns None the TTL of the kind applies.
+        keep: Returns False when the built resource must not be kept, i.e. a build
+              that failed without raising. It is returned and the next request
+              builds again.
+
+        Returns:
+        The resource
+
+        Throws:
+        Whatever factory raises, nothing is kept then
+        """
+        if not WarmRegistry.ENABLED:
+            return factory()
+
+        entry_key = (kind, key)
+        value = WarmRegistry._lookup(entry_key)
+        if value is not None:
+            return value
+
+        with WarmRegistry._lock:
+            build_lock = WarmRegistry._build_locks.setdefault(entry_key, threading.Lock())
+
+        try:
+            with build_lock:
+                # Another thread may have built it meanwhile
+                value = WarmRegistry._lookup(entry_key)
+                if value is None:
+                    value = factory()
+                    if keep is not None and not keep(value):
+                        return value
+                    ttl = WarmRegistry._ttl(kind, value, expires_on)
+                    with WarmRegistry._lock:
+                        WarmRegistry._entries[entry_key] = [
+                            value,
+                            None if ttl is None else time.monotonic() + ttl,
+                            fork_safe
+                        ]
+                return value
+        finally:
+            # Threads already waiting keep their reference, later ones find the entry
+            with WarmRegistry._lock:
+                if WarmRegistry._build_locks.get(entry_key) is build_lock:
+                    del WarmRegistry._build_locks[entry_key]
+
+    @staticmethod
+    def invalidate(kind:str = None, key:str = None) -> int:
+        """
+        Drop resources, closing the ones that have a close method.
+
+        Parameters:
+        kind: Kind to drop, None for every kind
+        key: Key to drop, None for every key of the kind
+
+        Returns:
+        Number of resources dropped
+        """
+        with WarmRegistry._lock:
+            dropped = [
+                entry_key for entry_key in WarmRegistry._entries
+                if (kind is None or entry_key[0] == kind) and (key is None or entry_key[1] == key)
+            ]
+            values = [WarmRegistry._entries.pop(entry_key)[WarmRegistry.VALUE] for entry_key in dropped]
+
+        for value in values:
+            WarmRegistry._close(value)
+        return len(values)
+
+    @staticmethod
+    def ensure_directory(path:str) -> str:
+        """
+        Create a directory unless this process already did or saw it. A known
+        directory is only checked with a stat, one removed since (xcom_persist_clear,
+        the TempCollector or an operator) is created again.
+
+        Returns:
+        path
+        """
+        def create():
+            os.makedirs(path, exist_ok=True)
+            return path
+
+        WarmRegistry.get(WarmRegistry.KIND_DIRECTORY, path, create)
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def session(base_url:str, pool_size:int) -> typing.Any:
+        """
+        Pooled requests.Session for a service, shared by the clients of the process
+        so connections stay open between tasks. Not closed by the clients using it.
+
+        Parameters:
+        base_url: Scheme and host of the service
+        pool_size: Connections kept open
+
+        Returns:
+        requests.Session
+        """
+        def create():
+            # Only tasks that talk to a service load requests
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            return_value = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            return_value.mount("https://", adapter)
+            return_value.mount("http://", adapter)
+            return return_value
+
+        return WarmRegistry.get(
+            WarmRegistry.KIND_SESSION,
+            WarmRegistry.key(base_url, pool_size),
+            create,
+            fork_safe=False
+        )
+
+    @staticmethod
+    def _lookup(entry_key:typing.Tuple[str, str]) -> typing.Any:
+        """Value of a live entry, None when missing or expired"""
+        expired = None
+        with WarmRegistry._lock:
+            entry = WarmRegistry._entries.get(entry_key)
+            if entry is None:
+                return None
+            if entry[WarmRegistry.EXPIRES] is not None and entry[WarmRegistry.EXPIRES] <= time.monotonic():
+                expired = WarmRegistry._entries.pop(entry_key)[WarmRegistry.VALUE]
+            else:
+                return entry[WarmRegistry.VALUE]
+
+        WarmRegistry._close(expired)
+        return None
+
+    @staticmethod
+    def _ttl(kind:str, value:typing.Any, expires_on:typing.Callable[[typing.Any], typing.Optional[float]]) -> typing.Optional[float]:
+        """Seconds a built resource is kept, None to keep it until invalidated"""
+        expiry = expires_on(value) if expires_on is not None else None
+        if expiry is not None:
+            return max(0.0, expiry - time.time() - WarmRegistry.EXPIRY_MARGIN)
+        return WarmRegistry.TTL.get(kind)
+
+    @staticmethod
+    def _close(value:typing.Any) -> None:
+        close = getattr(value, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+    @staticmethod
+    def _after_fork() -> None:
+        """
+        In a forked child, locks may have been held by threads that do not exist
+        there and resources that are not fork safe belong to the parent. They are
+        dropped without closing, closing would affect the parent.
+        """
+        WarmRegistry._lock = threading.Lock()
+        WarmRegistry._build_locks = {}
+        WarmRegistry._entries = {
+            entry_key : entry for entry_key, entry in WarmRegistry._entries.items()
+            if entry[WarmRegistry.FORK_SAFE]
+        }
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=WarmRegistry._after_fork)
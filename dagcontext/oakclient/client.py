@@ -0,0 +1,251 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dagcontext.authentication.identityprovider import IdentitySelector
+from dagcontext.configurations.constants import Constants
+from dagcontext.generic.activelog import ActivityLog
+from dagcontext.generic.ratelimit import RateLimiter
+from dagcontext.generic.warmregistry import WarmRegistry
+
+
+class OakClient:
+    """
+    Client for the OSDU/OAK storage, file and search services shared by every record
+    a task processes:
+
+        - One pooled requests.Session, connections are reused across calls, threads and
+          the tasks of the worker process (see WarmRegistry.session)
+        - The OakSystem token and data partition of the DagContext are added to every
+          request, the token is reloaded once when the service answers 401
+        - Storage reads and writes of many records are sent in as few multi-record
+          requests as the API allows
+        - At most max_concurrency requests are in flight, whichever thread sends them
+        - Requests go through the node wide RateLimiter of the host, a 429 backs every
+          run on the node off for Retry-After before the request is sent again
+
+    Build it from a task with OakClient.from_context(dag_context).
+    """
+    # Attempts when the service throttles a request
+    THROTTLE_ATTEMPTS = 5
+
+    def __init__(self,
+        host:str,
+        partition:str,
+        token_provider:typing.Callable[[bool], str],
+        max_concurrency:int = 8,
+        pool_size:int = None,
+        timeout:float = 60.0):
+        """
+        Constructor
+
+        Parameters:
+        host: OAK host name, requests go to https://<host>
+        partition: Data partition id sent with every request
+        token_provider: Returns the bearer token, called with True when the token
+                        was rejected and must be refreshed
+        max_concurrency: Maximum requests in flight
+        pool_size: Connections kept open, defaults to max_concurrency
+        timeout: Seconds to wait on a single request
+        """
+        if not host:
+            raise ValueError("OAK host is required")
+
+        self.base_url = host if host.startswith("http") else "https://{}".format(host)
+        self.base_url = self.base_url.rstrip("/")
+        self.partition = partition
+        self.token_provider = token_provider
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+
+        self._limit = threading.BoundedSemaphore(max_concurrency)
+        self._rate_limiter = RateLimiter.for_url(self.base_url)
+        self._session = WarmRegistry.session(self.base_url, pool_size or max_concurrency)
+
+    @staticmethod
+    def from_context(context, max_concurrency:int = 8, timeout:float = 60.0) -> "OakClient":
+        """
+        Client for the OAK host, data partition and OakSystem token of a DagContext.
+
+        Parameters:
+        context: DagContext of the task
+
+        Returns:
+        OakClient
+        """
+        # Deferred, dagcontext.context imports nothing from this package
+        from dagcontext.context.dagcontext import PropertyClass
+
+        def token_provider(refresh:bool) -> str:
+            if refresh:
+                context.reset_authentication_tokens()
+            return context.get_authentication_token(IdentitySelector.OakSystem)
+
+        return OakClient(
+            context.get_value(PropertyClass.Environment, Constants.OAK_IDENTITY.OAK_HOST),
+            context.get_value(PropertyClass.AirflowContext, Constants.AIRFLOW_EX_CTX.SYSTEM_PARTITION_ID),
+            token_provider,
+            max_concurrency,
+            timeout=timeout
+        )
+
+    def close(self) -> None:
+        """The session stays open for the next client, WarmRegistry.invalidate closes it"""
+        self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Storage
+
+    def get_record(self, record_id:str) -> dict:
+        """Latest version of a storage record"""
+        return self.request("GET", Constants.OAK_API.STORAGE_RECORD.format(record_id=record_id))
+
+    def get_records(self, record_ids:typing.List[str]) -> typing.List[dict]:
+        """
+        Latest version of many storage records, read STORAGE_QUERY_BATCH records per
+        request and the requests sent concurrently.
+
+        Returns:
+        The records found, ids the service did not return are logged
+        """
+        batches = OakClient.batches(record_ids, Constants.OAK_API.STORAGE_QUERY_BATCH)
+        responses = self.map(
+            lambda batch: self.request("POST", Constants.OAK_API.STORAGE_QUERY_RECORDS, {"records" : batch}),
+            batches
+        )
+
+        return_value = []
+        for response in responses:
+            return_value.extend(response.get("records", []))
+            if response.get("invalidRecords") or response.get("retryRecords"):
+                ActivityLog.log_warning(
+                    "Storage records not returned",
+                    response.get("invalidRecords", []) + response.get("retryRecords", []))
+        return return_value
+
+    def put_records(self, records:typing.List[dict]) -> typing.List[str]:
+        """
+        Create or update storage records, STORAGE_PUT_BATCH records per request.
+
+        Returns:
+        Ids of the records written
+        """
+        return_value = []
+        for batch in OakClient.batches(records, Constants.OAK_API.STORAGE_PUT_BATCH):
+            response = self.request("PUT", Constants.OAK_API.STORAGE_RECORDS, batch)
+            return_value.extend(response.get("recordIds", []))
+        return return_value
+
+    # File
+
+    def get_file_metadata(self, file_id:str) -> dict:
+        return self.request("GET", Constants.OAK_API.FILE_METADATA.format(file_id=file_id))
+
+    def get_download_url(self, file_id:str) -> str:
+        """Signed URL to download the file content"""
+        response = self.request("GET", Constants.OAK_API.FILE_DOWNLOAD_URL.format(file_id=file_id))
+        return response.get("SignedUrl")
+
+    def get_files_metadata(self, file_ids:typing.List[str]) -> typing.List[dict]:
+        """Metadata of many files, the file service has no multi-record call so they are read concurrently"""
+        return self.map(self.get_file_metadata, file_ids)
+
+    # Search
+
+    def search(self, kind:str, query:str = None, limit:int = None, returned_fields:typing.List[str] = None) -> dict:
+        """Single search request, the raw response"""
+        return self.request("POST", Constants.OAK_API.SEARCH_QUERY, OakClient._search_body(kind, query, limit, returned_fields))
+
+    def search_all(self, kind:str, query:str = None, returned_fields:typing.List[str] = None) -> typing.Iterator[dict]:
+        """Every result of a search, paged with the search cursor"""
+        body = OakClient._search_body(kind, query, Constants.OAK_API.SEARCH_PAGE_SIZE, returned_fields)
+        while True:
+            response = self.request("POST", Constants.OAK_API.SEARCH_QUERY_CURSOR, body)
+            results = response.get("results", [])
+            yield from results
+            if not results or not response.get("cursor"):
+                break
+            body["cursor"] = response["cursor"]
+
+    # Plumbing
+
+    def map(self, function:typing.Callable[[typing.Any], typing.Any], items:typing.List[typing.Any]) -> typing.List[typing.Any]:
+        """
+        Call function for every item on max_concurrency threads.
+
+        Returns:
+        The results in the order of items
+
+        Throws:
+        The first exception raised by function
+        """
+        items = list(items)
+        if len(items) < 2:
+            return [function(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as pool:
+            return list(pool.map(function, items))
+
+    def request(self, method:str, path:str, body:typing.Any = None) -> typing.Any:
+        """
+        Send a request with the token and partition headers.
+
+        Parameters:
+        method: HTTP method
+        path: Path relative to the host, or a full URL
+        body: JSON body
+
+        Returns:
+        The JSON response, None when the response is empty
+
+        Throws:
+        requests.HTTPError when the service answers with an error
+        """
+        url = path if path.startswith("http") else self.base_url + path
+
+        response = self._send(method, url, body, self.token_provider(False))
+        if response.status_code == 401:
+            # Token expired during the task
+            response = self._send(method, url, body, self.token_provider(True))
+
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    def _send(self, method:str, url:str, body:typing.Any, token:str):
+        headers = {
+            "Authorization" : "Bearer {}".format(token),
+            Constants.OAK_API.PARTITION_HEADER : self.partition
+        }
+        with self._limit:
+            for _ in range(OakClient.THROTTLE_ATTEMPTS):
+                self._rate_limiter.acquire()
+                response = self._session.request(method, url, json=body, headers=headers, timeout=self.timeout)
+                if response.status_code != 429:
+                    break
+                self._rate_limiter.backoff(RateLimiter.retry_after(response.headers))
+            return response
+
+    @staticmethod
+    def batches(items:typing.List[typing.Any], size:int) -> typing.List[typing.List[typing.Any]]:
+        """Split items into lists of at most size items"""
+        items = list(items)
+        return [items[start:start + size] for start in range(0, len(items), size)]
+
+    @staticmethod
+    def _search_body(kind:str, query:str, limit:int, returned_fields:typing.List[str]) -> dict:
+        body = {"kind" : kind}
+        if query:
+            body["query"] = query
+        if limit:
+            body["limit"] = limit
+        if returned_fields:
+            body["returnedFields"] = returned_fields
+        return body
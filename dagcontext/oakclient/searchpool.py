@@ -0,0 +1,242 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import json
+import threading
+import time
+import typing
+from dagcontext.configurations.constants import Constants
+from dagcontext.generic.activelog import ActivityLog
+from dagcontext.generic.ratelimit import RateLimiter
+from dagcontext.generic.warmregistry import WarmRegistry
+
+
+class SearchInstance:
+    """
+    One search instance of the pool with its own connection pool and health.
+
+    url: Base URL of the instance
+    api_key: Key sent in the api-key header
+    outstanding: Requests currently in flight
+    latency: Moving average of the response time in seconds
+    failures: Consecutive failed requests
+    ejected_until: Time the instance may be tried again after being taken out
+    """
+    def __init__(self, url:str, api_key:str, pool_size:int):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.outstanding = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+        # Shared with later pools of the process, see WarmRegistry.session
+        self.session = WarmRegistry.session(self.url, pool_size)
+
+    def __repr__(self):
+        return "SearchInstance({}, outstanding={}, latency={:.3f}, failures={})".format(
+            self.url, self.outstanding, self.latency, self.failures)
+
+
+class SearchInstancePool:
+    """
+    Spreads search traffic over the instances in the km_search_instances Airflow
+    variable (Constants.AIRFLOW_VARS.COGSRCH_SEARCH_INSTANCES).
+
+    Each request goes to the healthy instance with the fewest requests in flight
+    (STRATEGY_LEAST_OUTSTANDING) or the lowest expected wait, moving average latency
+    times requests in flight (STRATEGY_LATENCY). An instance that fails (connection
+    error, 5xx or 429) failure_threshold times in a row is taken out for eject_seconds,
+    doubling on each ejection up to max_eject_seconds. Once that time passed it gets
+    requests again, its first success reinstates it and its first failure takes it
+    out again. A failed request is retried on another instance.
+
+    The variable is a list of instances, each either a URL or service name, or
+    a dictionary with a url (or name) and an api_key.
+    """
+    STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+    STRATEGY_LATENCY = "latency"
+
+    API_VERSION = "2020-06-30"
+    SEARCH_PATH = "/indexes/{index}/docs/search?api-version={api_version}"
+    SERVICE_URL = "https://{name}.search.windows.net"
+
+    # Weight of the newest response time in the latency average
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self,
+        instances:typing.List[typing.Any],
+        strategy:str = STRATEGY_LEAST_OUTSTANDING,
+        pool_size:int = 8,
+        failure_threshold:int = 3,
+        eject_seconds:float = 30.0,
+        max_eject_seconds:float = 300.0,
+        timeout:float = 30.0):
+        """
+        Constructor
+
+        Parameters:
+        instances: Instance definitions, see the class
+        strategy: STRATEGY_LEAST_OUTSTANDING or STRATEGY_LATENCY
+        pool_size: Connections kept open per instance
+        failure_threshold: Consecutive failures that take an instance out
+        eject_seconds: First time an instance is out
+        max_eject_seconds: Longest time an instance is out
+        timeout: Seconds to wait on a single request
+
+        Throws:
+        ValueError if there are no instances or the strategy is not supported
+        """
+        if strategy not in (SearchInstancePool.STRATEGY_LEAST_OUTSTANDING, SearchInstancePool.STRATEGY_LATENCY):
+            raise ValueError("Unsupported balancing strategy: {}".format(strategy))
+
+        self.instances = [SearchInstancePool._instance(definition, pool_size) for definition in instances or []]
+        if not self.instances:
+            raise ValueError("At least one search instance is required")
+
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_context(context, **settings) -> "SearchInstancePool":
+        """
+        Pool of the instances in the km_search_instances setting of a DagContext,
+        settings are passed to the constructor.
+        """
+        # Deferred, dagcontext.context imports nothing from this package
+        from dagcontext.context.dagcontext import PropertyClass
+
+        instances = context.get_value(PropertyClass.Environment, Constants.AIRFLOW_VARS.COGSRCH_SEARCH_INSTANCES)
+        if isinstance(instances, str):
+            instances = json.loads(instances)
+        if isinstance(instances, dict):
+            instances = [instances]
+        return SearchInstancePool(instances, **settings)
+
+    def close(self) -> None:
+        """The sessions stay open for the next pool, WarmRegistry.invalidate closes them"""
+        for instance in self.instances:
+            instance.session = None
+
+    def search(self, index:str, body:dict) -> dict:
+        """
+        Search an index on the best instance.
+
+        Parameters:
+        index: Index name
+        body: Search request body
+
+        Returns:
+        The JSON response
+        """
+        path = SearchInstancePool.SEARCH_PATH.format(index=index, api_version=SearchInstancePool.API_VERSION)
+        return self.request("POST", path, body)
+
+    def request(self, method:str, path:str, body:typing.Any = None) -> typing.Any:
+        """
+        Send a request to the best instance, retrying on the others when it fails.
+
+        Returns:
+        The JSON response, None when the response is empty
+
+        Throws:
+        The error of the last instance tried when every attempt failed
+        """
+        last_error = None
+        tried = set()
+        for _ in range(len(self.instances)):
+            instance = self._acquire(tried)
+            if instance is None:
+                break
+            tried.add(id(instance))
+
+            started = time.monotonic()
+            try:
+                RateLimiter.for_url(instance.url).acquire()
+                response = instance.session.request(
+                    method,
+                    instance.url + path,
+                    json=body,
+                    headers={"api-key" : instance.api_key} if instance.api_key else None,
+                    timeout=self.timeout
+                )
+                if response.status_code == 429:
+                    RateLimiter.for_url(instance.url).backoff(RateLimiter.retry_after(response.headers))
+                if response.status_code >= 500 or response.status_code == 429:
+                    raise IOError("Search instance {} answered {}".format(instance.url, response.status_code))
+            except Exception as ex:  # pylint: disable=broad-except
+                self._release(instance, None)
+                last_error = ex
+                continue
+
+            self._release(instance, time.monotonic() - started)
+            response.raise_for_status()
+            return response.json() if response.content else None
+
+        raise last_error or IOError("No healthy search instance")
+
+    def healthy(self) -> typing.List[SearchInstance]:
+        """Instances currently taking requests"""
+        now = time.time()
+        with self._lock:
+            return [instance for instance in self.instances if instance.ejected_until <= now]
+
+    def _acquire(self, tried:set) -> typing.Optional[SearchInstance]:
+        """Pick an instance not tried yet and count the request against it"""
+        now = time.time()
+        with self._lock:
+            candidates = [instance for instance in self.instances if id(instance) not in tried]
+            available = [instance for instance in candidates if instance.ejected_until <= now]
+            if not available:
+                # Everything is out, the instance back soonest is still better than failing
+                available = sorted(candidates, key=lambda instance: instance.ejected_until)[:1]
+            if not available:
+                return None
+
+            if self.strategy == SearchInstancePool.STRATEGY_LATENCY:
+                instance = min(available, key=lambda instance: (instance.outstanding + 1) * instance.latency)
+            else:
+                instance = min(available, key=lambda instance: (instance.outstanding, instance.latency))
+
+            instance.outstanding += 1
+            return instance
+
+    def _release(self, instance:SearchInstance, latency:typing.Optional[float]) -> None:
+        """Record the outcome of a request, latency is None when it failed"""
+        with self._lock:
+            instance.outstanding -= 1
+            if latency is not None:
+                if instance.ejections:
+                    ActivityLog.log_info("Search instance reinstated", instance.url)
+                instance.failures = 0
+                instance.ejections = 0
+                instance.latency = latency if not instance.latency else (
+                    SearchInstancePool.LATENCY_WEIGHT * latency + (1 - SearchInstancePool.LATENCY_WEIGHT) * instance.latency)
+                return
+
+            instance.failures += 1
+            # An instance back from ejection is out again on its first failure
+            if instance.failures >= self.failure_threshold or instance.ejections:
+                eject = min(self.max_eject_seconds, self.eject_seconds * (2 ** instance.ejections))
+                instance.ejected_until = time.time() + eject
+                instance.ejections += 1
+                instance.failures = 0
+                ActivityLog.log_warning("Search instance taken out for {} seconds".format(eject), instance.url)
+
+    @staticmethod
+    def _instance(definition:typing.Any, pool_size:int) -> SearchInstance:
+        api_key = None
+        if isinstance(definition, dict):
+            api_key = definition.get("api_key") or definition.get("key")
+            definition = definition.get("url") or definition.get("endpoint") or definition.get("name")
+
+        url = str(definition)
+        if not url.startswith("http"):
+            url = SearchInstancePool.SERVICE_URL.format(name=url)
+        return SearchInstance(url, api_key, pool_size)
@@ -6,10 +6,12 @@ import os
 import logging
 from datetime import datetime, timedelta
 
-from dagcontext.airflowutil.varloader import AirflowVarialbeLoader
+from dagcontext.airflowutil.cachedvarloader import CachedAirflowVariableLoader
+from dagcontext.airflowutil.fanout import RecordFanout
 from dagcontext.configurations.constants import Constants
 from dagcontext.configurations.env_config import EnvironmentConfiguration
 
+from tasks.exampleconfig import ExampleConfiguration
 from tasks.exampletasks import ExampleTasks
 
 # Import the right objects based on airflow version 2.2.1 vs 1.10.12
@@ -33,19 +35,16 @@ with DAG(
 ) as dag:
 
 
-    # Load up the deployment details for processing
+    # Load up the deployment details for processing. Values compiled into the package
+    # by package_dag.py are used as is, everything else is deferred so parsing this file
+    # only records the names, they are resolved once per run when the first task executes.
     environment_config = EnvironmentConfiguration(
-        # Anything you want to load from the os.environ settings
-        environment_variables= [
-            Constants.OAK_IDENTITY.IDENTITY_ENDPOINT,
-            Constants.OAK_IDENTITY.IDENTITY_HEADER,
-            Constants.OAK_IDENTITY.OAK_HOST
-        ],
-        # Anything you want to load from Airflow variables
-        variable_loader = AirflowVarialbeLoader(),
-        airflow_variables = [
-            Constants.AIRFLOW_VARS.COGSRCH_SEARCH_INSTANCES
-        ],
+        environment_variables = ExampleConfiguration.ENVIRONMENT_VARIABLES,
+        # Airflow variables are read in bulk and cached
+        variable_loader = CachedAirflowVariableLoader(),
+        airflow_variables = ExampleConfiguration.AIRFLOW_VARIABLES,
+        deferred = True,
+        use_bundle = True
     )
 
     # Set up paths because we'll use them for logging, activity log, xcom passing
@@ -54,12 +53,9 @@ with DAG(
     dag_folder = os.path.join(airlfow_folder, "dags")
     temp_folder = os.path.join(dag_folder, "tmp/example")
 
-    if not os.path.exists(temp_folder):
-        os.makedirs(temp_folder)
-
     environment_config.update_config(Constants.ENVIRONMENT.WORKING_DIRECTORY, airlfow_folder)
     environment_config.update_config(Constants.ENVIRONMENT.DAG_DIRECTORY, dag_folder)
-    environment_config.update_config(Constants.ENVIRONMENT.TEMP_DIRECTORY, temp_folder)  
+    environment_config.update_directory(Constants.ENVIRONMENT.TEMP_DIRECTORY, temp_folder)  
 
     # Show Context and Get some data
     show_context = PythonOperator(
@@ -84,3 +80,33 @@ with DAG(
     # Dag Flow
     show_context >> consume_xcom
 
+    # Records are processed once per run: Airflow 2.3+ spreads them over mapped batch
+    # tasks, older versions process them all in a single task
+    if hasattr(PythonOperator, "partial"):
+        plan_records, process_records, merge_records = RecordFanout.build(
+            environment_config,
+            ExampleTasks.process_batch,
+            task_prefix = "records"
+        )
+        show_context >> plan_records
+        records_done = merge_records
+    else:
+        process_records = PythonOperator(
+            task_id="process_records",
+            python_callable=ExampleTasks.process_records,
+            op_kwargs=environment_config.get_config(),
+            provide_context=True,
+        )
+        show_context >> process_records
+        records_done = process_records
+
+    # Run cleanup waits for every other task, whether they succeeded or not, so no task
+    # of the run loses its claims, snapshot or log while it is still working
+    complete_run = PythonOperator(
+        task_id="complete_run",
+        python_callable=ExampleTasks.complete_run,
+        op_kwargs=environment_config.get_config(),
+        provide_context=True,
+        trigger_rule="all_done",
+    )
+    [consume_xcom, records_done] >> complete_run
@@ -0,0 +1,13 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+import os
+
+from dagcontext.airflowutil.dagfactory import DagFactory
+
+# Every DAG of example_pipelines.json, Airflow picks them up from the module globals.
+# The parsed configuration is cached by its hash so parsing this file again is cheap.
+globals().update(
+    DagFactory.build(os.path.join(os.path.dirname(os.path.abspath(__file__)), "example_pipelines.json"))
+)
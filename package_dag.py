@@ -0,0 +1,61 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+"""
+Create the DAG package (zip) with a compiled configuration bundle.
+
+    python package_dag.py --output example_dag.zip \
+        --env AIRFLOW_VAR_AZURE_DNS_HOST=myhost.energy.azure.com \
+        --variables target_variables.json
+
+--env NAME=value  Value of an os.environ setting on the target deployment
+--variables FILE  JSON dictionary of Airflow variable values on the target deployment
+--static KEY=value Any other setting to compile in
+
+Only names listed in tasks/exampleconfig.py are compiled and secrets are skipped.
+Anything without a value is resolved by the task at run time.
+"""
+
+import argparse
+import json
+import os
+from dagcontext.configurations.bundle import ConfigurationBundle
+from tasks.exampleconfig import ExampleConfiguration
+
+PACKAGE_SOURCES = [
+    "dagcontext",
+    "tasks",
+    "__init__.py",
+    "example_dag.py",
+    "example_factory_dag.py",
+    "example_pipelines.json"
+]
+
+def _pairs(values):
+    return dict(value.split("=", 1) for value in values or [])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Package the DAG with a compiled configuration bundle")
+    parser.add_argument("--output", required=True, help="Zip file to create, must not be called dagcontext or tasks")
+    parser.add_argument("--env", action="append", help="NAME=value of an environment setting")
+    parser.add_argument("--variables", help="JSON file with Airflow variable values")
+    parser.add_argument("--static", action="append", help="KEY=value of a static setting")
+    args = parser.parse_args()
+
+    airflow_values = {}
+    if args.variables:
+        with open(args.variables, "r") as variables_file:
+            airflow_values = json.load(variables_file)
+
+    bundle = ConfigurationBundle.compile(
+        ExampleConfiguration.ENVIRONMENT_VARIABLES,
+        ExampleConfiguration.AIRFLOW_VARIABLES,
+        environment_values=_pairs(args.env),
+        airflow_values=airflow_values,
+        static=_pairs(args.static),
+        secrets=ExampleConfiguration.SECRETS
+    )
+
+    ConfigurationBundle.package(args.output, bundle, PACKAGE_SOURCES, os.path.dirname(os.path.abspath(__file__)))
+    print("Created {} with {} compiled settings".format(args.output, len(bundle["settings"])))
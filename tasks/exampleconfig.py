@@ -0,0 +1,25 @@
+
+from dagcontext.configurations.constants import Constants
+
+class ExampleConfiguration:
+    """
+    Configuration names used by example_dag.py. Shared with package_dag.py so the
+    compiled configuration bundle is built for exactly the names the DAG asks for.
+    """
+
+    # Anything you want to load from the os.environ settings
+    ENVIRONMENT_VARIABLES = [
+        Constants.OAK_IDENTITY.IDENTITY_ENDPOINT,
+        Constants.OAK_IDENTITY.IDENTITY_HEADER,
+        Constants.OAK_IDENTITY.OAK_HOST
+    ]
+
+    # Anything you want to load from Airflow variables
+    AIRFLOW_VARIABLES = [
+        Constants.AIRFLOW_VARS.COGSRCH_SEARCH_INSTANCES
+    ]
+
+    # Never compiled into the bundle, always resolved on the worker
+    SECRETS = [
+        Constants.OAK_IDENTITY.IDENTITY_HEADER
+    ]
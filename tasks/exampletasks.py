@@ -1,6 +1,7 @@
 
 import typing
 from dagcontext.context.dagcontext import PropertyClass, DagContext
+from dagcontext.context.recordexecutor import RecordExecutor
 from dagcontext.generic.activelog import ActivityLog
 from dagcontext.configurations.constants import Constants
 from dagcontext.authentication.identityprovider import IdentitySelector
@@ -12,6 +13,7 @@ class ExampleTasks:
     """
 
     @staticmethod
+    @ActivityLog.flush_on_exit
     def show_context(**context):
         """
         Example task showing how to 
@@ -19,7 +21,8 @@ class ExampleTasks:
         2. Collect environment information collected from the system
         3. How to persist larger XCOM payloads for the next task
         """
-        context = DagContext(context)
+        # First task of the run, builds the context and saves the run snapshot
+        context = DagContext.from_snapshot(context)
         context.summarize()
 
 
@@ -58,17 +61,68 @@ class ExampleTasks:
         return xcom_loction
 
     @staticmethod
+    @ActivityLog.flush_on_exit
+    def process_batch(batch, **context):
+        """
+        Example mapped task (see RecordFanout) showing how to
+        1. Restrict the context to the batch of records handed to this instance
+        2. Process the records of the batch in parallel
+        3. Pass the batch output on to the reduce step
+        """
+        context = DagContext.from_snapshot(context)
+        context.bind_batch(batch)
+
+        ActivityLog.log_segment("Processing batch {}".format(batch[Constants.AIRFLOW_CTX.BATCH_INDEX]))
+        # A retry of this batch only processes the records the failed attempt did not complete
+        return context.record_executor(checkpoint=True).run(
+            ExampleTasks.process_record,
+            output_channel=Constants.XCOM_DATA.BATCH_XCOM_PERSIST_NAME
+        )
+
+    @staticmethod
+    def process_record(record_id:str) -> str:
+        """Work done for a single record"""
+        return record_id.split(':')[-1]
+
+    @staticmethod
+    @ActivityLog.flush_on_exit
+    def process_records(**context):
+        """
+        Example task processing every record of the run in one task, used where the
+        records cannot be fanned out to mapped tasks (see process_batch). Completed
+        records are journaled, a retry of this task only processes the rest.
+
+        The summary is passed on through xcom_output, a large one is persisted.
+        """
+        context = DagContext.from_snapshot(context)
+        ActivityLog.log_segment("Processing records")
+        try:
+            summary = context.record_executor(checkpoint=True).run(ExampleTasks.process_record)
+            if summary[RecordExecutor.ERRORS]:
+                raise RuntimeError("Records failed: {}".format(", ".join(summary[RecordExecutor.ERRORS])))
+        except Exception as ex:
+            # Leave the journal and claims for the retry, run files are left to complete_run
+            ActivityLog.log_error(ex)
+            raise ex
+
+        # The task succeeded, its retry journal is no longer needed
+        context.checkpoint_journal().clear()
+        return context.xcom_output(Constants.XCOM_DATA.RECORDS_XCOM_PERSIST_NAME, summary)
+
+    @staticmethod
+    @ActivityLog.flush_on_exit
     def consume_xcom(**context):
         """
         Example showing 
         1. How to retrieve information from the XCOM data being passed
         2. How to retrieve system and oak auth tokens 
-        3. How to ensure you clear up any files that could potentially left behind by either
-            - Inflight tracking of records
-            - XCOM payloads persisted to disk
+
+        Records are processed by process_batch or process_records, files of the run
+        are cleared by complete_run.
         """
 
-        context = DagContext(context)
+        # Loads the run snapshot saved by show_context, only XCOM data is pulled
+        context = DagContext.from_snapshot(context)
         context.summarize()
         ActivityLog.log_segment("Consuming XCOM")
         try:
@@ -87,14 +141,52 @@ class ExampleTasks:
                 "OAK Token: {}".format(system_auth_token)
             ) 
 
-            # Now intentionally raise so the data is cleared
-            ActivityLog.log_info("Intentional exception to come on missing XCOM Data to clear files")
-            context.get_value(PropertyClass.XCOM, "Field Doesn't Exist")
-
         except Exception as ex:
-            # For all follow on tasks, you MUST clear this data yourself so that there 
-            # is no accumulating cruft in the temp folders other than logs.
+            # Run files are left to complete_run
             ActivityLog.log_error(ex)
-            context.inflight_tracker.abandon(ex)
-            context.xcom_persist_clear(False)
             raise ex
+
+    @staticmethod
+    @ActivityLog.flush_on_exit
+    def complete_run(**context):
+        """
+        Last task of the DAG, runs once every other task is done (trigger_rule="all_done")
+        whether they succeeded or not. You MUST clear the run data yourself so that there
+        is no accumulating cruft in the temp folders other than logs:
+            - Inflight tracking of records
+            - XCOM payloads persisted to disk
+            - Resolved configuration, run snapshot and checkpoint journals
+
+        Fails when another task of the run failed, so the run is not reported as a success.
+        """
+        airflow_context = context
+        context = DagContext.from_snapshot(context)
+        ActivityLog.log_segment("Completing run")
+
+        # No run id, no tracker
+        if context.inflight_tracker is not None:
+            context.inflight_tracker.abandon()
+        context.xcom_persist_clear(False)
+        context.resolved_config_clear()
+        # Retries of tasks that failed part way resumed from these
+        context.checkpoint_clear()
+        context.snapshot_clear()
+        # Whatever is left of the run may now be collected
+        context.run_marker_clear()
+        # Nothing appends to the run log anymore, it can be compressed in the archive
+        ActivityLog.complete_run()
+
+        failed = ExampleTasks._failed_tasks(airflow_context)
+        if failed:
+            raise RuntimeError("Tasks of the run failed: {}".format(", ".join(failed)))
+
+    @staticmethod
+    def _failed_tasks(airflow_context:dict) -> typing.List[str]:
+        """Ids of the tasks of this DAG run that failed"""
+        dag_run = airflow_context.get("dag_run")
+        if dag_run is None:
+            return []
+        return sorted({
+            task_instance.task_id for task_instance in dag_run.get_task_instances()
+            if task_instance.state in ("failed", "upstream_failed")
+        })
@@ -0,0 +1,108 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+"""
+Import cost of the DAG module, the scheduler pays it on every parse of the DAG file.
+
+    python -m pytest -q tests/test_import_time.py -s
+
+Each import runs in a new interpreter. Airflow is imported first, as it is in the
+scheduler, so only what the DAG module adds is measured. Without airflow installed
+the parts of it the DAG file uses are stubbed.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+DAG_MODULE = "example_dag"
+# Milliseconds the fastest import of the DAG module may take
+BUDGET_MS = 150
+RUNS = 5
+
+# Top level packages only tasks load, never the DAG file parse
+DEFERRED_MODULES = [
+    "azure",
+    "requests",
+    "multiprocessing",
+    "argparse"
+]
+
+# Run in the new interpreter, prints the import time and the modules it loaded
+MEASURE = """
+import importlib.util
+import json
+import sys
+import time
+import types
+
+if importlib.util.find_spec("airflow") is None:
+    class Task:
+        def __init__(self, *args, **kwargs):
+            pass
+        def __rshift__(self, other):
+            return other
+        def __rrshift__(self, other):
+            return self
+
+    class DAG:
+        def __init__(self, *args, **kwargs):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            return False
+
+    for name in ("airflow", "airflow.configuration", "airflow.models", "airflow.operators",
+                 "airflow.operators.python", "airflow.utils", "airflow.utils.session"):
+        sys.modules[name] = types.ModuleType(name)
+        sys.modules[name].__path__ = []
+    sys.modules["airflow"].DAG = DAG
+    sys.modules["airflow.configuration"].conf = None
+    sys.modules["airflow.models"].Variable = object
+    sys.modules["airflow.operators.python"].PythonOperator = Task
+    sys.modules["airflow.utils.session"].create_session = None
+else:
+    # Loaded by the scheduler before it parses DAG files
+    import airflow.models
+
+loaded = set(sys.modules)
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"ms" : elapsed * 1000, "modules" : sorted(set(sys.modules) - loaded)}}))
+"""
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    @staticmethod
+    def _measure(module:str) -> dict:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(module=module)],
+            cwd=root,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=False
+        )
+        if result.returncode != 0:
+            raise AssertionError("Importing {} failed:\n{}".format(module, result.stderr[-2000:]))
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_dag_module_within_budget(self):
+        runs = [ImportTimeTest._measure(DAG_MODULE) for _ in range(RUNS)]
+        fastest = min(run["ms"] for run in runs)
+        print("Import of {}: {:.1f} ms (budget {} ms, {} runs)".format(DAG_MODULE, fastest, BUDGET_MS, RUNS))
+
+        loaded = {name.split(".")[0] for run in runs for name in run["modules"]}
+        self.assertEqual(sorted(name for name in DEFERRED_MODULES if name in loaded), [])
+        self.assertLessEqual(fastest, BUDGET_MS)
+
+
+if __name__ == "__main__":
+    unittest.main()
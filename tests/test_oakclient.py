@@ -0,0 +1,199 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+"""
+OakClient against a fake OAK service on a local http.server thread.
+
+    python -m pytest -q tests/test_oakclient.py -s
+
+Skipped when requests is not installed.
+"""
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dagcontext.configurations.constants import Constants
+from dagcontext.generic.ratelimit import RateLimiter
+from dagcontext.generic.warmregistry import WarmRegistry
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+# Lowest storage read rate accepted, the fake service answers each request after DELAY
+MIN_RECORDS_PER_SECOND = 2000
+
+
+class FakeOakService:
+    """
+    Storage, file and search endpoints answering after DELAY seconds. Counts the
+    requests per path, the most requests in flight at once and rejects any token
+    but VALID_TOKEN with a 401.
+    """
+    DELAY = 0.01
+    VALID_TOKEN = "fresh"
+
+    def __init__(self):
+        self.requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.throttle = 0
+        self.lock = threading.Lock()
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                service.handle(self)
+
+            def do_POST(self):
+                service.handle(self)
+
+            def do_PUT(self):
+                service.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, path:str) -> int:
+        with self.lock:
+            return self.requests.get(path, 0)
+
+    def handle(self, handler:BaseHTTPRequestHandler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = json.loads(handler.rfile.read(length)) if length else None
+        path = handler.path
+
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            throttled = self.throttle > 0
+            if throttled:
+                self.throttle -= 1
+        try:
+            time.sleep(FakeOakService.DELAY)
+            if throttled:
+                self.respond(handler, 429, {}, {"Retry-After" : "0"})
+            elif handler.headers.get("Authorization") != "Bearer {}".format(FakeOakService.VALID_TOKEN):
+                self.respond(handler, 401, {"message" : "token expired"})
+            elif handler.headers.get(Constants.OAK_API.PARTITION_HEADER) != "opendes":
+                self.respond(handler, 400, {"message" : "partition missing"})
+            elif path == Constants.OAK_API.STORAGE_QUERY_RECORDS:
+                self.respond(handler, 200, {"records" : [{"id" : record_id} for record_id in body["records"]]})
+            elif path == Constants.OAK_API.STORAGE_RECORDS:
+                self.respond(handler, 201, {"recordIds" : [record["id"] for record in body]})
+            elif path.startswith(Constants.OAK_API.STORAGE_RECORDS + "/"):
+                self.respond(handler, 200, {"id" : path.split("/")[-1]})
+            elif path.endswith("/metadata"):
+                self.respond(handler, 200, {"id" : path.split("/")[-2]})
+            else:
+                self.respond(handler, 404, {})
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    @staticmethod
+    def respond(handler:BaseHTTPRequestHandler, status:int, body:dict, headers:dict = None):
+        content = json.dumps(body).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class OakClientTest(unittest.TestCase):
+
+    def setUp(self):
+        # Deferred so the module can be collected without requests
+        from dagcontext.oakclient.client import OakClient
+
+        self.service = FakeOakService()
+        RateLimiter.LIMITS[self.service.url.split("//")[1]] = (100000.0, 100000.0)
+
+        self.refreshes = 0
+        def token_provider(refresh:bool) -> str:
+            if refresh:
+                self.refreshes += 1
+                return FakeOakService.VALID_TOKEN
+            return "expired" if self.refreshes == 0 else FakeOakService.VALID_TOKEN
+
+        self.token_provider = token_provider
+        self.client = OakClient(self.service.url, "opendes", token_provider, max_concurrency=8)
+
+    def tearDown(self):
+        self.client.close()
+        WarmRegistry.invalidate(WarmRegistry.KIND_SESSION)
+        self.service.stop()
+
+    def test_get_records_batched(self):
+        record_ids = ["opendes:wellbore:{}".format(index) for index in range(5000)]
+        # The first request gets the 401 and refreshes the token
+        self.assertEqual(self.client.get_record(record_ids[0]), {"id" : record_ids[0]})
+
+        started = time.monotonic()
+        records = self.client.get_records(record_ids)
+        elapsed = time.monotonic() - started
+        records_per_second = len(records) / elapsed
+        print("get_records: {} records in {:.3f}s, {:.0f} records/sec".format(len(records), elapsed, records_per_second))
+
+        self.assertEqual([record["id"] for record in records], record_ids)
+        self.assertEqual(
+            self.service.count(Constants.OAK_API.STORAGE_QUERY_RECORDS),
+            len(record_ids) // Constants.OAK_API.STORAGE_QUERY_BATCH
+        )
+        self.assertGreater(records_per_second, MIN_RECORDS_PER_SECOND)
+
+    def test_put_records_batched(self):
+        records = [{"id" : "opendes:wellbore:{}".format(index)} for index in range(1200)]
+        self.assertEqual(self.client.put_records(records), [record["id"] for record in records])
+        self.assertEqual(self.service.count(Constants.OAK_API.STORAGE_RECORDS), 4)
+
+    def test_concurrency_limit(self):
+        from dagcontext.oakclient.client import OakClient
+
+        client = OakClient(self.service.url, "opendes", self.token_provider, max_concurrency=3)
+        file_ids = ["file-{}".format(index) for index in range(40)]
+        try:
+            metadata = client.get_files_metadata(file_ids)
+        finally:
+            client.close()
+
+        self.assertEqual([item["id"] for item in metadata], file_ids)
+        self.assertLessEqual(self.service.max_in_flight, 3)
+        self.assertGreater(self.service.max_in_flight, 1)
+
+    def test_token_refreshed_once_on_401(self):
+        self.client.get_file_metadata("file-1")
+        self.client.get_file_metadata("file-2")
+        self.assertEqual(self.refreshes, 1)
+
+    def test_throttled_request_sent_again(self):
+        self.service.throttle = 2
+        self.assertEqual(self.client.get_records(["opendes:wellbore:1"]), [{"id" : "opendes:wellbore:1"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
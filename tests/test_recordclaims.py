@@ -0,0 +1,108 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+"""
+Record claims between the tasks of a run: the fan-out batch tasks and the single
+task path processing the same records at the same time.
+
+    python -m pytest -q tests/test_recordclaims.py
+"""
+
+import collections
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from dagcontext.airflowutil.fanout import RecordFanout
+from dagcontext.configurations.constants import Constants
+from dagcontext.context.dagcontext import DagContext
+from dagcontext.context.inflight import InflightTracker
+from dagcontext.generic.activelog import ActivityLog
+from tasks.exampletasks import ExampleTasks
+
+
+class FakeTaskInstance:
+    """The parts of an Airflow task instance the context reads"""
+    def __init__(self, task_id:str, map_index:int = -1):
+        self.task_id = task_id
+        self.map_index = map_index
+
+
+class RecordClaimsTest(unittest.TestCase):
+    RUN_ID = "claims-run"
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.record_ids = ["opendes:wellbore:{}".format(index) for index in range(40)]
+        self.processed = collections.Counter()
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        # Log lines of the run are written to the temp directory
+        ActivityLog.flush()
+        shutil.rmtree(self.temp_directory, ignore_errors=True)
+
+    def _context(self, task_id:str, map_index:int = -1, **settings) -> dict:
+        context = {
+            Constants.AIRFLOW_CTX.TASK_PARAMS : {
+                Constants.AIRFLOW_EX_CTX.SYSTEM_RUN_ID : RecordClaimsTest.RUN_ID,
+                Constants.AIRFLOW_EX_CTX.SYSTEM_PARTITION_ID : "opendes",
+                Constants.AIRFLOW_EX_CTX.SYSTEM_FILE_ID : self.record_ids
+            },
+            Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS : {
+                Constants.ENVIRONMENT.TEMP_DIRECTORY : self.temp_directory
+            },
+            Constants.AIRFLOW_CTX.TASK_INSTANCE : FakeTaskInstance(task_id, map_index)
+        }
+        context.update(settings)
+        return context
+
+    def _process_record(self, record_id:str) -> str:
+        with self.lock:
+            self.processed[record_id] += 1
+        # Long enough for both paths to be working at the same time
+        time.sleep(0.005)
+        return record_id.split(":")[-1]
+
+    def test_claim_owned_by_task_of_run(self):
+        inflight_path = self.temp_directory
+        first = InflightTracker(RecordClaimsTest.RUN_ID, inflight_path, "records_batch.0")
+        retry = InflightTracker(RecordClaimsTest.RUN_ID, inflight_path, "records_batch.0")
+        other = InflightTracker(RecordClaimsTest.RUN_ID, inflight_path, "process_records.-1")
+
+        self.assertTrue(first.claim("opendes:wellbore:1"))
+        self.assertTrue(retry.claim("opendes:wellbore:1"))
+        self.assertFalse(other.claim("opendes:wellbore:1"))
+        self.assertFalse(other.release("opendes:wellbore:1"))
+        self.assertTrue(first.release("opendes:wellbore:1"))
+        self.assertTrue(other.claim("opendes:wellbore:1"))
+
+    def test_each_record_processed_once(self):
+        # The first task of the run saves the snapshot both paths start from
+        DagContext.from_snapshot(self._context("show_context"))
+        batches = RecordFanout.plan_batches(len(self.record_ids), batch_size=10)
+
+        def run_batch(batch):
+            ExampleTasks.process_batch(batch, **self._context("records_batch", batch[Constants.AIRFLOW_CTX.BATCH_INDEX]))
+
+        outputs = []
+        with mock.patch.object(ExampleTasks, "process_record", self._process_record):
+            threads = [threading.Thread(target=run_batch, args=(batch,)) for batch in batches]
+            threads.append(threading.Thread(
+                target=lambda: outputs.append(ExampleTasks.process_records(**self._context("process_records")))
+            ))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sorted(self.processed), sorted(self.record_ids))
+        self.assertEqual(set(self.processed.values()), {1})
+        self.assertEqual(len(outputs), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+"""
+Run snapshots shared by the tasks of a run, tasks passed other settings in their
+op_kwargs keep their own.
+
+    python -m pytest -q tests/test_runsnapshot.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from dagcontext.configurations.config_snapshot import ResolvedConfigSnapshot
+from dagcontext.configurations.constants import Constants
+from dagcontext.configurations.env_config import EnvironmentConfiguration
+from dagcontext.context.dagcontext import DagContext
+from dagcontext.generic.activelog import ActivityLog
+from dagcontext.generic.warmregistry import WarmRegistry
+
+
+class RunSnapshotTest(unittest.TestCase):
+    RUN_ID = "snapshot-run"
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Log lines of the run are written to the temp directory
+        ActivityLog.flush()
+        WarmRegistry.invalidate()
+        shutil.rmtree(self.temp_directory, ignore_errors=True)
+
+    def _context(self, settings_name:str, settings:dict) -> dict:
+        return {
+            Constants.AIRFLOW_CTX.TASK_PARAMS : {
+                Constants.AIRFLOW_EX_CTX.SYSTEM_RUN_ID : RunSnapshotTest.RUN_ID
+            },
+            settings_name : settings
+        }
+
+    def _settings(self, **values) -> dict:
+        values[Constants.ENVIRONMENT.TEMP_DIRECTORY] = self.temp_directory
+        return values
+
+    def _deferred(self, **values) -> dict:
+        return {EnvironmentConfiguration.DEFERRED_STATIC : self._settings(**values)}
+
+    def test_task_settings_not_replaced_by_snapshot(self):
+        first = DagContext.from_snapshot(
+            self._context(Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS, self._settings(shard="a"))
+        )
+        second = DagContext.from_snapshot(
+            self._context(Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS, self._settings(shard="b"))
+        )
+        same = DagContext.from_snapshot(
+            self._context(Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS, self._settings(shard="a"))
+        )
+
+        self.assertEqual(first.environment_settings["shard"], "a")
+        self.assertEqual(second.environment_settings["shard"], "b")
+        self.assertEqual(same.environment_settings["shard"], "a")
+
+        directory = os.path.join(self.temp_directory, Constants.XCOM_PERSIST.CONTEXT_SNAPSHOT_PERSIST_PATH)
+        self.assertEqual(len(os.listdir(directory)), 2)
+        self.assertTrue(same.snapshot_clear())
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_deferred_settings_resolved_per_task_settings(self):
+        first = DagContext.from_snapshot(
+            self._context(Constants.ENVIRONMENT.DEFERRED_SETTINGS, self._deferred(shard="a"))
+        )
+        second = DagContext.from_snapshot(
+            self._context(Constants.ENVIRONMENT.DEFERRED_SETTINGS, self._deferred(shard="b"))
+        )
+
+        self.assertEqual(first.environment_settings["shard"], "a")
+        self.assertEqual(second.environment_settings["shard"], "b")
+
+        directory = os.path.join(self.temp_directory, Constants.XCOM_PERSIST.RESOLVED_CONFIG_PERSIST_PATH)
+        self.assertEqual(
+            sorted(ResolvedConfigSnapshot.run_id_from_name(name) for name in os.listdir(directory)),
+            [RunSnapshotTest.RUN_ID] * 2
+        )
+        self.assertTrue(ResolvedConfigSnapshot.clear(RunSnapshotTest.RUN_ID, self.temp_directory))
+        self.assertEqual(os.listdir(directory), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+"""
+SearchInstancePool against fake search instances on local http.server threads.
+
+    python -m pytest -q tests/test_searchpool.py -s
+
+Skipped when requests is not installed.
+"""
+
+import json
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dagcontext.generic.ratelimit import RateLimiter
+from dagcontext.generic.warmregistry import WarmRegistry
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+
+class FakeSearchInstance:
+    """
+    Search instance answering after delay seconds with status. Counts the requests
+    it received and rejects requests without API_KEY.
+    """
+    API_KEY = "search-key"
+
+    def __init__(self, delay:float = 0.01, status:int = 200):
+        self.delay = delay
+        self.status = status
+        self.received = 0
+        self.lock = threading.Lock()
+
+        instance = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                instance.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        RateLimiter.LIMITS[self.url.split("//")[1]] = (100000.0, 100000.0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self) -> int:
+        with self.lock:
+            return self.received
+
+    def handle(self, handler:BaseHTTPRequestHandler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        handler.rfile.read(length)
+        with self.lock:
+            self.received += 1
+        time.sleep(self.delay)
+
+        status = self.status
+        if status == 200 and handler.headers.get("api-key") != FakeSearchInstance.API_KEY:
+            status = 403
+        content = json.dumps({"value" : [{"instance" : self.url}]} if status == 200 else {}).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class SearchInstancePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instances = []
+
+    def tearDown(self):
+        WarmRegistry.invalidate(WarmRegistry.KIND_SESSION)
+        for instance in self.instances:
+            instance.stop()
+
+    def _pool(self, instances, **settings):
+        # Deferred so the module can be collected without requests
+        from dagcontext.oakclient.searchpool import SearchInstancePool
+
+        self.instances.extend(instances)
+        definitions = [{"url" : instance.url, "api_key" : FakeSearchInstance.API_KEY} for instance in instances]
+        return SearchInstancePool(definitions, **settings)
+
+    @staticmethod
+    def _search(pool, count:int, threads:int) -> list:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(lambda _: pool.search("records", {"search" : "*"}), range(count)))
+
+    def test_least_outstanding_spreads_requests(self):
+        instances = [FakeSearchInstance(delay=0.02) for _ in range(3)]
+        pool = self._pool(instances)
+
+        started = time.monotonic()
+        responses = SearchInstancePoolTest._search(pool, 60, 6)
+        elapsed = time.monotonic() - started
+        print("least_outstanding: {} searches in {:.3f}s, per instance {}".format(
+            len(responses), elapsed, [instance.count() for instance in instances]))
+
+        self.assertEqual(len(responses), 60)
+        for instance in instances:
+            self.assertGreaterEqual(instance.count(), 10)
+        self.assertTrue(all(instance.outstanding == 0 for instance in pool.instances))
+
+    def test_latency_prefers_fast_instances(self):
+        slow = FakeSearchInstance(delay=0.1)
+        fast = [FakeSearchInstance(delay=0.005) for _ in range(2)]
+        pool = self._pool([slow] + fast, strategy="latency")
+
+        SearchInstancePoolTest._search(pool, 80, 4)
+        print("latency: slow {}, fast {}".format(slow.count(), [instance.count() for instance in fast]))
+
+        for instance in fast:
+            self.assertGreater(instance.count(), slow.count())
+
+    def test_failing_instance_ejected_and_reinstated(self):
+        failing = FakeSearchInstance(status=500)
+        healthy = FakeSearchInstance()
+        pool = self._pool([failing, healthy], failure_threshold=2, eject_seconds=1.0)
+
+        # Every search succeeds, the failed attempts are retried on the healthy instance
+        for _ in range(10):
+            self.assertEqual(pool.search("records", {})["value"][0]["instance"], healthy.url)
+        self.assertEqual(failing.count(), 2)
+        self.assertEqual([instance.url for instance in pool.healthy()], [healthy.url])
+
+        # Back after eject_seconds, its first success reinstates it
+        failing.status = 200
+        time.sleep(1.05)
+        SearchInstancePoolTest._search(pool, 10, 2)
+        self.assertGreater(failing.count(), 2)
+        self.assertEqual(len(pool.healthy()), 2)
+        self.assertEqual(pool.instances[0].ejections, 0)
+
+    def test_reinstated_instance_out_again_on_first_failure(self):
+        failing = FakeSearchInstance(status=503)
+        healthy = FakeSearchInstance()
+        pool = self._pool([failing, healthy], failure_threshold=2, eject_seconds=0.5)
+
+        for _ in range(4):
+            pool.search("records", {})
+        time.sleep(0.55)
+        for _ in range(4):
+            pool.search("records", {})
+
+        # One more attempt after the first ejection, then out for twice as long
+        self.assertEqual(failing.count(), 3)
+        self.assertEqual(pool.instances[0].ejections, 2)
+        self.assertNotIn(pool.instances[0], pool.healthy())
+
+    def test_every_instance_failing_raises(self):
+        pool = self._pool([FakeSearchInstance(status=500) for _ in range(2)], failure_threshold=1)
+        with self.assertRaises(IOError):
+            pool.search("records", {})
+
+
+if __name__ == "__main__":
+    unittest.main()
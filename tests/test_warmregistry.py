@@ -0,0 +1,65 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# Licensed under Microsoft Incubation License Agreement:
+
+"""
+Resources the WarmRegistry keeps between the tasks of a worker process.
+
+    python -m pytest -q tests/test_warmregistry.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from dagcontext.authentication.authfactory import AuthFactory
+from dagcontext.authentication.identityprovider import IdentitySelector
+from dagcontext.configurations.constants import Constants
+from dagcontext.context.dagcontext import DagContext
+from dagcontext.generic.warmregistry import WarmRegistry
+
+
+class WarmRegistryTest(unittest.TestCase):
+
+    def tearDown(self):
+        WarmRegistry.invalidate()
+
+    @staticmethod
+    def _context() -> DagContext:
+        return DagContext({
+            Constants.ENVIRONMENT.ENVIRONMENT_SETTINGS : {
+                Constants.OAK_IDENTITY.IDENTITY_ENDPOINT : "http://127.0.0.1/identity",
+                Constants.OAK_IDENTITY.IDENTITY_HEADER : "header"
+            }
+        })
+
+    def test_failed_token_load_not_kept(self):
+        failed = ({selector : None for selector in IdentitySelector}, None)
+        loaded = ({selector : "token" for selector in IdentitySelector}, None)
+
+        with mock.patch.object(AuthFactory, "load_expiring_authentication", side_effect=[failed, loaded]) as load:
+            # Every provider fails for the first task
+            self.assertIsNone(WarmRegistryTest._context().get_authentication_token(IdentitySelector.OakSystem))
+            # The next task of the process tries again and keeps what it got
+            self.assertEqual(WarmRegistryTest._context().get_authentication_token(IdentitySelector.OakSystem), "token")
+            self.assertEqual(WarmRegistryTest._context().get_authentication_token(IdentitySelector.OakSystem), "token")
+
+        self.assertEqual(load.call_count, 2)
+
+    def test_removed_directory_created_again(self):
+        temp_directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_directory, "inflight")
+            WarmRegistry.ensure_directory(path)
+            shutil.rmtree(path)
+
+            WarmRegistry.ensure_directory(path)
+            with open(os.path.join(path, "record"), "w") as record:
+                record.write("claimed")
+        finally:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()